@@ -0,0 +1,26 @@
+-- Per-student report checkpoints so interrupted generation runs can be resumed
+CREATE TABLE IF NOT EXISTS public.report_checkpoints (
+    id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
+    upload_id UUID REFERENCES public.uploads(id) ON DELETE CASCADE NOT NULL,
+    student_index INTEGER NOT NULL,
+    student_name TEXT,
+    report TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    UNIQUE (upload_id, student_index)
+);
+
+-- Enable Row Level Security
+ALTER TABLE public.report_checkpoints ENABLE ROW LEVEL SECURITY;
+
+-- Users can read checkpoints for their own uploads (writes go through the service role key)
+CREATE POLICY "Users can view own report checkpoints" ON public.report_checkpoints
+    FOR SELECT USING (
+        EXISTS (
+            SELECT 1 FROM public.uploads
+            WHERE uploads.id = report_checkpoints.upload_id
+            AND uploads.user_id = auth.uid()
+        )
+    );
+
+-- Create indexes for better performance
+CREATE INDEX IF NOT EXISTS report_checkpoints_upload_id_idx ON public.report_checkpoints(upload_id);
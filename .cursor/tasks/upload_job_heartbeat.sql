@@ -0,0 +1,13 @@
+-- Running jobs refresh heartbeat_at so a queued or processing upload whose worker died can be detected and taken over
+DO $$ 
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 
+        FROM information_schema.columns 
+        WHERE table_name = 'uploads' 
+        AND column_name = 'heartbeat_at'
+    ) THEN
+        ALTER TABLE public.uploads 
+        ADD COLUMN heartbeat_at TIMESTAMP WITH TIME ZONE;
+    END IF;
+END $$;
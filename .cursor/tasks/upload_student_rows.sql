@@ -0,0 +1,14 @@
+-- Store the parsed student records against each upload so generation doesn't re-download and re-parse the workbook
+DO $$ 
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 
+        FROM information_schema.columns 
+        WHERE table_name = 'uploads' 
+        AND column_name = 'student_rows'
+    ) THEN
+        -- Columnar JSON: {"fields": [...], "rows": [[...], ...]}
+        ALTER TABLE public.uploads 
+        ADD COLUMN student_rows JSONB;
+    END IF;
+END $$;
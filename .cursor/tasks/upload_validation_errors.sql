@@ -0,0 +1,14 @@
+-- Row-level validation problems found when a sheet is uploaded; uploads with any are stored with status 'invalid'
+DO $$ 
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 
+        FROM information_schema.columns 
+        WHERE table_name = 'uploads' 
+        AND column_name = 'validation_errors'
+    ) THEN
+        -- [{"row": 5, "field": "Gender", "reason": "..."}, ...]
+        ALTER TABLE public.uploads 
+        ADD COLUMN validation_errors JSONB;
+    END IF;
+END $$;
@@ -1,17 +1,34 @@
-from flask import Flask, request, render_template, redirect, session, url_for, flash, render_template, send_file, jsonify
+from flask import Flask, request, render_template, redirect, session, url_for, flash, render_template, send_file, jsonify, Response, stream_with_context
 from supabase_config import supabase, supabase_admin
 from functools import wraps
+import io
 import os
 import secrets
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 import logging
-from datetime import datetime
-from utils.excel_parser import read_student_data_from_excel
+import json
+import time
+import urllib.parse
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Callable, Tuple
+from utils.excel_parser import (
+    read_student_data_from_excel, validate_student_workbook, group_students_by_class,
+    pack_student_rows, unpack_student_rows, ExcelParsingError
+)
 from utils.report_generator import ReportGenerationService, ReportGenerationError
+from utils.buffers import SpooledBuffer
+from utils.docx_builder import IncrementalWordDoc, render_report_bundle, OUTPUT_MODES, DEFAULT_OUTPUT_MODE
 from utils.storage import storage_service, StorageError
 from utils.usage import usage_service, UsageTrackingError
+from utils.report_cache import report_cache, ReportCacheError
+from utils.download_cache import download_cache, DownloadCacheError
+from utils.checkpoints import checkpoint_store, CheckpointError
+from utils.report_renderer import report_renderer, ReportRenderError, RENDER_FORMATS
+from utils.jobs import job_runner, Job, JobError
+from utils.progress_store import progress_store
+from utils.event_loop import event_loop
 import openpyxl.utils.exceptions
-from asgiref.wsgi import WsgiToAsgi
 import asyncio
 
 #create uploads directory on boot
@@ -21,8 +38,43 @@ os.makedirs("uploads", exist_ok=True)
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Global progress tracking
-progress_tracker = {}
+# Seconds between keep-alive comments on idle Server-Sent Event streams
+SSE_KEEPALIVE_SECONDS = 15
+
+# Each event stream holds a worker thread, so streams are only offered on threaded workers;
+# on sync workers the page polls /jobs/<job_id> instead
+SSE_ENABLED = os.getenv('SSE_ENABLED', str(os.getenv('GUNICORN_WORKER_CLASS', 'gthread') != 'sync')).lower() == 'true'
+
+# Event streams end after this long, well under the gunicorn worker timeout, and the client reconnects
+SSE_MAX_STREAM_SECONDS = float(os.getenv('SSE_MAX_STREAM_SECONDS', '120'))
+
+# Event streams check the shared job event log for new events this often
+SSE_POLL_SECONDS = float(os.getenv('SSE_POLL_SECONDS', '0.5'))
+
+# Row-level problems returned from /upload and stored against the upload; the total is still reported
+MAX_VALIDATION_ERRORS = 500
+
+# Background jobs aren't bound by the gunicorn worker timeout, so they get a longer generation budget
+JOB_TIME_BUDGET_SECONDS = float(os.getenv('JOB_TIME_BUDGET_SECONDS', '1800'))
+
+# Running jobs refresh their upload's heartbeat_at every JOB_HEARTBEAT_SECONDS (see utils/jobs.py); a queued
+# or processing upload whose heartbeat is older than this belongs to a dead worker and can be taken over
+JOB_STALE_SECONDS = float(os.getenv('JOB_STALE_SECONDS', '120'))
+
+# How /download serves reports: 'cache' (send from the shared download cache), 'stream'
+# (proxy storage in chunks) or 'redirect' (send the client to a signed storage URL)
+DOWNLOAD_MODES = ('cache', 'stream', 'redirect')
+DOWNLOAD_MODE = os.getenv('DOWNLOAD_MODE', 'cache')
+if DOWNLOAD_MODE not in DOWNLOAD_MODES:
+    raise ValueError(f"DOWNLOAD_MODE must be one of: {', '.join(DOWNLOAD_MODES)}")
+DOWNLOAD_CHUNK_BYTES = int(os.getenv('DOWNLOAD_CHUNK_BYTES', str(64 * 1024)))
+DOWNLOAD_SIGNED_URL_TTL_SECONDS = int(os.getenv('DOWNLOAD_SIGNED_URL_TTL_SECONDS', '60'))
+
+# Content types for generated report files
+OUTPUT_CONTENT_TYPES = {
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.zip': 'application/zip'
+}
 
 def ensure_uploads_table():
     try:
@@ -176,6 +228,7 @@ def upload_page():
                 logger.warning(f"Invalid file type: {file.mimetype}")
                 return jsonify({'error': 'Invalid file type. Only .xlsx files are allowed.'}), 400
 
+            upload_buffer = None
             try:
                 # Generate unique filename with timestamp
                 original_filename = secure_filename(file.filename)
@@ -183,13 +236,46 @@ def upload_page():
                 timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
                 unique_filename = f"{filename_without_ext}_{timestamp}{file_ext}"
                 
-                # Save the file to disk temporarily
-                temp_file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                file.save(temp_file_path)
-                logger.info(f"Saved file temporarily to {temp_file_path}")
+                # Hold the file in memory (spilling to a temporary file only if it is large)
+                upload_buffer = SpooledBuffer(suffix=file_ext)
+                file.save(upload_buffer)
+                logger.info(f"Received {upload_buffer.size()} bytes for {unique_filename}")
                 
                 # Get user ID from session
                 user_id = session['user']
+
+                # Parse and validate once here; /generate reads the stored rows instead of the workbook
+                try:
+                    student_data, validation_errors = validate_student_workbook(upload_buffer)
+                except ExcelParsingError as parse_error:
+                    logger.warning(f"Rejected upload {unique_filename}: {str(parse_error)}")
+                    return jsonify({'error': str(parse_error), 'validation_errors': []}), 400
+                student_count = len(student_data)
+                logger.info(f"Student count: {student_count}")
+
+                # The new upload becomes the latest, so /progress must stop reporting the previous one
+                progress_store.delete(user_progress_key(user_id))
+
+                if validation_errors:
+                    # Record the upload as invalid so generation stays blocked until a clean sheet is uploaded
+                    logger.info(f"Upload {unique_filename} has {len(validation_errors)} validation errors")
+                    result = supabase_admin.table('uploads').insert({
+                        'user_id': user_id,
+                        'filename': unique_filename,
+                        'file_path': f"{user_id}/{unique_filename}",
+                        'num_students': student_count,
+                        'status': 'invalid',
+                        'validation_errors': validation_errors[:MAX_VALIDATION_ERRORS],
+                        'error_message': 'The sheet has rows that need fixing',
+                        'created_at': datetime.utcnow().isoformat()
+                    }).execute()
+                    return jsonify({
+                        'error': f"{len(validation_errors)} problem(s) found in the sheet. Fix them and upload it again.",
+                        'student_count': student_count,
+                        'upload_id': result.data[0]['id'] if result.data else None,
+                        'error_count': len(validation_errors),
+                        'validation_errors': validation_errors[:MAX_VALIDATION_ERRORS]
+                    }), 422
                 
                 # Upload to Supabase Storage
                 try:
@@ -198,35 +284,24 @@ def upload_page():
                     logger.info(f"Uploading to Supabase Storage: {storage_path}")
                     
                     # Upload the file to Supabase Storage
-                    with open(temp_file_path, 'rb') as f:
-                        supabase.storage.from_('uploads').upload(
-                            path=storage_path,
-                            file=f,
-                            file_options={"content-type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
-                        )
-                    
-                    # Get the public URL
-                    public_url = supabase.storage.from_('uploads').get_public_url(storage_path)
-                    logger.info(f"File uploaded successfully to {public_url}")
+                    event_loop.run(storage_service.upload_object(
+                        storage_path,
+                        upload_buffer.payload(),
+                        bucket='uploads',
+                        content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                    ))
+                    logger.info(f"File uploaded successfully to {storage_service.public_url(storage_path, 'uploads')}")
                     
                     # Store file info in database
                     result = supabase_admin.table('uploads').insert({
                         'user_id': user_id,
                         'filename': unique_filename,
                         'file_path': storage_path,
+                        'num_students': student_count,
+                        'student_rows': pack_student_rows(student_data),
                         'created_at': datetime.utcnow().isoformat()
                     }).execute()
-                    logger.info(f"Stored file info in database: {result.data}")
-                    
-                    # Count students
-                    import pandas as pd
-                    df = pd.read_excel(temp_file_path)
-                    student_count = len(df)
-                    logger.info(f"Student count: {student_count}")
-                    
-                    # Clean up temporary file
-                    os.remove(temp_file_path)
-                    logger.info(f"Cleaned up temporary file: {temp_file_path}")
+                    logger.info(f"Stored file info in database for upload {result.data[0]['id'] if result.data else None}")
                     
                     return jsonify({
                         'student_count': student_count,
@@ -235,19 +310,19 @@ def upload_page():
                     
                 except Exception as storage_error:
                     logger.error(f"Error uploading to Supabase Storage: {str(storage_error)}")
-                    # Clean up temporary file
-                    if os.path.exists(temp_file_path):
-                        os.remove(temp_file_path)
                     return jsonify({'error': f'Failed to upload file to storage: {str(storage_error)}'}), 500
                     
             except Exception as e:
                 logger.error(f"Error processing upload: {str(e)}")
                 return jsonify({'error': str(e)}), 500
+            finally:
+                if upload_buffer:
+                    upload_buffer.close()
         else:
             logger.warning(f"Invalid file type: {file.filename}")
             return jsonify({'error': 'Invalid file type. Only .xlsx files are allowed.'}), 400
             
-    return render_template('upload.html')
+    return render_template('upload.html', sse_enabled=SSE_ENABLED)
 
 @app.route('/logout')
 def logout():
@@ -257,10 +332,15 @@ def logout():
 @app.route('/progress')
 @login_required
 def get_progress():
-    """Get the current progress of report generation for the user"""
+    """Get the current progress of report generation for the user's latest upload"""
     user_id = session.get('user')
-    if user_id in progress_tracker:
-        return jsonify(progress_tracker[user_id])
+    latest = progress_store.get(user_progress_key(user_id))
+    progress = progress_store.get(latest['upload_id']) if latest else None
+    if progress is None:
+        upload = get_upload(user_id, columns='id')
+        progress = progress_store.get(upload['id']) if upload else None
+    if progress:
+        return jsonify(progress)
     else:
         return jsonify({
             'current': 0,
@@ -269,259 +349,824 @@ def get_progress():
             'progress': 0
         })
 
-class ExcelParsingError(Exception):
-    """Custom exception for Excel parsing errors"""
-    pass
+@app.route('/cache/stats')
+@login_required
+def get_cache_stats():
+    """Get counters for the generated report, rendered document and downloaded file caches"""
+    try:
+        stats = {'enabled': True, **report_cache.stats()} if report_cache else {'enabled': False}
+        stats['rendered_documents'] = report_renderer.stats()
+        stats['downloads'] = {'enabled': True, **download_cache.stats()} if download_cache else {'enabled': False}
+        return jsonify(stats)
+    except (ReportCacheError, DownloadCacheError) as e:
+        logger.error(f"Error reading cache stats: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
 class FileNotFoundError(Exception):
     """Custom exception for file not found errors"""
     pass
 
-@app.route("/generate", methods=["POST"])
-@login_required
-def generate_report():
-    async def _generate():
-        temp_file_path = None
-        output_file_path = None
+class UploadInvalidError(Exception):
+    """Raised when generation is requested for an upload that failed validation"""
+    pass
+
+class JobActiveError(Exception):
+    """Raised when generation is requested for an upload whose job is already queued or running"""
+    pass
+
+def output_filename_from_url(output_url: str) -> str:
+    """Report filename from an upload's output_file_url; older rows end in an empty '?' query"""
+    return os.path.basename(urllib.parse.urlparse(output_url).path)
+
+# Upload columns needed to report on a job; leaves out the (possibly large) student_rows
+JOB_COLUMNS = 'id, status, error_message, output_file_url, heartbeat_at'
+
+def user_progress_key(user_id: str) -> str:
+    """Progress store key naming the upload whose progress /progress reports for a user"""
+    return f"user:{user_id}"
+
+def get_upload(user_id: str, upload_id: Optional[str] = None, columns: str = '*') -> Optional[dict]:
+    """Return the user's upload with the given ID, or their latest upload if no ID is given"""
+    if upload_id:
+        logger.debug(f"Getting upload {upload_id} for user: {user_id}")
+        result = supabase.table('uploads').select(columns).eq('id', upload_id).eq('user_id', user_id).execute()
+    else:
+        # Get the latest uploaded file for the current user
+        logger.debug(f"Getting latest upload for user: {user_id}")
+        result = supabase.table('uploads').select(columns).eq('user_id', user_id).order('created_at', desc=True).limit(1).execute()
+    return result.data[0] if result.data else None
+
+async def update_upload(upload_id: str, fields: dict) -> None:
+    """Update an uploads row without blocking the event loop"""
+    await asyncio.to_thread(lambda: supabase_admin.table('uploads').update(fields).eq('id', upload_id).execute())
+
+async def run_report_generation(user_id: str, on_event: Optional[Callable[[str, dict], None]] = None,
+                                stream_tokens: bool = False, upload_id: Optional[str] = None,
+                                time_budget: Optional[float] = None, output_mode: str = DEFAULT_OUTPUT_MODE) -> Tuple[dict, int]:
+    """
+    Generate reports for an upload and store the resulting document
+
+    Each finished report is checkpointed against the uploads row, so running
+    this again for the same upload only generates the students that are
+    still missing before rebuilding the document.
+
+    Args:
+        user_id: ID of the user whose upload should be processed
+        on_event: Optional callback receiving ('report', data) as each student's report
+            completes, and ('token', data) for each streamed chunk when stream_tokens is set
+        stream_tokens: Stream report text from the LLM token by token through on_event
+        upload_id: Upload to process (or resume); defaults to the user's latest upload
+        time_budget: Seconds allowed for LLM generation; defaults to REPORT_TIME_BUDGET_SECONDS
+        output_mode: 'single' for one Word document, or 'per_student' / 'per_class'
+            for a zip of documents; defaults to REPORT_OUTPUT_MODE
+
+    Returns:
+        Tuple[dict, int]: JSON-serialisable response body and HTTP status code
+    """
+    on_report = None
+    on_token = None
+    if on_event:
+        def on_report(index: int, student_name: str, report: str, completed: int, total: int) -> None:
+            on_event('report', {
+                'index': index,
+                'student_name': student_name,
+                'report': report,
+                'current': completed,
+                'total': total
+            })
+
+        if stream_tokens:
+            def on_token(index: int, text: str) -> None:
+                on_event('token', {'index': index, 'text': text})
+
+    workbook_buffer = None
+    output_buffer = None
+    word_doc = None
+    try:
+        logger.info(f"Starting report generation process for user {user_id}")
+
+        latest_upload = await asyncio.to_thread(get_upload, user_id, upload_id)
+        if not latest_upload:
+            logger.warning(f"No files found for user {user_id}")
+            return {
+                'success': False,
+                'message': 'No files found. Please upload an Excel file first.'
+            }, 400
+
+        storage_path = latest_upload['file_path']
+        upload_id = latest_upload['id']
+
+        # Initialize progress tracking, keyed by the upload (job) ID so any worker can report it,
+        # and point /progress at this upload without a database lookup
+        await asyncio.to_thread(progress_store.set, upload_id, {
+            'current': 0,
+            'total': 0,
+            'status': 'Starting...',
+            'progress': 0
+        })
+        await asyncio.to_thread(progress_store.set, user_progress_key(user_id), {'upload_id': upload_id})
+
+        logger.info(f"Processing file {storage_path} (ID: {upload_id}) for user {user_id}")
+        await update_upload(upload_id, {
+            'status': 'processing',
+            'error_message': None,
+            'heartbeat_at': datetime.now(timezone.utc).isoformat()
+        })
+
         try:
-            user_id = session.get('user')
-            logger.info(f"Starting report generation process for user {user_id}")
-            
-            # Initialize progress tracking
-            progress_tracker[user_id] = {
-                'current': 0,
-                'total': 0,
-                'status': 'Starting...',
-                'progress': 0
-            }
-            
-            # Get the latest uploaded file for the current user
-            logger.debug(f"Getting latest upload for user: {user_id}")
-            result = supabase.table('uploads').select('*').eq('user_id', user_id).order('created_at', desc=True).limit(1).execute()
-            
-            if not result.data:
-                logger.warning(f"No files found for user {user_id}")
-                return jsonify({
-                    'success': False,
-                    'message': 'No files found. Please upload an Excel file first.'
-                }), 400
-            
-            latest_upload = result.data[0]
-            storage_path = latest_upload['file_path']
-            upload_id = latest_upload['id']
-            
-            logger.info(f"Processing file {storage_path} (ID: {upload_id}) for user {user_id}")
-            
-            # Download file from Supabase Storage
-            try:
+            if latest_upload.get('student_rows'):
+                # Rows were parsed and validated at upload time
+                student_data = unpack_student_rows(latest_upload['student_rows'])
+            else:
+                # Uploads from before rows were stored: download and parse the workbook
                 logger.info(f"Downloading file from storage: {storage_path}")
-                temp_file_path = await download_from_storage(storage_path, user_id)
-                logger.info(f"Successfully downloaded file to: {temp_file_path}")
-                
-                # Process the file
-                try:
-                    # Read student data
+                workbook_buffer = await download_from_storage(storage_path, user_id)
+                logger.info(f"Successfully downloaded {workbook_buffer.size()} bytes")
+                student_data = None
+
+            # Process the file
+            try:
+                # Read student data
+                if student_data is None:
                     logger.info("Starting to read student data from Excel file")
-                    student_data = read_student_data_from_excel(temp_file_path)
-                    if not student_data:
-                        logger.warning("No valid student data found in the file")
-                        # Update upload record with error
-                        supabase_admin.table('uploads').update({
-                            'status': 'error',
-                            'error_message': 'No valid student data found in the file'
-                        }).eq('id', upload_id).execute()
-                        return jsonify({
-                            'success': False,
-                            'message': 'No valid student data found in the file.'
-                        }), 400
-                    
-                    logger.info(f"Successfully read data for {len(student_data)} students")
-                    
-                    # Update progress tracking
-                    progress_tracker[user_id]['total'] = len(student_data)
-                    progress_tracker[user_id]['status'] = 'Processing students...'
-                    
-                    # Generate reports
-                    logger.info("Starting report generation process")
-                    report_service = ReportGenerationService()
+                    student_data = await asyncio.to_thread(read_student_data_from_excel, workbook_buffer)
+                if not student_data:
+                    logger.warning("No valid student data found in the file")
+                    # Update upload record with error
+                    await update_upload(upload_id, {
+                        'status': 'error',
+                        'error_message': 'No valid student data found in the file'
+                    })
+                    return {
+                        'success': False,
+                        'message': 'No valid student data found in the file.'
+                    }, 400
+
+                logger.info(f"Successfully read data for {len(student_data)} students")
+
+                # Update progress tracking
+                await asyncio.to_thread(progress_store.merge, upload_id, {'total': len(student_data), 'status': 'Processing students...'})
+
+                # Restore reports checkpointed by an earlier, interrupted run of this upload
+                completed_reports = await load_completed_reports(upload_id, student_data)
+                if completed_reports:
+                    logger.info(f"Resuming upload {upload_id}: {len(completed_reports)}/{len(student_data)} reports already generated")
+
+                async def on_checkpoint(index: int, student_name: str, report: str) -> None:
+                    await checkpoint_store.save(upload_id, index, student_name, report)
+
+                # Build a single Word document in the background as each report completes
+                if output_mode == 'single':
+                    word_doc = IncrementalWordDoc(len(student_data))
+
+                def on_report_ready(index: int, student_name: str, report: str, completed: int, total: int) -> None:
+                    if word_doc:
+                        word_doc.add(index, report)
+                    if on_report:
+                        on_report(index, student_name, report, completed, total)
+
+                # Generate reports
+                logger.info("Starting report generation process")
+                report_service = ReportGenerationService.with_shared_clients(time_budget=time_budget)
+                classes = group_students_by_class(student_data)
+                if len(classes) > 1:
+                    # Workbook with a sheet per class: generate each class as its own run within this job
+                    logger.info(f"Generating {len(classes)} classes: {list(classes)}")
+                    reports = await report_service.generate_class_reports(
+                        student_data,
+                        classes,
+                        upload_id,
+                        progress_store,
+                        on_report=on_report_ready,
+                        on_token=on_token,
+                        completed_reports=completed_reports,
+                        on_checkpoint=on_checkpoint
+                    )
+                else:
                     reports = await report_service.generate_reports_with_progress(
                         student_data,
-                        user_id,
-                        progress_tracker
+                        upload_id,
+                        progress_store,
+                        on_report=on_report_ready,
+                        on_token=on_token,
+                        completed_reports=completed_reports,
+                        on_checkpoint=on_checkpoint
                     )
-                    logger.info(f"Successfully generated {len(reports)} reports")
-                    
-                    # Create Word document
+                logger.info(f"Successfully generated {len(reports)} reports")
+                logger.info(f"Token usage for user {user_id}: {report_service.token_usage}")
+
+                if word_doc:
                     logger.info("Creating Word document with generated reports")
-                    output_file_path = await report_service.create_word_doc(reports)
-                    logger.info(f"Successfully created Word document at: {output_file_path}")
-                    
-                    # Upload the generated report to Supabase Storage
-                    output_filename = os.path.basename(output_file_path)
-                    output_storage_path = f"{user_id}/reports/{output_filename}"
-                    logger.info(f"Uploading generated report to storage: {output_storage_path}")
-                    
-                    with open(output_file_path, 'rb') as f:
-                        supabase.storage.from_('uploads').upload(
-                            path=output_storage_path,
-                            file=f,
-                            file_options={"content-type": "application/vnd.openxmlformats-officedocument.wordprocessingml.document"}
-                        )
-                    
-                    # Get the public URL for the output file
-                    output_url = supabase.storage.from_('uploads').get_public_url(output_storage_path)
-                    logger.info(f"Generated report available at: {output_url}")
-                    
-                    # Update the upload record with the output file URL and success status
-                    logger.info(f"Updating upload record {upload_id} with output URL")
-                    supabase_admin.table('uploads').update({
-                        'output_file_url': output_url,
-                        'status': 'completed',
-                        'error_message': None
-                    }).eq('id', upload_id).execute()
-                    
-                    # Delete the original Excel file from storage
-                    try:
-                        logger.info(f"Starting deletion of original Excel file from storage: {storage_path}")
-                        await storage_service.delete_file(os.path.basename(storage_path), user_id=user_id)
-                        logger.info(f"Successfully deleted original Excel file from storage: {storage_path}")
-                    except Exception as delete_error:
-                        logger.warning(f"Failed to delete original Excel file {storage_path}: {str(delete_error)}", exc_info=True)
-                        # Continue with cleanup even if deletion fails
-                    
-                    # Clean up temporary files
-                    logger.info("Starting cleanup of temporary files")
-                    try:
-                        if os.path.exists(temp_file_path):
-                            os.remove(temp_file_path)
-                            logger.info(f"Successfully deleted temporary file: {temp_file_path}")
-                        if os.path.exists(output_file_path):
-                            os.remove(output_file_path)
-                            logger.info(f"Successfully deleted output file: {output_file_path}")
-                        logger.info("Successfully completed cleanup of all temporary files")
-                    except Exception as cleanup_error:
-                        logger.error(f"Error during temporary file cleanup: {str(cleanup_error)}", exc_info=True)
-                        # Continue with response even if cleanup fails
-                    
-                    logger.info(f"Report generation completed successfully for user {user_id}")
-                    output_filename = os.path.basename(output_file_path) if output_file_path else None
-                    return jsonify({
-                        'success': True,
-                        'message': 'Reports generated successfully!',
-                        'filename': output_filename,
-                        'download_url': f"/download/reports/{output_filename}" if output_filename else None
-                    })
-                    
-                except Exception as process_error:
-                    logger.error(f"Error processing file: {str(process_error)}", exc_info=True)
-                    # Update upload record with error information
-                    supabase_admin.table('uploads').update({
-                        'status': 'error',
-                        'error_message': str(process_error)
-                    }).eq('id', upload_id).execute()
-                    return jsonify({
-                        'success': False,
-                        'message': f'Error processing file: {str(process_error)}'
-                    }), 500
-                    
-            except Exception as download_error:
-                logger.error(f"Error downloading file: {str(download_error)}", exc_info=True)
+                    output_filename, output_buffer = await word_doc.save(reports)
+                    logger.info(f"Successfully created Word document {output_filename}")
+                else:
+                    logger.info(f"Creating {output_mode} report bundle")
+                    output_filename, output_buffer = await asyncio.to_thread(
+                        render_report_bundle, reports, student_data, output_mode
+                    )
+                    logger.info(f"Successfully created report bundle {output_filename}")
+
+                # Upload the generated report to Supabase Storage
+                output_storage_path = f"{user_id}/reports/{output_filename}"
+                logger.info(f"Uploading generated report to storage: {output_storage_path}")
+
+                await storage_service.upload_object(
+                    output_storage_path,
+                    output_buffer.payload(),
+                    bucket='uploads',
+                    content_type=OUTPUT_CONTENT_TYPES[os.path.splitext(output_filename)[1]]
+                )
+                output_url = storage_service.public_url(output_storage_path, 'uploads')
+                logger.info(f"Generated report available at: {output_url}")
+
+                # Update the upload record with the output file URL and success status
+                logger.info(f"Updating upload record {upload_id} with output URL")
+                await update_upload(upload_id, {
+                    'output_file_url': output_url,
+                    'status': 'completed',
+                    'error_message': None
+                })
+
+                # Delete the original Excel file from storage
+                try:
+                    logger.info(f"Starting deletion of original Excel file from storage: {storage_path}")
+                    await storage_service.delete_file(os.path.basename(storage_path), user_id=user_id)
+                    logger.info(f"Successfully deleted original Excel file from storage: {storage_path}")
+                except Exception as delete_error:
+                    logger.warning(f"Failed to delete original Excel file {storage_path}: {str(delete_error)}", exc_info=True)
+                    # Continue with cleanup even if deletion fails
+
+                logger.info(f"Report generation completed successfully for user {user_id}")
+                return {
+                    'success': True,
+                    'message': 'Reports generated successfully!',
+                    'filename': output_filename,
+                    'download_url': f"/download/reports/{output_filename}" if output_filename else None
+                }, 200
+
+            except Exception as process_error:
+                logger.error(f"Error processing file: {str(process_error)}", exc_info=True)
                 # Update upload record with error information
-                supabase_admin.table('uploads').update({
+                await update_upload(upload_id, {
                     'status': 'error',
-                    'error_message': f'Error downloading file: {str(download_error)}'
-                }).eq('id', upload_id).execute()
-                return jsonify({
+                    'error_message': str(process_error)
+                })
+                return {
                     'success': False,
-                    'message': f'Error downloading file: {str(download_error)}'
-                }), 500
-                
-        except Exception as e:
-            logger.error(f"Unexpected error in report generation: {str(e)}", exc_info=True)
-            # Update upload record with error information if we have an upload_id
-            if 'upload_id' in locals():
-                supabase_admin.table('uploads').update({
-                    'status': 'error',
-                    'error_message': f'Unexpected error: {str(e)}'
-                }).eq('id', upload_id).execute()
+                    'message': f'Error processing file: {str(process_error)}'
+                }, 500
+
+        except Exception as download_error:
+            logger.error(f"Error downloading file: {str(download_error)}", exc_info=True)
+            # Update upload record with error information
+            await update_upload(upload_id, {
+                'status': 'error',
+                'error_message': f'Error downloading file: {str(download_error)}'
+            })
+            return {
+                'success': False,
+                'message': f'Error downloading file: {str(download_error)}'
+            }, 500
+
+    except asyncio.CancelledError:
+        # Reports finished before the cancel are already checkpointed, so the upload can be resumed
+        logger.info(f"Report generation cancelled for user {user_id}")
+        if upload_id:
+            await asyncio.to_thread(progress_store.set, upload_id, {
+                'current': 0,
+                'total': 0,
+                'status': 'Cancelled',
+                'progress': 0
+            })
+            await update_upload(upload_id, {'status': 'cancelled', 'error_message': None})
+        raise
+
+    except Exception as e:
+        logger.error(f"Unexpected error in report generation: {str(e)}", exc_info=True)
+        # Update upload record with error information if we have an upload_id
+        if 'upload_id' in locals():
+            await update_upload(upload_id, {
+                'status': 'error',
+                'error_message': f'Unexpected error: {str(e)}'
+            })
+        return {
+            'success': False,
+            'message': f'Unexpected error: {str(e)}'
+        }, 500
+
+    finally:
+        # Let the final progress be read for a little longer, then expire it
+        if upload_id:
+            await asyncio.to_thread(progress_store.finish, upload_id)
+            await asyncio.to_thread(progress_store.finish, user_progress_key(user_id))
+
+        if word_doc:
+            word_doc.close()
+
+        # Release the workbook and output buffers (and any file they spilled to)
+        for buffer in (workbook_buffer, output_buffer):
+            if buffer:
+                buffer.close()
+
+async def load_completed_reports(upload_id: str, student_data: list) -> dict:
+    """
+    Load checkpointed reports for an upload that still match the parsed students
+
+    Returns:
+        dict: Mapping of student index to report text; empty if checkpoints can't be read
+    """
+    try:
+        checkpoints = await checkpoint_store.load(upload_id)
+    except CheckpointError as e:
+        logger.warning(f"Could not load checkpoints, generating all students: {str(e)}")
+        return {}
+
+    return {
+        index: checkpoint['report']
+        for index, checkpoint in checkpoints.items()
+        if index < len(student_data) and checkpoint['student_name'] == student_data[index].get('student_name')
+    }
+
+async def load_report_set(upload: dict) -> Tuple[List[str], List[dict]]:
+    """
+    Load the stored report text for an upload, in student order
+
+    Students without a stored report (their generation failed or never ran)
+    get a placeholder. Uploads from before student rows were stored fall back
+    to the names saved with each report.
+
+    Returns:
+        Tuple[List[str], List[dict]]: Reports and the matching student records;
+        both empty if nothing has been generated
+    """
+    checkpoints = await checkpoint_store.load(upload['id'])
+    if not checkpoints:
+        return [], []
+    if upload.get('student_rows'):
+        students = unpack_student_rows(upload['student_rows'])
+        completed = {
+            index: checkpoint['report']
+            for index, checkpoint in checkpoints.items()
+            if index < len(students) and checkpoint['student_name'] == students[index].get('student_name')
+        }
+    else:
+        students = [
+            {'student_name': checkpoints[i]['student_name'] if i in checkpoints else f'Student {i + 1}'}
+            for i in range(max(checkpoints) + 1)
+        ]
+        completed = {index: checkpoint['report'] for index, checkpoint in checkpoints.items()}
+    reports = [
+        completed.get(i, f"Report not available for {student.get('student_name') or f'Student {i + 1}'}.")
+        for i, student in enumerate(students)
+    ]
+    return reports, students
+
+def requested_output_mode() -> str:
+    """
+    Output mode from the request's JSON body or ``output_mode`` query parameter
+
+    Raises:
+        ValueError: If the requested mode is not one of OUTPUT_MODES
+    """
+    body = request.get_json(silent=True) or {}
+    output_mode = body.get('output_mode') or request.args.get('output_mode') or DEFAULT_OUTPUT_MODE
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError(f"Unknown output mode '{output_mode}'. Choose one of: {', '.join(OUTPUT_MODES)}")
+    return output_mode
+
+# Message stored against an upload whose job stopped heartbeating
+STALE_JOB_MESSAGE = 'Report generation stopped unexpectedly. Resume to finish the remaining students.'
+
+def stale_job_filter() -> str:
+    """PostgREST or-filter matching uploads that no live job owns: not queued or processing, or not heartbeating"""
+    stale_before = (datetime.now(timezone.utc) - timedelta(seconds=JOB_STALE_SECONDS)).isoformat()
+    return f'status.is.null,status.not.in.(queued,processing),heartbeat_at.is.null,heartbeat_at.lt."{stale_before}"'
+
+def job_is_stale(upload: dict) -> bool:
+    """Whether a queued or processing upload has stopped heartbeating, e.g. because its worker died"""
+    if upload.get('status') not in ('queued', 'processing'):
+        return False
+    job = job_runner.get(upload['id'])
+    if job and job.status in ('queued', 'running'):
+        return False
+    heartbeat_at = upload.get('heartbeat_at')
+    if not heartbeat_at:
+        return True
+    age = datetime.now(timezone.utc) - datetime.fromisoformat(heartbeat_at)
+    return age.total_seconds() > JOB_STALE_SECONDS
+
+def recover_stale_job(upload: dict) -> dict:
+    """Mark an upload whose job stopped heartbeating as failed so it can be resumed
+
+    Returns:
+        dict: The upload, with its status updated if the job was stale
+    """
+    if not job_is_stale(upload):
+        return upload
+    result = supabase_admin.table('uploads').update({
+        'status': 'error',
+        'error_message': STALE_JOB_MESSAGE
+    }).eq('id', upload['id']).or_(stale_job_filter()).execute()
+    if not result.data:
+        # Another worker picked the job up in the meantime
+        return upload
+    logger.warning(f"Job {upload['id']} stopped heartbeating; marked it as failed")
+    return {**upload, 'status': 'error', 'error_message': STALE_JOB_MESSAGE}
+
+def record_job_heartbeat(job_ids: List[str]) -> None:
+    """Refresh heartbeat_at for uploads whose jobs are active in this process"""
+    supabase_admin.table('uploads').update({
+        'heartbeat_at': datetime.now(timezone.utc).isoformat()
+    }).in_('id', job_ids).in_('status', ['queued', 'processing']).execute()
+
+job_runner.set_heartbeat(record_job_heartbeat)
+
+def start_generation_job(user_id: str, upload: dict, stream_tokens: bool = False,
+                         output_mode: str = DEFAULT_OUTPUT_MODE) -> Job:
+    """Queue report generation for an upload on the background job runner
+
+    The uploads row ID doubles as the job ID, and its status column is the
+    durable job state ('queued' -> 'processing' -> 'completed' / 'error' / 'cancelled').
+    The row is claimed with a conditional update, so only one worker can
+    queue it while another worker's job is still heartbeating.
+
+    Raises:
+        UploadInvalidError: If the upload failed validation
+        JobActiveError: If the upload's job is already queued or running on another worker
+        JobError: If the job can't be queued
+    """
+    upload_id = upload['id']
+    if upload.get('status') == 'invalid':
+        raise UploadInvalidError("This upload has rows that need fixing. Upload a corrected sheet before generating.")
+    job = job_runner.get(upload_id)
+    if job and job.status in ('queued', 'running'):
+        return job
+
+    result = supabase_admin.table('uploads').update({
+        'status': 'queued',
+        'error_message': None,
+        'heartbeat_at': datetime.now(timezone.utc).isoformat()
+    }).eq('id', upload_id).or_(stale_job_filter()).execute()
+    if not result.data:
+        raise JobActiveError("Reports are already being generated for this upload")
+    return job_runner.submit(upload_id, lambda emit: run_report_generation(
+        user_id,
+        on_event=emit,
+        stream_tokens=stream_tokens,
+        upload_id=upload_id,
+        time_budget=JOB_TIME_BUDGET_SECONDS,
+        output_mode=output_mode
+    ))
+
+def job_links(job_id: str) -> dict:
+    return {
+        'status_url': f"/jobs/{job_id}",
+        'result_url': f"/jobs/{job_id}/result"
+    }
+
+def requested_stream_tokens() -> bool:
+    """Whether the request's JSON body asks for 'token' events as reports are written"""
+    body = request.get_json(silent=True) or {}
+    return bool(body.get('stream_tokens'))
+
+def job_accepted_response(job: Job):
+    body = {
+        'success': True,
+        'job_id': job.job_id,
+        'status': job.status,
+        **job_links(job.job_id)
+    }
+    if SSE_ENABLED:
+        body['events_url'] = f"/jobs/{job.job_id}/events"
+    return jsonify(body), 202
+
+def sse_response(job_id: str, after: int = 0, follow: bool = True) -> Response:
+    """Stream a job's events as Server-Sent Events, starting after event id ``after``
+
+    Events are read from the job's log in the shared progress store, so any
+    worker can serve the stream, not only the one running the job. A leading
+    'job' event tells the client which job it is following, and each event
+    carries an id so a reconnecting client resumes where it left off. After
+    SSE_MAX_STREAM_SECONDS the stream ends with a 'reconnect' event naming
+    the URL to continue from, so no request outlives the worker timeout.
+    With ``follow`` False (the job has already ended) the stored events are
+    replayed and the stream closes.
+    """
+    def _stream():
+        deadline = time.monotonic() + SSE_MAX_STREAM_SECONDS
+        last_sent = time.monotonic()
+        last_event_id = after
+        yield f"event: job\ndata: {json.dumps({'job_id': job_id})}\n\n"
+        while True:
+            for last_event_id, event, data in progress_store.events_after(job_id, last_event_id):
+                yield f"id: {last_event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+                last_sent = time.monotonic()
+                if event in ('done', 'error'):
+                    return
+            if not follow:
+                return
+            now = time.monotonic()
+            if now >= deadline:
+                events_url = f"/jobs/{job_id}/events?after={last_event_id}"
+                yield f"event: reconnect\ndata: {json.dumps({'events_url': events_url})}\n\n"
+                return
+            if now - last_sent >= SSE_KEEPALIVE_SECONDS:
+                yield ': keep-alive\n\n'
+                last_sent = now
+            time.sleep(SSE_POLL_SECONDS)
+
+    return Response(
+        stream_with_context(_stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route("/generate", methods=["POST"])
+@login_required
+def generate_report():
+    """Queue report generation for the latest upload and return its job ID immediately
+
+    Follow the job by polling its status_url and result_url, or, where event
+    streams are enabled, its events_url. The JSON body may set output_mode,
+    and stream_tokens to also publish 'token' events as reports are written.
+    """
+    user_id = session.get('user')
+    try:
+        upload = get_upload(user_id, columns=JOB_COLUMNS)
+        if not upload:
             return jsonify({
                 'success': False,
-                'message': f'Unexpected error: {str(e)}'
-            }), 500
-            
+                'message': 'No files found. Please upload an Excel file first.'
+            }), 400
+        return job_accepted_response(start_generation_job(user_id, upload, stream_tokens=requested_stream_tokens(),
+                                                         output_mode=requested_output_mode()))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except UploadInvalidError as e:
+        return jsonify({'success': False, 'message': str(e)}), 422
+    except JobActiveError as e:
+        return jsonify({'success': False, 'message': str(e), 'job_id': upload['id'], **job_links(upload['id'])}), 409
+    except JobError as e:
+        logger.error(f"Error queueing report generation: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 503
+
+@app.route("/uploads/<upload_id>/resume", methods=["POST"])
+@login_required
+def resume_report(upload_id):
+    """Queue a job generating only the students missing from an interrupted run"""
+    user_id = session.get('user')
+    try:
+        upload = get_upload(user_id, upload_id, columns=JOB_COLUMNS)
+        if not upload:
+            return jsonify({'success': False, 'message': 'Upload not found'}), 404
+        return job_accepted_response(start_generation_job(user_id, upload, stream_tokens=requested_stream_tokens(),
+                                                         output_mode=requested_output_mode()))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except UploadInvalidError as e:
+        return jsonify({'success': False, 'message': str(e)}), 422
+    except JobActiveError as e:
+        return jsonify({'success': False, 'message': str(e), 'job_id': upload['id'], **job_links(upload['id'])}), 409
+    except JobError as e:
+        logger.error(f"Error queueing report generation: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 503
+
+@app.route("/jobs/<job_id>")
+@login_required
+def get_job_status(job_id):
+    """Get the status and progress of a report generation job"""
+    user_id = session.get('user')
+    upload = get_upload(user_id, job_id, columns=JOB_COLUMNS)
+    if not upload:
+        return jsonify({'error': 'Job not found'}), 404
+    upload = recover_stale_job(upload)
+
+    body = {
+        'job_id': job_id,
+        'status': upload.get('status'),
+        'error': upload.get('error_message')
+    }
+    # Progress is shared by all workers, so it is reported whichever worker runs the job
+    progress = progress_store.get(job_id)
+    if progress:
+        body['progress'] = progress
+    return jsonify(body)
+
+@app.route("/jobs/<job_id>/result")
+@login_required
+def get_job_result(job_id):
+    """Get the result of a finished job; 202 while it is still running
+
+    A job that stopped heartbeating (its worker died) is reported as an error
+    with a resume_url, rather than answering 202 forever.
+    """
+    user_id = session.get('user')
+    upload = get_upload(user_id, job_id, columns=JOB_COLUMNS)
+    if not upload:
+        return jsonify({'error': 'Job not found'}), 404
+    upload = recover_stale_job(upload)
+
+    status = upload.get('status')
+    if status == 'completed' and upload.get('output_file_url'):
+        output_filename = output_filename_from_url(upload['output_file_url'])
+        return jsonify({
+            'success': True,
+            'message': 'Reports generated successfully!',
+            'filename': output_filename,
+            'download_url': f"/download/reports/{output_filename}"
+        })
+    if status == 'error':
+        return jsonify({
+            'success': False,
+            'message': upload.get('error_message') or 'Report generation failed',
+            'resume_url': f"/uploads/{job_id}/resume"
+        }), 500
+    if status == 'cancelled':
+        return jsonify({
+            'success': False,
+            'cancelled': True,
+            'message': 'Report generation was cancelled',
+            'resume_url': f"/uploads/{job_id}/resume"
+        }), 409
+    return jsonify({'job_id': job_id, 'status': status}), 202
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+@login_required
+def cancel_job(job_id):
+    """Cancel a queued or running job; reports already generated are kept for resuming"""
+    user_id = session.get('user')
+    upload = get_upload(user_id, job_id, columns=JOB_COLUMNS)
+    if not upload:
+        return jsonify({'error': 'Job not found'}), 404
+    if upload.get('status') not in ('queued', 'processing'):
+        return jsonify({'success': False, 'message': f"Job is not running (status: {upload.get('status')})"}), 409
+
+    # Also covers jobs whose worker has gone away; the running job sets this itself once it stops.
+    # Only a job that is still active is marked, so one finishing in the meantime keeps its status
+    result = supabase_admin.table('uploads').update({
+        'status': 'cancelled',
+        'error_message': None
+    }).eq('id', job_id).in_('status', ['queued', 'processing']).execute()
+    if not result.data:
+        upload = get_upload(user_id, job_id, columns=JOB_COLUMNS) or upload
+        return jsonify({'success': False, 'message': f"Job is not running (status: {upload.get('status')})"}), 409
+    job_runner.cancel(job_id)
+    logger.info(f"Cancellation requested for job {job_id} by user {user_id}")
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status': 'cancelled',
+        'resume_url': f"/uploads/{job_id}/resume"
+    }), 202
+
+@app.route("/jobs/<job_id>/events")
+@login_required
+def get_job_events(job_id):
+    """Server-Sent Events for a job, served by any worker
+
+    Emits 'report' events as students complete ('token' events too if the job
+    was started with stream_tokens), then a final 'done' or 'error' event
+    carrying the same body as /jobs/<job_id>/result. Streams are capped at
+    SSE_MAX_STREAM_SECONDS; resume with ?after=<last event id> or the
+    Last-Event-ID header. The job keeps running if the client disconnects.
+    """
+    if not SSE_ENABLED:
+        return jsonify({'error': 'Event streams are disabled on this server; poll /jobs/<job_id> instead'}), 404
+    upload = get_upload(session.get('user'), job_id, columns=JOB_COLUMNS)
+    if not upload:
+        return jsonify({'error': 'Job not found'}), 404
+    try:
+        after = max(int(request.headers.get('Last-Event-ID') or request.args.get('after', '0')), 0)
+    except ValueError:
+        return jsonify({'error': 'Event id must be an integer'}), 400
+    upload = recover_stale_job(upload)
+    follow = upload.get('status') in ('queued', 'processing')
+    if not follow and not progress_store.events_after(job_id, after):
+        return jsonify({'error': 'Job has no events to stream; fetch /jobs/<job_id>/result instead'}), 404
+    return sse_response(job_id, after=after, follow=follow)
+
+def stream_download(filename: str, user_id: str, mime_type: str) -> Response:
+    """Proxy a report from storage to the client in chunks, passing Range requests through"""
+    upstream = storage_service.open_stream(filename, user_id, request.headers.get('Range'))
+
+    def chunks():
+        try:
+            yield from upstream.iter_raw(DOWNLOAD_CHUNK_BYTES)
         finally:
-            # Ensure temporary files are cleaned up even if an error occurs
-            if temp_file_path and os.path.exists(temp_file_path):
-                try:
-                    os.remove(temp_file_path)
-                    logger.info(f"Cleaned up temporary file in finally block: {temp_file_path}")
-                except Exception as cleanup_error:
-                    logger.error(f"Error cleaning up temporary file in finally block: {str(cleanup_error)}", exc_info=True)
-            
-            if output_file_path and os.path.exists(output_file_path):
-                try:
-                    os.remove(output_file_path)
-                    logger.info(f"Cleaned up output file in finally block: {output_file_path}")
-                except Exception as cleanup_error:
-                    logger.error(f"Error cleaning up output file in finally block: {str(cleanup_error)}", exc_info=True)
+            upstream.close()
 
-    return asyncio.run(_generate())
+    response = Response(chunks(), status=upstream.status_code, mimetype=mime_type, direct_passthrough=True)
+    for header in ('Content-Length', 'Content-Range', 'Accept-Ranges', 'ETag', 'Last-Modified'):
+        if header in upstream.headers:
+            response.headers[header] = upstream.headers[header]
+    response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @app.route('/download/<path:filename>')
 @login_required
 def download_file(filename):
-    """Download a report file from storage (supports subdirectories)"""
+    """Download a report file from storage (supports subdirectories)
+
+    DOWNLOAD_MODE picks how the file reaches the client: from the shared
+    download cache, streamed through from storage without touching the disk,
+    or by redirecting to a short-lived signed storage URL so the file never
+    passes through this server. All three honour Range requests, so
+    interrupted downloads can resume.
+    """
     import os  # Ensure os is imported
-    async def _download():
-        try:
-            # Get the user ID from the session
-            user_id = session.get('user')
-            if not user_id:
-                return jsonify({"error": "User not authenticated"}), 401
+    try:
+        # Get the user ID from the session
+        user_id = session.get('user')
+        if not user_id:
+            return jsonify({"error": "User not authenticated"}), 401
 
-            # Always use only the base filename (no subdirectory)
-            base_filename = os.path.basename(filename)
+        # Always use only the base filename (no subdirectory)
+        base_filename = os.path.basename(filename)
 
-            # Download the file using the storage service (which uses uploads/<user_id>/reports/<filename>)
-            try:
-                download_path = await storage_service.download_file(
-                    filename=base_filename,
-                    bucket="uploads",
-                    user_id=user_id
-                )
-            except StorageError as e:
-                if "not found" in str(e):
-                    return jsonify({"error": "File not found"}), 404
-                elif "Invalid file type" in str(e):
-                    return jsonify({"error": str(e)}), 400
-                else:
-                    raise
-
-            # Get the correct MIME type based on file extension
-            mime_types = {
-                '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                '.pdf': 'application/pdf',
-                '.txt': 'text/plain'
-            }
-            file_ext = os.path.splitext(base_filename)[1].lower()
-            mime_type = mime_types.get(file_ext, 'application/octet-stream')
-
-            # Send the file to the user with proper headers
-            return send_file(
-                download_path,
-                as_attachment=True,
-                download_name=base_filename,
-                mimetype=mime_type
-            )
+        # Get the correct MIME type based on file extension
+        mime_types = {
+            '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+            '.zip': 'application/zip',
+            '.pdf': 'application/pdf',
+            '.txt': 'text/plain'
+        }
+        file_ext = os.path.splitext(base_filename)[1].lower()
+        mime_type = mime_types.get(file_ext, 'application/octet-stream')
 
+        # Files live at uploads/<user_id>/reports/<filename>
+        try:
+            if DOWNLOAD_MODE == 'redirect':
+                return redirect(event_loop.run(storage_service.create_signed_url(
+                    base_filename, user_id, DOWNLOAD_SIGNED_URL_TTL_SECONDS
+                )))
+            if DOWNLOAD_MODE == 'stream':
+                return stream_download(base_filename, user_id, mime_type)
+            download_path = event_loop.run(storage_service.download_file(
+                filename=base_filename,
+                bucket="uploads",
+                user_id=user_id
+            ))
         except StorageError as e:
-            logger.error(f"Storage error during download: {str(e)}")
-            return jsonify({"error": str(e)}), 500
-        except Exception as e:
-            logger.error(f"Error during file download: {str(e)}")
-            return jsonify({"error": "Failed to download file"}), 500
+            if "not found" in str(e):
+                return jsonify({"error": "File not found"}), 404
+            elif "Invalid file type" in str(e):
+                return jsonify({"error": str(e)}), 400
+            else:
+                raise
+
+        # Send the file to the user with proper headers; conditional=True answers Range and If-None-Match requests
+        return send_file(
+            download_path,
+            as_attachment=True,
+            download_name=base_filename,
+            mimetype=mime_type,
+            conditional=True
+        )
+
+    except RequestedRangeNotSatisfiable:
+        # Flask answers 416 for a Range past the end of the file
+        raise
+    except StorageError as e:
+        logger.error(f"Storage error during download: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+    except Exception as e:
+        logger.error(f"Error during file download: {str(e)}")
+        return jsonify({"error": "Failed to download file"}), 500
 
-    return asyncio.run(_download())
+@app.route('/uploads/<upload_id>/document')
+@login_required
+def render_upload_document(upload_id):
+    """Render an upload's stored reports on demand
+
+    ?format= is one of docx (one document, the default), per_student or
+    per_class (a zip of documents), txt or html. Renders come from the stored
+    report text, so a new format or layout never needs another LLM run, and
+    recently rendered documents are served from report_renderer's cache.
+    """
+    user_id = session.get('user')
+    fmt = request.args.get('format', 'docx')
+    if fmt not in RENDER_FORMATS:
+        return jsonify({'error': f"Unknown format '{fmt}'. Choose one of: {', '.join(RENDER_FORMATS)}"}), 400
+    try:
+        upload = get_upload(user_id, upload_id, columns='id, student_rows')
+        if not upload:
+            return jsonify({'error': 'Upload not found'}), 404
+        reports, students = event_loop.run(load_report_set(upload))
+        if not reports:
+            return jsonify({'error': 'No reports have been generated for this upload'}), 404
+
+        data = report_renderer.render(reports, students, fmt)
+        extension, mime_type = RENDER_FORMATS[fmt]
+        return send_file(
+            io.BytesIO(data),
+            as_attachment=fmt not in ('txt', 'html'),
+            download_name=f"student_reports_{upload_id}{extension}",
+            mimetype=mime_type
+        )
+    except (CheckpointError, ReportRenderError) as e:
+        logger.error(f"Error rendering reports for upload {upload_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/reports')
 @login_required
@@ -549,13 +1194,14 @@ def list_reports():
             # If we have a completed report with an output URL
             if output_url and isinstance(output_url, str) and output_url.strip():
                 try:
-                    filename = output_url.split('/')[-1]
+                    filename = output_filename_from_url(output_url)
                     logger.debug(f"Adding report with filename: {filename}")
                     reports.append({
                         'id': upload['id'],
                         'filename': filename,
                         'created_at': upload['created_at'],
-                        'download_url': f"/download/{filename}"
+                        'download_url': f"/download/{filename}",
+                        'document_url': f"/uploads/{upload['id']}/document"
                     })
                 except Exception as e:
                     logger.warning(f"Error processing output URL for upload {upload['id']}: {str(e)}")
@@ -579,94 +1225,75 @@ def view_reports():
 @login_required
 def delete_report(report_id):
     """Delete a specific report"""
-    async def _delete():
-        try:
-            # Get the user ID from the session
-            user_id = session.get('user')
-            if not user_id:
-                return jsonify({"error": "User not authenticated"}), 401
-
-            # First, get the report details to verify ownership and get the file URL
-            logger.debug(f"Attempting to delete report {report_id} for user {user_id}")
-            result = supabase.table('uploads').select('*').eq('id', report_id).eq('user_id', user_id).execute()
-            
-            if not result.data:
-                logger.warning(f"Report {report_id} not found for user {user_id}")
-                return jsonify({"error": "Report not found"}), 404
-            
-            report = result.data[0]
-            output_url = report.get('output_file_url')
-            
-            # Delete the file from storage if it exists
-            if output_url:
-                try:
-                    filename = output_url.split('/')[-1]
-                    logger.debug(f"Attempting to delete file from storage: {filename}")
-                    # Use the storage service to delete the file
-                    await storage_service.delete_file(filename, user_id=user_id)
-                    logger.debug(f"Successfully deleted file from storage: {filename}")
-                except Exception as storage_error:
-                    logger.warning(f"Failed to delete file from storage: {str(storage_error)}")
-                    # Continue with database deletion even if storage deletion fails
-            
-            # Delete the record from the database
-            logger.debug(f"Deleting report record from database: {report_id}")
-            delete_result = supabase.table('uploads').delete().eq('id', report_id).eq('user_id', user_id).execute()
-            
-            # Supabase delete operations return empty data array on success
-            # Check if there was no error rather than checking for data
-            logger.debug(f"Delete result: {delete_result}")
-            logger.debug(f"Successfully deleted report {report_id}")
-            return jsonify({"message": "Report deleted successfully"}), 200
-                
-        except Exception as e:
-            logger.error(f"Error deleting report {report_id}: {str(e)}", exc_info=True)
-            return jsonify({"error": "Internal server error"}), 500
+    try:
+        # Get the user ID from the session
+        user_id = session.get('user')
+        if not user_id:
+            return jsonify({"error": "User not authenticated"}), 401
 
-    return asyncio.run(_delete())
+        # First, get the report details to verify ownership and get the file URL
+        logger.debug(f"Attempting to delete report {report_id} for user {user_id}")
+        result = supabase.table('uploads').select('*').eq('id', report_id).eq('user_id', user_id).execute()
+        
+        if not result.data:
+            logger.warning(f"Report {report_id} not found for user {user_id}")
+            return jsonify({"error": "Report not found"}), 404
+        
+        report = result.data[0]
+        output_url = report.get('output_file_url')
+        
+        # Delete the file from storage if it exists
+        if output_url:
+            try:
+                filename = output_filename_from_url(output_url)
+                logger.debug(f"Attempting to delete file from storage: {filename}")
+                # Use the storage service to delete the file
+                storage_service.forget_cached_report(filename, user_id)
+                event_loop.run(storage_service.delete_file(filename, user_id=user_id))
+                logger.debug(f"Successfully deleted file from storage: {filename}")
+            except Exception as storage_error:
+                logger.warning(f"Failed to delete file from storage: {str(storage_error)}")
+                # Continue with database deletion even if storage deletion fails
+        
+        # Delete the record from the database
+        logger.debug(f"Deleting report record from database: {report_id}")
+        delete_result = supabase.table('uploads').delete().eq('id', report_id).eq('user_id', user_id).execute()
+        
+        # Supabase delete operations return empty data array on success
+        # Check if there was no error rather than checking for data
+        logger.debug(f"Delete result: {delete_result}")
+        logger.debug(f"Successfully deleted report {report_id}")
+        return jsonify({"message": "Report deleted successfully"}), 200
+            
+    except Exception as e:
+        logger.error(f"Error deleting report {report_id}: {str(e)}", exc_info=True)
+        return jsonify({"error": "Internal server error"}), 500
 
 @app.route('/static/download_handler.js')
 def serve_download_handler():
     """Serve the download handler JavaScript file"""
     return send_file('templates/download_handler.js', mimetype='application/javascript')
 
-async def download_from_storage(storage_path: str, user_id: str = None) -> str:
+async def download_from_storage(storage_path: str, user_id: str = None) -> SpooledBuffer:
     """
-    Download a file from Supabase Storage to a temporary location
+    Download a file from Supabase Storage into a buffer
     
     Args:
         storage_path: The path of the file in Supabase Storage
         user_id: Optional user ID for logging purposes
         
     Returns:
-        str: Path to the downloaded temporary file
+        SpooledBuffer: The file's contents, positioned at the start; the caller must close it
         
     Raises:
         Exception: If download fails or file is not found
     """
     try:
-        # Create a temporary directory for downloads if it doesn't exist
-        temp_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'temp')
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # Download the file
         logger.debug(f"Downloading file from storage: {storage_path}")
-        response = supabase.storage.from_('uploads').download(storage_path)
+        response = await storage_service.download_object(storage_path, bucket='uploads')
         if not response:
             raise Exception("Failed to download file from storage")
-        
-        # Save to temporary file
-        temp_file_path = os.path.join(temp_dir, os.path.basename(storage_path))
-        with open(temp_file_path, 'wb') as f:
-            f.write(response)
-        
-        logger.debug(f"Downloaded file to: {temp_file_path}")
-        
-        # Verify file exists
-        if not os.path.exists(temp_file_path):
-            raise Exception(f"File not found at path: {temp_file_path}")
-            
-        return temp_file_path
+        return SpooledBuffer.from_bytes(response, suffix=os.path.splitext(storage_path)[1])
         
     except Exception as e:
         logger.error(f"Error downloading file from storage: {str(e)}")
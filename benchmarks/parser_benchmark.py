@@ -0,0 +1,236 @@
+"""
+Benchmark student workbook parsing
+
+Generates synthetic student workbooks (10 to 20,000 rows, with long free-text
+fields like a real sample report), then times and memory-profiles each parser
+on them and writes the results as JSON so runs can be compared over time.
+
+Every workbook size is generated twice: a plain one, and an "inflated" one
+where formatting on a far-away row pushes the sheet's max_row well past the
+data, as often happens with sheets exported from school systems.
+
+Usage:
+    python -m benchmarks.parser_benchmark
+    python -m benchmarks.parser_benchmark --sizes 10 1000 --repeat 5 --output results.json
+    python -m benchmarks.parser_benchmark --parsers streaming pandas_count
+"""
+import os
+import sys
+import gc
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+import logging
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.excel_parser import (  # noqa: E402
+    EXPECTED_HEADERS, read_student_data_from_excel, validate_student_sheet, validate_student_workbook
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = [10, 100, 1000, 5000, 20000]
+
+# Rows the inflated variant's stray formatting sits past the last student
+INFLATED_EXTRA_ROWS = 50000
+
+WORDS = (
+    "consistently demonstrates enthusiasm respectful collaborative diligent curious thoughtful "
+    "assessment participation improvement mathematics english science history geography "
+    "swimming athletics debating choir leadership resilience organised creative effort homework "
+    "class discussion wellbeing friendships responsibility goals semester progress excellent"
+).split()
+
+def _text(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+def generate_workbook(path: str, rows: int, inflated: bool = False, seed: int = 0) -> None:
+    """
+    Write a synthetic student workbook to path
+
+    Args:
+        path: Where to save the .xlsx file
+        rows: Number of student rows
+        inflated: Add a formatted but empty cell far below the data, inflating max_row
+        seed: Random seed, so the same arguments always produce the same workbook
+    """
+    rng = random.Random(seed + rows)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet('Sheet1')
+    sheet.append(list(EXPECTED_HEADERS))
+
+    # One sample report per class, repeated on every row as teachers do
+    sample_report = _text(rng, 250)
+    for i in range(rows):
+        sheet.append([
+            f"Student {i + 1}",
+            rng.choice([7, 8, 9, 10, 11, 12]),
+            rng.choice(['Male', 'Female', 'M', 'F', 'Other']),
+            ', '.join(rng.sample(WORDS, 3)),
+            _text(rng, rng.randint(40, 120)),
+            _text(rng, rng.randint(20, 60)),
+            _text(rng, rng.randint(5, 30)),
+            sample_report
+        ])
+
+    if inflated:
+        for _ in range(INFLATED_EXTRA_ROWS - 1):
+            sheet.append([])
+        cell = WriteOnlyCell(sheet, value=None)
+        cell.number_format = '0.00'
+        sheet.append([cell])
+
+    workbook.save(path)
+
+def legacy_full_load(file_path: str) -> int:
+    """The original parser: full workbook load, then sheet.cell() for every row up to max_row"""
+    workbook = openpyxl.load_workbook(file_path)
+    sheet = workbook['Sheet1']
+    headers = [str(cell.value).strip() if cell.value else '' for cell in sheet[1]]
+    count = 0
+    for row in range(2, sheet.max_row + 1):
+        values = [sheet.cell(row=row, column=col).value for col in range(1, len(headers) + 1)]
+        if any(value is not None for value in values):
+            count += 1
+    return count
+
+def pandas_count(file_path: str) -> int:
+    """The row count /upload used to take with pd.read_excel"""
+    import pandas as pd
+    return len(pd.read_excel(file_path))
+
+def streaming(file_path: str) -> int:
+    return len(read_student_data_from_excel(file_path))
+
+def streaming_with_report(file_path: str) -> int:
+    students, _ = validate_student_sheet(file_path)
+    return len(students)
+
+def workbook_all_sheets(file_path: str) -> int:
+    students, _ = validate_student_workbook(file_path)
+    return len(students)
+
+PARSERS: Dict[str, Callable[[str], int]] = {
+    'legacy_full_load': legacy_full_load,
+    'pandas_count': pandas_count,
+    'streaming': streaming,
+    'streaming_with_report': streaming_with_report,
+    'workbook_all_sheets': workbook_all_sheets
+}
+
+def measure(parser: Callable[[str], int], file_path: str, repeat: int) -> Dict[str, Any]:
+    """Time a parser over several runs, then trace its peak Python heap usage in one more"""
+    timings = []
+    rows = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        rows = parser(file_path)
+        timings.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        parser(file_path)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'rows': rows,
+        'seconds_min': min(timings),
+        'seconds_median': statistics.median(timings),
+        'seconds_max': max(timings),
+        'peak_memory_bytes': peak
+    }
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _version(module_name: str) -> Optional[str]:
+    try:
+        return __import__(module_name).__version__
+    except ImportError:
+        return None
+
+def run(sizes: List[int], parsers: List[str], repeat: int, workdir: str) -> Dict[str, Any]:
+    """Generate any missing workbooks in workdir and benchmark every parser on each"""
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    for rows in sizes:
+        for inflated in (False, True):
+            path = os.path.join(workdir, f"students_{rows}{'_inflated' if inflated else ''}.xlsx")
+            if not os.path.exists(path):
+                logger.info(f"Generating {path}")
+                generate_workbook(path, rows, inflated=inflated)
+            for name in parsers:
+                logger.info(f"Benchmarking {name} on {os.path.basename(path)}")
+                result = measure(PARSERS[name], path, repeat)
+                results.append({
+                    'parser': name,
+                    'rows': rows,
+                    'inflated': inflated,
+                    'file_bytes': os.path.getsize(path),
+                    **{key: value for key, value in result.items() if key != 'rows'},
+                    'rows_parsed': result['rows']
+                })
+                logger.info(f"  {result['seconds_median']:.3f}s median, {result['peak_memory_bytes'] / 1e6:.1f}MB peak")
+
+    return {
+        'benchmark': 'parser',
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'git_commit': _git_commit(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'openpyxl': openpyxl.__version__,
+            'pandas': _version('pandas')
+        },
+        'repeat': repeat,
+        'results': results
+    }
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Student rows per workbook')
+    parser.add_argument('--parsers', nargs='+', choices=sorted(PARSERS), default=sorted(PARSERS))
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per parser and workbook')
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'batch_report_parser_benchmark'),
+                        help='Where generated workbooks are kept between runs')
+    parser.add_argument('--output', help='Write JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # Per-row warnings from the parsers would swamp the benchmark output
+    logging.getLogger('utils.excel_parser').setLevel(logging.ERROR)
+
+    report = run(args.sizes, args.parsers, args.repeat, args.workdir)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        logger.info(f"Wrote results to {args.output}")
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
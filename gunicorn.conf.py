@@ -1,4 +1,5 @@
 # Gunicorn configuration file
+import os
 import multiprocessing
 
 # Server socket
@@ -7,7 +8,10 @@ backlog = 2048
 
 # Worker processes
 workers = 2
-worker_class = "sync"
+# Threaded workers keep heartbeating while long requests (SSE streams, downloads)
+# run in their own threads; async coroutines run on one long-lived loop per worker
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
 worker_connections = 1000
 max_requests = 1000
 max_requests_jitter = 100
@@ -0,0 +1,85 @@
+"""Message Batch generation against the local FakeBatchServer"""
+import time
+import asyncio
+import pytest
+from utils.batch_backend import MessageBatchBackend
+from utils.fake_batch_server import FakeBatchServer
+from utils.progress_store import MemoryProgressStore
+from utils.report_generator import ReportGenerationService
+
+def make_students(count):
+    return [{
+        'student_name': f'Student {i}',
+        'year': 7,
+        'gender': 'female',
+        'adjectives': 'diligent',
+        'academic_performance': 'Strong',
+        'extracurricular_activities': 'Choir',
+        'other': 'None',
+        'sample_report': 'Sample report'
+    } for i in range(count)]
+
+@pytest.fixture
+def start_server():
+    servers = []
+
+    def start(**kwargs):
+        server = FakeBatchServer(**kwargs).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+def make_service(monkeypatch, server):
+    monkeypatch.setenv('ANTHROPIC_API_KEY', 'test')
+    backend = MessageBatchBackend(api_key='test', model='claude-test', temperature=0.4, max_tokens=256,
+                                  base_url=server.url, poll_interval=0.05, max_poll_interval=0.05)
+    return ReportGenerationService(cache=None, batch_threshold=1, batch_backend=backend)
+
+def run_batch(service, students, deadline=None):
+    progress = MemoryProgressStore()
+    checkpoints = {}
+
+    async def on_checkpoint(index, name, report):
+        checkpoints[index] = report
+
+    reports = asyncio.run(service._generate_reports_in_batch(students, 'job-1', progress, deadline=deadline,
+                                                            on_checkpoint=on_checkpoint))
+    return reports, checkpoints, progress.get('job-1')
+
+def test_batch_completes(monkeypatch, start_server):
+    def responder(params):
+        content = params['messages'][-1]['content']
+        if 'Student 2' in content:
+            raise ValueError('prompt rejected')
+        return f"Report: {content.splitlines()[0]}"
+
+    server = start_server(responder=responder, polls_until_ended=2)
+    reports, checkpoints, progress = run_batch(make_service(monkeypatch, server), make_students(4))
+
+    assert reports[0] == 'Report: Write a report for Student 0.'
+    assert reports[3] == 'Report: Write a report for Student 3.'
+    assert reports[2].startswith('Report generation failed for Student 2') and 'prompt rejected' in reports[2]
+    assert sorted(checkpoints) == [0, 1, 3]
+    assert progress['current'] == 4
+    assert progress['status'] == 'Processed 4/4 (some errors)'
+
+def test_batch_timeout_keeps_finished_reports(monkeypatch, start_server):
+    # One request finishes per poll and the batch never ends on its own, so the budget runs out part way
+    server = start_server(polls_until_ended=1000, requests_per_poll=1)
+    students = make_students(20)
+    reports, checkpoints, progress = run_batch(make_service(monkeypatch, server), students,
+                                               deadline=time.monotonic() + 0.5)
+
+    finished = [i for i, report in enumerate(reports) if not report.startswith('Report generation failed')]
+    assert 0 < len(finished) < len(students)
+    assert sorted(checkpoints) == finished
+    for i in finished:
+        assert reports[i].startswith('Fake report for prompt:')
+    for i in set(range(len(students))) - set(finished):
+        assert 'did not finish within' in reports[i]
+    batch = next(iter(server.batches.values()))
+    assert batch['status'] == 'ended'
+    assert progress['current'] == len(students)
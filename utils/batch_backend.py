@@ -0,0 +1,147 @@
+import time
+import asyncio
+import logging
+from typing import Dict, Callable, Optional, Any, Tuple
+import anthropic
+
+logger = logging.getLogger(__name__)
+
+class BatchGenerationError(Exception):
+    """Base exception for Message Batch generation errors"""
+    pass
+
+class MessageBatchBackend:
+    """Generates reports through the Anthropic Message Batches API
+
+    All prompts are submitted as a single batch, which is polled until it
+    ends. Results are matched back to their prompts by ``custom_id``. A
+    batch still running at its timeout is cancelled, and the requests that
+    had already succeeded are still returned.
+    """
+
+    def __init__(self, api_key: str, model: str, temperature: float, max_tokens: int,
+                 base_url: Optional[str] = None, poll_interval: float = 5.0,
+                 max_poll_interval: float = 30.0, timeout: float = 3600.0,
+                 cancel_grace_seconds: float = 60.0):
+        self.client = anthropic.AsyncAnthropic(api_key=api_key, base_url=base_url)
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.cancel_grace_seconds = cancel_grace_seconds
+
+    def _build_request(self, custom_id: str, system_prompt: str, student_prompt: str) -> Dict[str, Any]:
+        return {
+            'custom_id': custom_id,
+            'params': {
+                'model': self.model,
+                'max_tokens': self.max_tokens,
+                'temperature': self.temperature,
+                'system': [{'type': 'text', 'text': system_prompt, 'cache_control': {'type': 'ephemeral'}}],
+                'messages': [{'role': 'user', 'content': student_prompt}]
+            }
+        }
+
+    async def _cancel_and_wait(self, batch: Any) -> Any:
+        """Cancel a batch and poll for up to cancel_grace_seconds until it has ended
+
+        Cancellation is asynchronous: requests already being processed may
+        still finish, and results can only be read once the batch has ended.
+        """
+        batch = await self.client.messages.batches.cancel(batch.id)
+        grace_deadline = time.monotonic() + self.cancel_grace_seconds
+        while batch.processing_status != 'ended' and time.monotonic() < grace_deadline:
+            await asyncio.sleep(min(self.poll_interval, max(0.0, grace_deadline - time.monotonic())))
+            batch = await self.client.messages.batches.retrieve(batch.id)
+        return batch
+
+    async def _read_results(self, batch_id: str) -> Dict[str, Dict[str, Any]]:
+        results = {}
+        async for entry in await self.client.messages.batches.results(batch_id):
+            if entry.result.type == 'succeeded':
+                text = ''.join(block.text for block in entry.result.message.content if block.type == 'text')
+                results[entry.custom_id] = {'report': text, 'usage': entry.result.message.usage.model_dump()}
+            elif entry.result.type == 'errored':
+                results[entry.custom_id] = {'error': entry.result.error.error.message}
+            else:
+                results[entry.custom_id] = {'error': f"Request {entry.result.type}"}
+        return results
+
+    async def _partial_results(self, batch: Any, prompts: Dict[str, Tuple[str, str]],
+                               reason: str) -> Dict[str, Dict[str, Any]]:
+        """Cancel a timed-out batch and keep the reports that succeeded before it stopped"""
+        results = {}
+        try:
+            batch = await self._cancel_and_wait(batch)
+            if batch.processing_status == 'ended':
+                results = await self._read_results(batch.id)
+            else:
+                logger.warning(f"Message batch {batch.id} did not end within {self.cancel_grace_seconds:.0f}s of cancelling")
+        except Exception as e:
+            logger.warning(f"Failed to read results of cancelled message batch {batch.id}: {str(e)}")
+        for custom_id in prompts:
+            if 'report' not in results.get(custom_id, {}):
+                results[custom_id] = {'error': reason}
+        succeeded = sum(1 for result in results.values() if 'report' in result)
+        logger.info(f"Message batch {batch.id} timed out with {succeeded}/{len(prompts)} reports")
+        return results
+
+    async def generate(self, prompts: Dict[str, Tuple[str, str]],
+                       on_poll: Optional[Callable[[Any], None]] = None,
+                       timeout: Optional[float] = None) -> Dict[str, Dict[str, Any]]:
+        """Run a batch of prompts keyed by custom id
+
+        If the batch hasn't ended within the timeout it is cancelled. Requests
+        that succeeded before the cancel keep their reports; every other
+        request gets an error entry, so callers can fill in placeholders.
+
+        Args:
+            prompts: Mapping of custom id to (system prompt, student prompt)
+            on_poll: Optional callback receiving the batch's request_counts after each poll
+            timeout: Seconds to wait for the batch before cancelling it (defaults to self.timeout)
+
+        Returns:
+            Dict[str, Dict[str, Any]]: Mapping of custom id to either {'report': text, 'usage': token usage}
+            or {'error': reason}
+
+        Raises:
+            BatchGenerationError: If the batch cannot be created, or results of a finished batch cannot be read
+        """
+        try:
+            batch = await self.client.messages.batches.create(
+                requests=[self._build_request(custom_id, *prompt) for custom_id, prompt in prompts.items()]
+            )
+            logger.info(f"Submitted message batch {batch.id} with {len(prompts)} requests")
+        except Exception as e:
+            raise BatchGenerationError(f"Failed to create message batch: {str(e)}")
+
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        deadline = time.monotonic() + timeout
+        interval = self.poll_interval
+        try:
+            while batch.processing_status != 'ended':
+                if time.monotonic() >= deadline:
+                    logger.warning(f"Message batch {batch.id} did not finish within {timeout:.0f}s; cancelling it")
+                    return await self._partial_results(batch, prompts, f"Message batch did not finish within {timeout:.0f}s")
+                await asyncio.sleep(min(interval, max(0.0, deadline - time.monotonic())))
+                interval = min(self.max_poll_interval, interval * 1.5)
+                batch = await self.client.messages.batches.retrieve(batch.id)
+                logger.debug(f"Message batch {batch.id} status: {batch.processing_status}, counts: {batch.request_counts}")
+                if on_poll:
+                    on_poll(batch.request_counts)
+
+            results = await self._read_results(batch.id)
+            logger.info(f"Message batch {batch.id} ended with {len(results)} results")
+            return results
+        except asyncio.CancelledError:
+            # The job was cancelled: stop the batch too so it doesn't keep spending tokens
+            try:
+                await self.client.messages.batches.cancel(batch.id)
+                logger.info(f"Cancelled message batch {batch.id}")
+            except Exception as e:
+                logger.warning(f"Failed to cancel message batch {batch.id}: {str(e)}")
+            raise
+        except Exception as e:
+            raise BatchGenerationError(f"Error processing message batch {batch.id}: {str(e)}")
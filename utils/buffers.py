@@ -0,0 +1,93 @@
+import io
+import os
+import tempfile
+import logging
+from typing import Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# Buffers larger than this move from memory to a temporary file
+SPILL_THRESHOLD_BYTES = int(os.getenv('BUFFER_SPILL_THRESHOLD_BYTES', str(16 * 1024 * 1024)))
+
+class SpooledBuffer:
+    """Binary file object held in memory until it grows past max_size
+
+    Uploaded workbooks and generated documents are passed around in these
+    instead of being written to fixed paths under uploads/ or /tmp/reports,
+    so small files never touch the disk and concurrent requests can't collide
+    on a filename. Once more than ``max_size`` bytes are written the contents
+    move to a uniquely named temporary file, removed again on ``close``.
+    Unlike tempfile.SpooledTemporaryFile the spilled file has a path, which
+    the storage client and worker processes can open themselves.
+
+    Supports the usual read/write/seek/tell file methods and use as a
+    context manager.
+    """
+
+    def __init__(self, max_size: int = SPILL_THRESHOLD_BYTES, suffix: str = ''):
+        self.max_size = max_size
+        self.suffix = suffix
+        self._file: Union[io.BytesIO, 'tempfile._TemporaryFileWrapper'] = io.BytesIO()
+        self._path: Optional[str] = None
+
+    @classmethod
+    def from_bytes(cls, data: bytes, max_size: int = SPILL_THRESHOLD_BYTES, suffix: str = '') -> 'SpooledBuffer':
+        """Buffer holding data, positioned at the start"""
+        buffer = cls(max_size, suffix)
+        buffer.write(data)
+        buffer.seek(0)
+        return buffer
+
+    @property
+    def spilled(self) -> bool:
+        return self._path is not None
+
+    @property
+    def path(self) -> Optional[str]:
+        """Path of the temporary file once spilled to disk, flushed so it can be opened elsewhere"""
+        if self._path:
+            self._file.flush()
+        return self._path
+
+    def write(self, data: bytes) -> int:
+        if self._path is None and self._file.tell() + len(data) > self.max_size:
+            self._spill()
+        return self._file.write(data)
+
+    def _spill(self) -> None:
+        spilled = tempfile.NamedTemporaryFile(suffix=self.suffix, delete=False)
+        spilled.write(self._file.getbuffer())
+        spilled.seek(self._file.tell())
+        logger.debug(f"Spilled {len(self._file.getbuffer())}-byte buffer to {spilled.name}")
+        self._file = spilled
+        self._path = spilled.name
+
+    def size(self) -> int:
+        """Number of bytes in the buffer"""
+        if self._path is None:
+            return len(self._file.getbuffer())
+        self._file.flush()
+        return os.path.getsize(self._path)
+
+    def payload(self) -> Union[bytes, str]:
+        """Contents for APIs that take bytes or a file path: the bytes while in memory, the path once spilled"""
+        return self.path or self._file.getvalue()
+
+    def close(self) -> None:
+        self._file.close()
+        if self._path:
+            try:
+                os.remove(self._path)
+            except FileNotFoundError:
+                pass
+            self._path = None
+
+    def __getattr__(self, name):
+        # read, seek, tell, flush, seekable, ... of the underlying file
+        return getattr(self._file, name)
+
+    def __enter__(self) -> 'SpooledBuffer':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Any
+from supabase_config import supabase_admin
+
+logger = logging.getLogger(__name__)
+
+class CheckpointError(Exception):
+    """Base exception for report checkpoint operations"""
+    pass
+
+class CheckpointStore:
+    """Persists each student's finished report against its uploads row
+
+    Rows live in the report_checkpoints table (see
+    .cursor/tasks/report_checkpoints.sql), keyed on (upload_id, student_index),
+    so a run interrupted by a worker restart can be resumed by generating
+    only the students that have no checkpoint yet. They are also the stored
+    report text that documents are rendered from on demand.
+    """
+
+    def __init__(self, supabase_client):
+        self.supabase = supabase_client
+
+    async def save(self, upload_id: str, student_index: int, student_name: str, report: str) -> None:
+        """Store a completed report for one student"""
+        def _save():
+            self.supabase.table('report_checkpoints').upsert({
+                'upload_id': upload_id,
+                'student_index': student_index,
+                'student_name': student_name,
+                'report': report,
+                'created_at': datetime.utcnow().isoformat()
+            }, on_conflict='upload_id,student_index').execute()
+
+        try:
+            await asyncio.to_thread(_save)
+            logger.debug(f"Saved checkpoint for student {student_index} of upload {upload_id}")
+        except Exception as e:
+            raise CheckpointError(f"Failed to save checkpoint for student {student_index} of upload {upload_id}: {str(e)}")
+
+    async def load(self, upload_id: str) -> Dict[int, Dict[str, Any]]:
+        """Return {student_index: {'student_name', 'report'}} for every checkpointed student"""
+        def _load():
+            return self.supabase.table('report_checkpoints').select(
+                'student_index, student_name, report'
+            ).eq('upload_id', upload_id).execute()
+
+        try:
+            result = await asyncio.to_thread(_load)
+            return {
+                row['student_index']: {'student_name': row['student_name'], 'report': row['report']}
+                for row in result.data or []
+            }
+        except Exception as e:
+            raise CheckpointError(f"Failed to load checkpoints for upload {upload_id}: {str(e)}")
+
+# Create a singleton instance
+checkpoint_store = CheckpointStore(supabase_admin)
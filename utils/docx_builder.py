@@ -0,0 +1,240 @@
+import io
+import os
+import re
+import asyncio
+import logging
+import zipfile
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, BinaryIO, Dict, List, Optional, Set, Tuple, Union
+from docx import Document
+from utils.buffers import SpooledBuffer
+
+logger = logging.getLogger(__name__)
+
+# 'single': one document for the whole upload; 'per_student' / 'per_class': a zip of documents
+OUTPUT_MODES = ('single', 'per_student', 'per_class')
+DEFAULT_OUTPUT_MODE = os.getenv('REPORT_OUTPUT_MODE', 'single')
+
+# Bundles with at least this many documents are rendered across processes
+PARALLEL_MIN_DOCS = int(os.getenv('DOCX_PARALLEL_MIN_DOCS', '20'))
+
+class DocxBuilderError(Exception):
+    """Base exception for Word document building errors"""
+    pass
+
+class IncrementalWordDoc:
+    """Word document assembled one report at a time while generation runs
+
+    ``add`` is called as each student's report completes (it is cheap and
+    safe to call from the event loop) and hands the report to a dedicated
+    single-thread executor, which appends the student's section to the
+    document. Sections are written in student order: a report that finishes
+    before an earlier student's waits until the gap is filled. By the time
+    the last report arrives nearly the whole document is built, so ``save``
+    only has to write it out. python-docx documents cannot be shared across
+    processes, hence a thread rather than a process executor.
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='docx-builder')
+        # Only touched from the executor thread
+        self._doc = None
+        self._pending: Dict[int, str] = {}
+        self._received: Set[int] = set()
+        self._next = 0
+        self._error: Optional[Exception] = None
+
+    def add(self, index: int, report: str) -> None:
+        """Queue a student's report (index into the student list) for appending"""
+        try:
+            self._executor.submit(self._add, index, report)
+        except RuntimeError:
+            logger.debug(f"Ignoring report {index} for a closed document")
+
+    def _add(self, index: int, report: str) -> None:
+        if self._error or index in self._received or not 0 <= index < self.total:
+            return
+        self._received.add(index)
+        self._pending[index] = report
+        try:
+            if self._doc is None:
+                self._doc = Document()
+            while self._next in self._pending:
+                if self._next:
+                    self._doc.add_page_break()
+                self._doc.add_heading(f"Student Report {self._next + 1}", level=1)
+                self._doc.add_paragraph(self._pending.pop(self._next))
+                self._next += 1
+        except Exception as e:
+            logger.error(f"Error adding report {index} to Word document: {str(e)}")
+            self._error = e
+
+    def _save(self) -> Tuple[str, SpooledBuffer]:
+        if self._error:
+            raise self._error
+        if self._next < self.total:
+            raise DocxBuilderError(f"Only {self._next}/{self.total} reports were added to the document")
+        filename = f"student_reports_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx"
+        buffer = SpooledBuffer(suffix='.docx')
+        try:
+            (self._doc or Document()).save(buffer)
+        except Exception:
+            buffer.close()
+            raise
+        buffer.seek(0)
+        logger.info(f"Successfully created Word document {filename} ({buffer.size()} bytes)")
+        return filename, buffer
+
+    async def save(self, reports: Optional[List[str]] = None) -> Tuple[str, SpooledBuffer]:
+        """
+        Finish the document and save it to a buffer
+
+        Args:
+            reports: The full, ordered report list; any report that never went
+                through ``add`` is appended from it first
+
+        Returns:
+            Tuple[str, SpooledBuffer]: Filename for the document and a buffer holding it,
+            which the caller must close
+
+        Raises:
+            DocxBuilderError: If the document could not be built or saved
+        """
+        if reports is not None:
+            for index, report in enumerate(reports):
+                self.add(index, report)
+        try:
+            return await asyncio.wrap_future(self._executor.submit(self._save))
+        except Exception as e:
+            logger.error(f"Error creating Word document: {str(e)}")
+            raise DocxBuilderError(f"Error creating Word document: {str(e)}")
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Stop the builder thread and discard queued work; safe to call more than once"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def render_word_doc(sections: List[Tuple[str, str]]) -> bytes:
+    """Render (heading, report) sections into a .docx, one section per page"""
+    doc = Document()
+    for i, (heading, report) in enumerate(sections):
+        if i:
+            doc.add_page_break()
+        doc.add_heading(heading, level=1)
+        doc.add_paragraph(report)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+def _safe_filename(name: str, used: Set[str]) -> str:
+    """A .docx filename for name that is safe inside a zip and unique among used"""
+    base = re.sub(r'[^\w\- ]+', '', name).strip().replace(' ', '_')[:100] or 'report'
+    filename = f"{base}.docx"
+    suffix = 2
+    while filename.lower() in used:
+        filename = f"{base}_{suffix}.docx"
+        suffix += 1
+    used.add(filename.lower())
+    return filename
+
+def plan_report_bundle(reports: List[str], students: List[Dict[str, Any]], mode: str) -> List[Tuple[str, List[Tuple[str, str]]]]:
+    """
+    Split reports into the documents of a bundle
+
+    Args:
+        reports: Reports in the same order as students
+        students: Student records; their student_name becomes each section's heading
+        mode: 'per_student' or 'per_class'
+
+    Returns:
+        List[Tuple[str, List[Tuple[str, str]]]]: (filename, [(heading, report), ...]) per document
+    """
+    if mode not in ('per_student', 'per_class'):
+        raise DocxBuilderError(f"Unknown bundle mode '{mode}'")
+
+    used: Set[str] = set()
+    sections = [
+        (student.get('student_name') or f"Student {i + 1}", report)
+        for i, (student, report) in enumerate(zip(students, reports))
+    ]
+    if mode == 'per_student':
+        return [(_safe_filename(heading, used), [(heading, report)]) for heading, report in sections]
+
+    classes: Dict[str, List[Tuple[str, str]]] = {}
+    for student, section in zip(students, sections):
+        classes.setdefault(student.get('class_name') or '', []).append(section)
+    return [(_safe_filename(class_name or 'student_reports', used), class_sections)
+            for class_name, class_sections in classes.items()]
+
+def write_report_bundle(target: Union[str, BinaryIO], reports: List[str], students: List[Dict[str, Any]], mode: str,
+                        max_workers: Optional[int] = None) -> int:
+    """
+    Render one .docx per student or per class into a zip written to target
+
+    Bundles of PARALLEL_MIN_DOCS documents or more are rendered across a
+    process pool, so rendering time scales with the number of cores. Each
+    document is written to the zip as soon as it is rendered, in order,
+    so the bundle is never held in memory as a whole.
+
+    Args:
+        target: Path or writable binary file for the zip
+        reports: Reports in the same order as students
+        students: Student records (student_name, class_name)
+        mode: 'per_student' or 'per_class'
+        max_workers: Processes to render with (default: the CPU count)
+
+    Returns:
+        int: Number of documents in the bundle
+    """
+    documents = plan_report_bundle(reports, students, mode)
+    filenames = [filename for filename, _ in documents]
+    contents = [sections for _, sections in documents]
+
+    # .docx files are already compressed, so store them as-is
+    with zipfile.ZipFile(target, 'w', compression=zipfile.ZIP_STORED) as bundle:
+        if len(documents) >= PARALLEL_MIN_DOCS:
+            workers = min(len(documents), max_workers or os.cpu_count() or 1)
+            logger.info(f"Rendering {len(documents)} documents across {workers} processes")
+            # spawn rather than fork: the web worker process has running threads
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                rendered = pool.map(render_word_doc, contents, chunksize=max(1, len(documents) // (workers * 4)))
+                for filename, data in zip(filenames, rendered):
+                    bundle.writestr(filename, data)
+        else:
+            for filename, sections in documents:
+                bundle.writestr(filename, render_word_doc(sections))
+    return len(documents)
+
+def render_report_bundle(reports: List[str], students: List[Dict[str, Any]], mode: str,
+                         max_workers: Optional[int] = None) -> Tuple[str, SpooledBuffer]:
+    """
+    Render one .docx per student or per class into a zip (see write_report_bundle)
+
+    Args:
+        reports: Reports in the same order as students
+        students: Student records (student_name, class_name)
+        mode: 'per_student' or 'per_class'
+        max_workers: Processes to render with (default: the CPU count)
+
+    Returns:
+        Tuple[str, SpooledBuffer]: Filename for the zip and a buffer holding it,
+        which the caller must close
+
+    Raises:
+        DocxBuilderError: If the bundle could not be rendered
+    """
+    filename = f"student_reports_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    buffer = SpooledBuffer(suffix='.zip')
+    try:
+        count = write_report_bundle(buffer, reports, students, mode, max_workers)
+    except Exception as e:
+        buffer.close()
+        logger.error(f"Error creating report bundle: {str(e)}")
+        raise DocxBuilderError(f"Error creating report bundle: {str(e)}")
+    buffer.seek(0)
+    logger.info(f"Successfully created {count}-document bundle {filename} ({buffer.size()} bytes)")
+    return filename, buffer
@@ -0,0 +1,242 @@
+import os
+import time
+import sqlite3
+import hashlib
+import tempfile
+import logging
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+class DownloadCacheError(Exception):
+    """Base exception for download cache operations"""
+    pass
+
+class DownloadCache:
+    """Size-bounded LRU cache of files downloaded from storage
+
+    Files are kept in ``directory`` under hashed names, with an index in a
+    SQLite file next to them, so every gunicorn worker on the instance shares
+    one cache. Files are written to a temporary name and renamed into place,
+    so a reader never sees a partial file. Each entry remembers the ETag and
+    Last-Modified it was downloaded with: entries validated within
+    ``fresh_seconds`` are served without contacting storage, older ones are
+    revalidated with a conditional request by the caller.
+
+    Once the cached files total more than ``max_bytes`` the least recently
+    used are deleted, except those used in the last ``min_evict_age_seconds``,
+    which may still be streaming to a client.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 512 * 1024 * 1024, fresh_seconds: int = 300,
+                 min_evict_age_seconds: int = 60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fresh_seconds = fresh_seconds
+        self.min_evict_age_seconds = min_evict_age_seconds
+        self.path = os.path.join(directory, 'index.sqlite3')
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with self._connect() as conn:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS files ('
+                    'key TEXT PRIMARY KEY, filename TEXT NOT NULL, size INTEGER NOT NULL, '
+                    'etag TEXT, last_modified TEXT, validated_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+                )
+                conn.execute('CREATE INDEX IF NOT EXISTS files_accessed_at_idx ON files(accessed_at)')
+                conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+                conn.executemany(
+                    'INSERT OR IGNORE INTO stats (name, value) VALUES (?, 0)',
+                    [('hits',), ('revalidated',), ('misses',), ('bytes_saved',)]
+                )
+        except (OSError, sqlite3.Error) as e:
+            raise DownloadCacheError(f"Failed to initialise download cache in {directory}: {str(e)}")
+
+    @contextmanager
+    def _connect(self, immediate: bool = False) -> Iterator[sqlite3.Connection]:
+        """Open a connection that commits on success and is always closed
+
+        With ``immediate`` the write lock is taken up front, so rows read in
+        the transaction can't be changed by another worker before it writes.
+        """
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                if immediate:
+                    conn.execute('BEGIN IMMEDIATE')
+                yield conn
+        finally:
+            conn.close()
+
+    def _file_path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Return the cached entry for key, marking it as recently used
+
+        Returns:
+            Optional[Dict[str, Any]]: path, size, etag, last_modified and fresh (True if it
+            can be served without revalidating), or None if key is not cached
+        """
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    'SELECT filename, size, etag, last_modified, validated_at FROM files WHERE key = ?', (key,)
+                ).fetchone()
+                if row:
+                    conn.execute('UPDATE files SET accessed_at = ? WHERE key = ?', (now, key))
+        except sqlite3.Error as e:
+            logger.warning(f"Download cache lookup failed for {key}: {str(e)}")
+            return None
+
+        if not row:
+            return None
+        path = self._file_path(row[0])
+        if not os.path.exists(path):
+            self.invalidate(key)
+            return None
+        return {
+            'path': path,
+            'size': row[1],
+            'etag': row[2],
+            'last_modified': row[3],
+            'fresh': now - row[4] < self.fresh_seconds
+        }
+
+    def store(self, key: str, content: bytes, etag: Optional[str] = None, last_modified: Optional[str] = None,
+              suffix: str = '') -> str:
+        """
+        Add or replace the file for key and evict least recently used files if over max_bytes
+
+        Returns:
+            str: Path of the cached file
+
+        Raises:
+            DownloadCacheError: If the file could not be written
+        """
+        # A new name per version: a worker still sending the old file keeps reading it intact
+        filename = f"{hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]}-{os.urandom(4).hex()}{suffix}"
+        path = self._file_path(filename)
+        now = time.time()
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.partial-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(temp_path, path)
+            with self._connect(immediate=True) as conn:
+                previous = conn.execute('SELECT filename FROM files WHERE key = ?', (key,)).fetchone()
+                conn.execute(
+                    'INSERT OR REPLACE INTO files (key, filename, size, etag, last_modified, validated_at, accessed_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (key, filename, len(content), etag, last_modified, now, now)
+                )
+            if previous:
+                self._remove_file(previous[0])
+        except (OSError, sqlite3.Error) as e:
+            for leftover in (temp_path, path):
+                if leftover and os.path.exists(leftover):
+                    os.remove(leftover)
+            raise DownloadCacheError(f"Failed to cache {key}: {str(e)}")
+
+        self._evict(now)
+        return path
+
+    def mark_validated(self, key: str) -> None:
+        """Record that storage confirmed the cached file for key is current"""
+        try:
+            with self._connect() as conn:
+                conn.execute('UPDATE files SET validated_at = ? WHERE key = ?', (time.time(), key))
+        except sqlite3.Error as e:
+            logger.warning(f"Download cache update failed for {key}: {str(e)}")
+
+    def invalidate(self, key: str) -> None:
+        """Drop key from the cache, if present"""
+        try:
+            with self._connect(immediate=True) as conn:
+                row = conn.execute('SELECT filename FROM files WHERE key = ?', (key,)).fetchone()
+                conn.execute('DELETE FROM files WHERE key = ?', (key,))
+            if row:
+                self._remove_file(row[0])
+        except sqlite3.Error as e:
+            logger.warning(f"Download cache invalidation failed for {key}: {str(e)}")
+
+    def record(self, outcome: str, bytes_saved: int = 0) -> None:
+        """Count a lookup outcome ('hits', 'revalidated' or 'misses') and the download bytes it saved"""
+        try:
+            with self._connect() as conn:
+                conn.execute('UPDATE stats SET value = value + 1 WHERE name = ?', (outcome,))
+                if bytes_saved:
+                    conn.execute("UPDATE stats SET value = value + ? WHERE name = 'bytes_saved'", (bytes_saved,))
+        except sqlite3.Error as e:
+            logger.warning(f"Download cache stats update failed: {str(e)}")
+
+    def _remove_file(self, filename: str) -> None:
+        try:
+            os.remove(self._file_path(filename))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to remove cached file {filename}: {str(e)}")
+
+    def _evict(self, now: float) -> None:
+        """Delete least recently used files until the cache fits in max_bytes"""
+        try:
+            with self._connect(immediate=True) as conn:
+                total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM files').fetchone()[0]
+                if total <= self.max_bytes:
+                    return
+                evicted = []
+                for key, filename, size in conn.execute(
+                    'SELECT key, filename, size FROM files WHERE accessed_at < ? ORDER BY accessed_at',
+                    (now - self.min_evict_age_seconds,)
+                ).fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append((key, filename))
+                    total -= size
+                conn.executemany('DELETE FROM files WHERE key = ?', [(key,) for key, _ in evicted])
+        except sqlite3.Error as e:
+            logger.warning(f"Download cache eviction failed: {str(e)}")
+            return
+
+        for _, filename in evicted:
+            self._remove_file(filename)
+        if evicted:
+            logger.debug(f"Evicted {len(evicted)} files from the download cache")
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters, bytes saved and current size, shared across all processes using the cache"""
+        try:
+            with self._connect() as conn:
+                counters = dict(conn.execute('SELECT name, value FROM stats').fetchall())
+                entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files').fetchone()
+        except sqlite3.Error as e:
+            raise DownloadCacheError(f"Failed to read download cache stats: {str(e)}")
+        lookups = counters.get('hits', 0) + counters.get('revalidated', 0) + counters.get('misses', 0)
+        return {
+            'hits': counters.get('hits', 0),
+            'revalidated': counters.get('revalidated', 0),
+            'misses': counters.get('misses', 0),
+            'hit_rate': round((lookups - counters.get('misses', 0)) / lookups, 4) if lookups else 0.0,
+            'bytes_saved': counters.get('bytes_saved', 0),
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes
+        }
+
+# Create a singleton instance (set DOWNLOAD_CACHE_ENABLED=false to disable)
+download_cache = None
+if os.getenv('DOWNLOAD_CACHE_ENABLED', 'true').lower() == 'true':
+    try:
+        download_cache = DownloadCache(
+            directory=os.getenv('DOWNLOAD_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'batch_report_downloads')),
+            max_bytes=int(os.getenv('DOWNLOAD_CACHE_MAX_BYTES', str(512 * 1024 * 1024))),
+            fresh_seconds=int(os.getenv('DOWNLOAD_CACHE_FRESH_SECONDS', '300'))
+        )
+    except DownloadCacheError as e:
+        logger.error(f"Download cache disabled: {str(e)}")
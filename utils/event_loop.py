@@ -0,0 +1,71 @@
+import os
+import asyncio
+import threading
+import logging
+from concurrent.futures import Future
+from typing import Awaitable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+class EventLoopThread:
+    """One long-lived asyncio event loop per worker process, run in a daemon thread
+
+    Sync Flask handlers and job threads hand their coroutines to this loop
+    instead of calling asyncio.run, which built and tore down a loop (and
+    every HTTP connection pool bound to it) on each request. Because every
+    coroutine runs on the same loop, the LLM and storage clients can be
+    created once per process and shared. The loop starts lazily and is
+    recreated after a fork, so gunicorn workers forked from a preloaded app
+    each get their own.
+
+    Coroutines run here share one thread: blocking calls inside them must
+    be offloaded with asyncio.to_thread.
+    """
+
+    def __init__(self, name: str = 'event-loop'):
+        self.name = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """The running loop for this process, started on first use"""
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def _run() -> None:
+                    asyncio.set_event_loop(loop)
+                    loop.call_soon(ready.set)
+                    loop.run_forever()
+
+                threading.Thread(target=_run, name=self.name, daemon=True).start()
+                ready.wait()
+                self._loop = loop
+                self._pid = os.getpid()
+                logger.info(f"Started shared event loop in process {self._pid}")
+            return self._loop
+
+    def submit(self, coro: Awaitable[T]) -> 'Future[T]':
+        """Schedule a coroutine on the loop and return a concurrent.futures.Future for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Awaitable[T], timeout: Optional[float] = None) -> T:
+        """Run a coroutine on the loop and block the calling thread until it finishes
+
+        Drop-in replacement for asyncio.run from sync code. Must not be called
+        from the loop's own thread.
+        """
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+# Create a singleton instance
+event_loop = EventLoopThread()
@@ -1,6 +1,11 @@
+import io
+import os
 import openpyxl
 import logging
-from typing import List, Dict, Any, Optional
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, time
+from typing import List, Dict, Any, Optional, Iterator, Tuple, Union, BinaryIO
 
 logger = logging.getLogger(__name__)
 
@@ -8,6 +13,38 @@ class ExcelParsingError(Exception):
     """Custom exception for Excel parsing errors"""
     pass
 
+def find_student_data_errors(student: Dict[str, Any]) -> List[Dict[str, str]]:
+    """
+    List every problem with a student record
+
+    Args:
+        student: Dictionary containing student data
+
+    Returns:
+        List[Dict[str, str]]: One {'field', 'reason'} per problem, using the sheet's
+        column names; empty if the record is valid
+    """
+    column_names = {normalized: expected for expected, normalized in EXPECTED_HEADERS.items()}
+    errors = []
+
+    # Check if all required fields exist and are not empty
+    for field in column_names:
+        if field not in student or not student[field]:
+            errors.append({'field': column_names[field], 'reason': 'Missing value'})
+
+    # Validate gender is one of the expected values
+    gender = student.get('gender')
+    if gender:
+        if not isinstance(gender, str):
+            errors.append({'field': column_names['gender'], 'reason': f"Gender must be text, got '{gender}'"})
+        elif gender.lower() not in VALID_GENDERS:
+            errors.append({
+                'field': column_names['gender'],
+                'reason': f"Invalid gender '{gender}'; use Male, Female or Other (or M, F, O)"
+            })
+
+    return errors
+
 def validate_student_data(student: Dict[str, Any]) -> bool:
     """
     Validate that a student record has all required fields and they are not empty
@@ -18,38 +55,287 @@ def validate_student_data(student: Dict[str, Any]) -> bool:
     Returns:
         bool: True if student data is valid, False otherwise
     """
-    required_fields = [
-        'student_name',
-        'year',
-        'gender',
-        'adjectives',
-        'academic_performance',
-        'extracurricular_activities',
-        'other',
-        'sample_report'
-    ]
-    
-    # Check if all required fields exist and are not empty
-    for field in required_fields:
-        if field not in student or not student[field]:
-            logger.warning(f"Missing or empty required field '{field}' for student {student.get('student_name', 'unknown')}")
-            return False
-            
-        
-    # Validate gender is one of the expected values
-    valid_genders = ['male', 'female', 'other', 'm', 'f', 'o', 'M', 'F', 'O']
-    if student['gender'].lower() not in valid_genders:
-        logger.warning(f"Invalid gender '{student['gender']}' for student {student['student_name']}")
-        return False
-        
-    return True
+    errors = find_student_data_errors(student)
+    for error in errors:
+        logger.warning(f"{error['reason']} in '{error['field']}' for student {student.get('student_name', 'unknown')}")
+    return not errors
+
+# Header text accepted for each field, matched case-insensitively against either form
+EXPECTED_HEADERS = {
+    'Student Name': 'student_name',
+    'Year': 'year',
+    'Gender': 'gender',
+    'Adjectives': 'adjectives',
+    'Academic Performance': 'academic_performance',
+    'Extracurricular Activities': 'extracurricular_activities',
+    'Other': 'other',
+    'Sample Report': 'sample_report'
+}
+
+# Accepted gender values, compared case-insensitively
+VALID_GENDERS = {'male', 'female', 'other', 'm', 'f', 'o'}
+
+# Workbooks at least this large with several student sheets are parsed one sheet per process
+PARALLEL_MIN_BYTES = int(os.getenv('EXCEL_PARALLEL_MIN_BYTES', str(5 * 1024 * 1024)))
+
+# Stop reading after this many consecutive empty rows; formatting often inflates a sheet's max_row
+DEFAULT_MAX_EMPTY_ROWS = 100
+
+def map_headers(headers: List[str]) -> Dict[int, str]:
+    """
+    Map column indexes to normalized field names using the header row
+
+    Raises:
+        ExcelParsingError: If any required header is missing
+    """
+    column_mapping = {}
+    for index, header in enumerate(headers):
+        for expected, normalized in EXPECTED_HEADERS.items():
+            if header.lower() == expected.lower() or header.lower() == normalized.lower():
+                column_mapping[index] = normalized
+                break
+
+    found = set(column_mapping.values())
+    missing_headers = {expected for expected, normalized in EXPECTED_HEADERS.items() if normalized not in found}
+    if missing_headers:
+        raise ExcelParsingError(f"Missing required headers: {missing_headers}")
+    return column_mapping
 
-def read_student_data_from_excel(file_path: str, sheet_name: str = "Sheet1") -> List[Dict[str, Any]]:
+def iter_student_data_from_excel(file_path: Union[str, BinaryIO], sheet_name: str = "Sheet1",
+                                 max_empty_rows: int = DEFAULT_MAX_EMPTY_ROWS,
+                                 issues: Optional[List[Dict[str, Any]]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Stream valid student records from an Excel file one row at a time
+
+    Opens the workbook in read-only mode and reads cell values row by row, so
+    memory stays flat however large the sheet is. Invalid rows are logged and
+    skipped, as in read_student_data_from_excel.
+
+    Args:
+        file_path: Path to the Excel file, or a binary file object holding it
+        sheet_name: Name of the sheet to read (default: "Sheet1")
+        max_empty_rows: Stop after this many consecutive empty rows
+        issues: Optional list that receives a {'row', 'field', 'reason'} entry for
+            each problem in a skipped row
+
+    Yields:
+        Dict[str, Any]: Each valid student record
+
+    Raises:
+        ExcelParsingError: If the file can't be opened or required headers are missing
+    """
+    try:
+        workbook = openpyxl.load_workbook(file_path, read_only=True)
+    except Exception as e:
+        raise ExcelParsingError(f"Failed to open Excel file: {str(e)}")
+
+    try:
+        if sheet_name not in workbook.sheetnames:
+            raise ExcelParsingError(f"Sheet '{sheet_name}' not found in workbook")
+        yield from _iter_sheet_students(workbook[sheet_name], max_empty_rows, issues)
+    finally:
+        workbook.close()
+
+def _iter_sheet_students(sheet, max_empty_rows: int = DEFAULT_MAX_EMPTY_ROWS,
+                         issues: Optional[List[Dict[str, Any]]] = None) -> Iterator[Dict[str, Any]]:
+    """iter_student_data_from_excel for a worksheet of an already open workbook"""
+    rows = sheet.iter_rows(values_only=True)
+    header_row = next(rows, None) or ()
+    headers = [str(value).strip() if value else '' for value in header_row]
+    column_mapping = map_headers(headers)
+
+    skipped_rows = []
+    empty_run = 0
+    for row_number, values in enumerate(rows, 2):
+        student = {
+            field: values[index] if index < len(values) else None
+            for index, field in column_mapping.items()
+        }
+
+        # Skip empty rows, and stop once a long run of them suggests the data has ended
+        if all(value is None for value in student.values()):
+            empty_run += 1
+            if empty_run >= max_empty_rows:
+                logger.debug(f"Stopping after {empty_run} consecutive empty rows at row {row_number}")
+                break
+            continue
+        empty_run = 0
+
+        try:
+            errors = find_student_data_errors(student)
+        except Exception as e:
+            logger.error(f"Error processing row {row_number}: {str(e)}")
+            errors = [{'field': None, 'reason': str(e)}]
+
+        if not errors:
+            logger.debug(f"Added valid student data for {student['student_name']}")
+            yield student
+        else:
+            skipped_rows.append(row_number)
+            logger.warning(f"Skipping invalid student data in row {row_number}: {errors}")
+            if issues is not None:
+                issues.extend({'row': row_number, **error} for error in errors)
+
+    if skipped_rows:
+        logger.warning(f"Skipped {len(skipped_rows)} rows due to invalid data: {skipped_rows}")
+
+def validate_student_sheet(file_path: Union[str, BinaryIO], sheet_name: str = "Sheet1") -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Read a student sheet and report every invalid row instead of skipping it silently
+
+    Args:
+        file_path: Path to the Excel file, or a binary file object holding it
+        sheet_name: Name of the sheet to read (default: "Sheet1")
+
+    Returns:
+        Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]: The valid student records, and one
+        {'row', 'field', 'reason'} entry per problem found (row numbers as shown in Excel)
+
+    Raises:
+        ExcelParsingError: If the file can't be opened or required headers are missing
+    """
+    issues: List[Dict[str, Any]] = []
+    students = list(iter_student_data_from_excel(file_path, sheet_name, issues=issues))
+    return _with_empty_sheet_issue(students, issues)
+
+def _with_empty_sheet_issue(students: List[Dict[str, Any]], issues: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    if not students and not issues:
+        issues.append({'row': None, 'field': None, 'reason': 'No student rows found in the sheet'})
+    return students, issues
+
+def find_student_sheets(file_path: Union[str, BinaryIO]) -> List[str]:
+    """
+    Names of the sheets whose header row has every required column, in workbook order
+
+    Raises:
+        ExcelParsingError: If the file can't be opened or no sheet has the required headers
+    """
+    workbook = _open_workbook(file_path)
+    try:
+        return [sheet.title for sheet in _student_sheets(workbook)]
+    finally:
+        workbook.close()
+
+def _open_workbook(file_path: Union[str, BinaryIO]):
+    try:
+        return openpyxl.load_workbook(file_path, read_only=True)
+    except Exception as e:
+        raise ExcelParsingError(f"Failed to open Excel file: {str(e)}")
+
+def _student_sheets(workbook) -> list:
+    """find_student_sheets for an open workbook, returning the worksheets themselves"""
+    sheets = []
+    first_error = None
+    for sheet in workbook.worksheets:
+        header_row = next(sheet.iter_rows(max_row=1, values_only=True), None) or ()
+        try:
+            map_headers([str(value).strip() if value else '' for value in header_row])
+            sheets.append(sheet)
+        except ExcelParsingError as e:
+            logger.debug(f"Skipping sheet '{sheet.title}': {str(e)}")
+            first_error = first_error or e
+
+    if not sheets:
+        # With a single sheet, its own missing-header error is the most useful message
+        if len(workbook.sheetnames) == 1 and first_error:
+            raise first_error
+        raise ExcelParsingError(f"No sheet has the required headers: {set(EXPECTED_HEADERS)}")
+    return sheets
+
+def _validate_class_sheet(file_path: Union[str, bytes, BinaryIO], sheet_name: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """validate_student_sheet for one class, tagging students and problems with the sheet name"""
+    if isinstance(file_path, bytes):
+        file_path = io.BytesIO(file_path)
+    return _tag_class(validate_student_sheet(file_path, sheet_name), sheet_name)
+
+def _validate_class_worksheet(sheet) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """_validate_class_sheet for a worksheet of an already open workbook"""
+    issues: List[Dict[str, Any]] = []
+    students = list(_iter_sheet_students(sheet, issues=issues))
+    return _tag_class(_with_empty_sheet_issue(students, issues), sheet.title)
+
+def _tag_class(result: Tuple[List[Dict[str, Any]], List[Dict[str, Any]]], sheet_name: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    students, issues = result
+    for student in students:
+        student['class_name'] = sheet_name
+    for issue in issues:
+        issue['sheet'] = sheet_name
+    return students, issues
+
+def _source_size(file_path: Union[str, BinaryIO]) -> int:
+    if isinstance(file_path, str):
+        return os.path.getsize(file_path)
+    position = file_path.tell()
+    size = file_path.seek(0, os.SEEK_END)
+    file_path.seek(position)
+    return size
+
+def _portable_source(file_path: Union[str, BinaryIO]) -> Union[str, bytes]:
+    """The workbook in a form that can be sent to worker processes: its path, or its bytes"""
+    if isinstance(file_path, str):
+        return file_path
+    # SpooledBuffer that has spilled to disk
+    path = getattr(file_path, 'path', None)
+    if isinstance(path, str):
+        return path
+    file_path.seek(0)
+    return file_path.read()
+
+def validate_student_workbook(file_path: Union[str, BinaryIO], max_workers: Optional[int] = None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Read every student sheet in a workbook, one class per sheet
+
+    Each student record gets a ``class_name`` set to its sheet's name, and each
+    problem a ``sheet``. The workbook is opened once and each sheet read from
+    it; only workbooks larger than PARALLEL_MIN_BYTES with several student
+    sheets are reopened, one sheet per process.
+
+    Args:
+        file_path: Path to the Excel file, or a binary file object holding it
+        max_workers: Processes to use for large workbooks (default: one per sheet, up to the CPU count)
+
+    Returns:
+        Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]: The valid student records of all
+        classes, in workbook order, and every problem found
+
+    Raises:
+        ExcelParsingError: If the file can't be opened or no sheet has the required headers
+    """
+    workbook = _open_workbook(file_path)
+    try:
+        sheets = _student_sheets(workbook)
+        sheet_names = [sheet.title for sheet in sheets]
+        logger.info(f"Found {len(sheet_names)} student sheet(s) in {file_path}: {sheet_names}")
+        parallel = len(sheets) > 1 and _source_size(file_path) >= PARALLEL_MIN_BYTES
+        results = None if parallel else [_validate_class_worksheet(sheet) for sheet in sheets]
+    finally:
+        workbook.close()
+
+    if parallel:
+        workers = min(len(sheet_names), max_workers or os.cpu_count() or 1)
+        logger.info(f"Parsing {len(sheet_names)} sheets across {workers} processes")
+        source = _portable_source(file_path)
+        # spawn rather than fork: the web worker process has running threads
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = list(pool.map(_validate_class_sheet, [source] * len(sheet_names), sheet_names))
+
+    students = [student for sheet_students, _ in results for student in sheet_students]
+    issues = [issue for _, sheet_issues in results for issue in sheet_issues]
+    return students, issues
+
+def group_students_by_class(students: List[Dict[str, Any]]) -> Dict[str, List[int]]:
+    """Map each class name to the indexes of its students, in order of first appearance"""
+    classes: Dict[str, List[int]] = {}
+    for index, student in enumerate(students):
+        classes.setdefault(student.get('class_name') or '', []).append(index)
+    return classes
+
+def read_student_data_from_excel(file_path: Union[str, BinaryIO], sheet_name: str = "Sheet1") -> List[Dict[str, Any]]:
     """
     Read and validate student data from an Excel file
     
     Args:
-        file_path: Path to the Excel file
+        file_path: Path to the Excel file, or a binary file object holding it
         sheet_name: Name of the sheet to read (default: "Sheet1")
         
     Returns:
@@ -60,73 +346,8 @@ def read_student_data_from_excel(file_path: str, sheet_name: str = "Sheet1") ->
     """
     try:
         logger.info(f"Reading Excel file: {file_path}")
-        workbook = openpyxl.load_workbook(file_path)
-        
-        if sheet_name not in workbook.sheetnames:
-            raise ExcelParsingError(f"Sheet '{sheet_name}' not found in workbook")
-            
-        sheet = workbook[sheet_name]
-        
-        # Define expected headers in both formats
-        expected_headers = {
-            'Student Name': 'student_name',
-            'Year': 'year',
-            'Gender': 'gender',
-            'Adjectives': 'adjectives',
-            'Academic Performance': 'academic_performance',
-            'Extracurricular Activities': 'extracurricular_activities',
-            'Other': 'other',
-            'Sample Report': 'sample_report'
-        }
-        
-        # Get headers from the file
-        headers = [str(cell.value).strip() if cell.value else '' for cell in sheet[1]]
-        
-        # Create a mapping of actual headers to expected format
-        header_mapping = {}
-        for header in headers:
-            # Try to match the header in either format
-            for expected, normalized in expected_headers.items():
-                if header.lower() == expected.lower() or header.lower() == normalized.lower():
-                    header_mapping[header] = normalized
-                    break
-        
-        # Check if we have all required headers
-        if len(header_mapping) != len(expected_headers):
-            missing_headers = set(expected_headers.keys()) - set(header_mapping.keys())
-            raise ExcelParsingError(f"Missing required headers: {missing_headers}")
-        
-        valid_students = []
-        skipped_rows = []
-        
-        for row in range(2, sheet.max_row + 1):
-            try:
-                # Create student dictionary using the header mapping
-                student = {}
-                for col, header in enumerate(headers, 1):
-                    if header in header_mapping:
-                        student[header_mapping[header]] = sheet.cell(row=row, column=col).value
-                
-                # Skip empty rows
-                if all(value is None for value in student.values()):
-                    logger.debug(f"Skipping empty row {row}")
-                    continue
-                    
-                # Validate student data
-                if validate_student_data(student):
-                    valid_students.append(student)
-                    logger.debug(f"Added valid student data for {student['student_name']}")
-                else:
-                    skipped_rows.append(row)
-                    logger.warning(f"Skipping invalid student data in row {row}")
-                    
-            except Exception as e:
-                logger.error(f"Error processing row {row}: {str(e)}")
-                skipped_rows.append(row)
-                
-        if skipped_rows:
-            logger.warning(f"Skipped {len(skipped_rows)} rows due to invalid data: {skipped_rows}")
-            
+        valid_students = list(iter_student_data_from_excel(file_path, sheet_name))
+
         if not valid_students:
             raise ExcelParsingError("No valid student data found in the file")
             
@@ -136,3 +357,32 @@ def read_student_data_from_excel(file_path: str, sheet_name: str = "Sheet1") ->
     except Exception as e:
         logger.error(f"Error reading Excel file: {str(e)}")
         raise ExcelParsingError(f"Failed to read Excel file: {str(e)}")
+
+def pack_student_rows(students: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Pack student records into compact columnar JSON for storing against an upload
+
+    Field names are stored once rather than per row, and cell values that
+    aren't JSON types (dates, times) are converted to strings.
+
+    Returns:
+        Dict[str, Any]: {'fields': [...], 'rows': [[...], ...]}
+    """
+    fields = list(EXPECTED_HEADERS.values()) + ['class_name']
+    rows = []
+    for student in students:
+        row = []
+        for field in fields:
+            value = student.get(field)
+            if isinstance(value, (datetime, date, time)):
+                value = value.isoformat()
+            elif value is not None and not isinstance(value, (str, int, float, bool)):
+                value = str(value)
+            row.append(value)
+        rows.append(row)
+    return {'fields': fields, 'rows': rows}
+
+def unpack_student_rows(packed: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Expand records packed by pack_student_rows back into student dicts"""
+    fields = packed['fields']
+    return [dict(zip(fields, row)) for row in packed['rows']]
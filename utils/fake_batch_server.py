@@ -0,0 +1,200 @@
+"""
+Local stand-in for the Anthropic Message Batches API
+
+Implements just enough of /v1/messages/batches for MessageBatchBackend to
+run against without network access or API spend. Point the backend at it
+with ANTHROPIC_BATCH_BASE_URL, or start one in-process:
+
+    server = FakeBatchServer()
+    server.start()
+    backend = MessageBatchBackend(api_key="test", ..., base_url=server.url)
+
+Run ``python -m utils.fake_batch_server`` to serve it on a fixed port.
+"""
+import json
+import uuid
+import threading
+import logging
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+def _echo_responder(params: Dict[str, Any]) -> str:
+    """Default responder: reply with the start of the last user message"""
+    content = params['messages'][-1]['content']
+    if isinstance(content, list):
+        content = ''.join(block.get('text', '') for block in content)
+    return f"Fake report for prompt: {content[:80]}"
+
+class FakeBatchServer:
+    """In-process HTTP server emulating the Message Batches endpoints
+
+    Args:
+        responder: Called with each request's params; returns the report text,
+            or raises to record the request as errored
+        polls_until_ended: Number of retrieve calls a batch stays in_progress for
+        requests_per_poll: If set, each retrieve call while in_progress completes
+            this many more requests, so a cancelled batch has partial results
+        host: Interface to bind
+        port: Port to bind (0 picks a free port)
+    """
+
+    def __init__(self, responder: Optional[Callable[[Dict[str, Any]], str]] = None,
+                 polls_until_ended: int = 1, requests_per_poll: Optional[int] = None,
+                 host: str = '127.0.0.1', port: int = 0):
+        self.responder = responder or _echo_responder
+        self.polls_until_ended = polls_until_ended
+        self.requests_per_poll = requests_per_poll
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'FakeBatchServer':
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _batch_body(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        ended = batch['status'] == 'ended'
+        counts = {'processing': len(batch['requests']) - len(batch['results']),
+                  'succeeded': 0, 'errored': 0, 'canceled': 0, 'expired': 0}
+        for result in batch['results']:
+            counts[result['result']['type']] += 1
+        return {
+            'id': batch['id'],
+            'type': 'message_batch',
+            'processing_status': batch['status'],
+            'request_counts': counts,
+            'created_at': batch['created_at'],
+            'expires_at': batch['created_at'],
+            'ended_at': batch['created_at'] if ended else None,
+            'archived_at': None,
+            'cancel_initiated_at': None,
+            'results_url': f"{self.url}/v1/messages/batches/{batch['id']}/results" if ended else None
+        }
+
+    def _complete(self, batch: Dict[str, Any], count: int) -> None:
+        """Produce results for the next count requests that don't have one yet"""
+        done = len(batch['results'])
+        for request in batch['requests'][done:done + count]:
+            params = request['params']
+            try:
+                text = self.responder(params)
+                result = {
+                    'type': 'succeeded',
+                    'message': {
+                        'id': f"msg_{uuid.uuid4().hex}",
+                        'type': 'message',
+                        'role': 'assistant',
+                        'model': params['model'],
+                        'content': [{'type': 'text', 'text': text}],
+                        'stop_reason': 'end_turn',
+                        'stop_sequence': None,
+                        'usage': {'input_tokens': 0, 'output_tokens': 0}
+                    }
+                }
+            except Exception as e:
+                result = {
+                    'type': 'errored',
+                    'error': {'type': 'error', 'error': {'type': 'invalid_request_error', 'message': str(e)}}
+                }
+            batch['results'].append({'custom_id': request['custom_id'], 'result': result})
+
+    def _finish(self, batch: Dict[str, Any]) -> None:
+        self._complete(batch, len(batch['requests']))
+        batch['status'] = 'ended'
+
+    def _cancel(self, batch: Dict[str, Any]) -> None:
+        """End the batch; requests without a result yet are recorded as canceled"""
+        done = len(batch['results'])
+        for request in batch['requests'][done:]:
+            batch['results'].append({'custom_id': request['custom_id'], 'result': {'type': 'canceled'}})
+        batch['status'] = 'ended'
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def _send_json(self, body: Any, status: int = 200) -> None:
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _not_found(self) -> None:
+                self._send_json({'type': 'error', 'error': {'type': 'not_found_error', 'message': 'Not found'}}, 404)
+
+            def do_POST(self):
+                parts = self.path.rstrip('/').split('/')
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                with server._lock:
+                    if self.path.rstrip('/') == '/v1/messages/batches':
+                        batch_id = f"msgbatch_{uuid.uuid4().hex}"
+                        batch = {
+                            'id': batch_id,
+                            'requests': body['requests'],
+                            'status': 'in_progress',
+                            'polls': 0,
+                            'results': [],
+                            'created_at': datetime.now(timezone.utc).isoformat()
+                        }
+                        server.batches[batch_id] = batch
+                        if server.polls_until_ended <= 0:
+                            server._finish(batch)
+                        return self._send_json(server._batch_body(batch))
+                    if len(parts) == 6 and parts[5] == 'cancel' and parts[4] in server.batches:
+                        batch = server.batches[parts[4]]
+                        if batch['status'] != 'ended':
+                            server._cancel(batch)
+                        return self._send_json(server._batch_body(batch))
+                self._not_found()
+
+            def do_GET(self):
+                parts = self.path.rstrip('/').split('/')
+                with server._lock:
+                    if len(parts) < 5 or parts[4] not in server.batches:
+                        return self._not_found()
+                    batch = server.batches[parts[4]]
+                    if len(parts) == 5:
+                        batch['polls'] += 1
+                        if batch['status'] != 'ended':
+                            if batch['polls'] >= server.polls_until_ended:
+                                server._finish(batch)
+                            elif server.requests_per_poll:
+                                server._complete(batch, server.requests_per_poll)
+                        return self._send_json(server._batch_body(batch))
+                    if len(parts) == 6 and parts[5] == 'results' and batch['status'] == 'ended':
+                        payload = '\n'.join(json.dumps(result) for result in batch['results']).encode('utf-8')
+                        self.send_response(200)
+                        self.send_header('Content-Type', 'application/binary')
+                        self.send_header('Content-Length', str(len(payload)))
+                        self.end_headers()
+                        self.wfile.write(payload)
+                        return
+                self._not_found()
+
+        return Handler
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    fake_server = FakeBatchServer(port=8765)
+    print(f"Fake Message Batches API listening on {fake_server.url}")
+    fake_server._httpd.serve_forever()
@@ -0,0 +1,258 @@
+import os
+import time
+import queue
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError, TimeoutError as FutureTimeoutError
+from typing import Callable, Awaitable, Dict, List, Optional, Tuple
+from utils.event_loop import event_loop
+from utils.progress_store import ProgressStore, progress_store
+
+logger = logging.getLogger(__name__)
+
+# emit(event, data) passed to each job so it can publish events to its event log
+EmitCallback = Callable[[str, dict], None]
+JobFunction = Callable[[EmitCallback], Awaitable[Tuple[dict, int]]]
+
+# Body and status code reported for a cancelled job
+CANCELLED_RESULT = ({'success': False, 'cancelled': True, 'message': 'Report generation was cancelled'}, 409)
+
+class JobError(Exception):
+    """Base exception for background job operations"""
+    pass
+
+class Job:
+    """A single background job started by this process"""
+
+    def __init__(self, job_id: str, publish: Optional[Callable[['Job', str, dict], None]] = None):
+        self.job_id = job_id
+        # queued -> running -> completed / error / cancelled
+        self.status = 'queued'
+        self.result: Optional[dict] = None
+        self.status_code: Optional[int] = None
+        self.finished_at: Optional[float] = None
+        self.future: Optional[Future] = None
+        self.cancel_requested = False
+        self._publish = publish
+        self._lock = threading.Lock()
+
+    def emit(self, event: str, data: dict) -> None:
+        """Publish an event to the job's event log"""
+        if self._publish:
+            self._publish(self, event, data)
+
+    def finish(self, result: dict, status_code: int) -> None:
+        with self._lock:
+            self.result = result
+            self.status_code = status_code
+            if status_code == 200:
+                self.status = 'completed'
+            else:
+                self.status = 'cancelled' if result.get('cancelled') else 'error'
+            self.finished_at = time.monotonic()
+        self.emit('done' if status_code == 200 else 'error', result)
+
+class JobRunner:
+    """Runs report generation jobs on a thread pool outside the HTTP request
+
+    Each job's coroutine runs on the process's shared event loop, so jobs
+    share the LLM and storage clients and request handlers return
+    immediately; the pool threads only wait on the coroutines, capping how
+    many jobs run at once. The pool is created lazily so that each gunicorn
+    worker forked from a preloaded app gets its own threads.
+    Durable job state lives in the uploads table; this runner only tracks
+    jobs started by the current process.
+
+    Cancellation requests are written to a store shared by all workers
+    (``cancel_store``), and each job's waiting thread checks it every
+    ``cancel_poll_interval`` seconds, so a job can be cancelled from any
+    worker. Cancelling cancels the job's coroutine, which cancels the LLM
+    calls it is awaiting.
+
+    While this process has queued or running jobs, a background thread
+    passes their IDs to the heartbeat callback every ``heartbeat_interval``
+    seconds, so other workers can tell a live job from one whose worker
+    has died.
+
+    Events emitted by a job are appended to its log in ``event_store``,
+    keyed on the job ID, so any worker can stream them. Emitting only
+    queues the event; a background thread writes queued events in batches,
+    keeping store writes off the event loop running the job.
+    """
+
+    # Most events written to the event store in one batch
+    EVENT_BATCH_SIZE = 500
+
+    def __init__(self, max_workers: int = 4, retention_seconds: float = 3600,
+                 cancel_store: Optional[ProgressStore] = None, cancel_poll_interval: float = 0.5,
+                 heartbeat_interval: float = 30, event_store: Optional[ProgressStore] = None):
+        self.max_workers = max_workers
+        self.retention_seconds = retention_seconds
+        self.cancel_store = cancel_store
+        self.cancel_poll_interval = cancel_poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.event_store = event_store
+        self._events: queue.Queue = queue.Queue()
+        self._event_thread: Optional[threading.Thread] = None
+        self._heartbeat: Optional[Callable[[List[str]], None]] = None
+        self._heartbeat_thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def set_heartbeat(self, heartbeat: Callable[[List[str]], None]) -> None:
+        """Register the callback receiving the IDs of this process's active jobs every heartbeat_interval"""
+        self._heartbeat = heartbeat
+
+    def _start_heartbeat(self) -> None:
+        if self._heartbeat and not (self._heartbeat_thread and self._heartbeat_thread.is_alive()):
+            self._heartbeat_thread = threading.Thread(target=self._beat, name='report-job-heartbeat', daemon=True)
+            self._heartbeat_thread.start()
+
+    def _beat(self) -> None:
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                active = [job_id for job_id, job in self._jobs.items() if job.status in ('queued', 'running')]
+            if not active:
+                continue
+            try:
+                self._heartbeat(active)
+            except Exception as e:
+                logger.warning(f"Failed to record heartbeat for jobs {', '.join(active)}: {str(e)}")
+
+    def _start_event_writer(self) -> None:
+        if self.event_store and not (self._event_thread and self._event_thread.is_alive()):
+            self._event_thread = threading.Thread(target=self._write_events, name='report-job-events', daemon=True)
+            self._event_thread.start()
+
+    def _publish(self, job: Job, event: str, data: dict) -> None:
+        if self.event_store:
+            self._events.put((job, event, data))
+
+    def _write_events(self) -> None:
+        while True:
+            batch = [self._events.get()]
+            while len(batch) < self.EVENT_BATCH_SIZE:
+                try:
+                    batch.append(self._events.get_nowait())
+                except queue.Empty:
+                    break
+            by_job: Dict[str, List[Tuple[str, dict]]] = {}
+            for job, event, data in batch:
+                # Drop events from an earlier run of a job that has since been resubmitted
+                if self._jobs.get(job.job_id) is job:
+                    by_job.setdefault(job.job_id, []).append((event, data))
+            for job_id, events in by_job.items():
+                self.event_store.append_events(job_id, events)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='report-job')
+        return self._executor
+
+    def submit(self, job_id: str, run: JobFunction) -> Job:
+        """
+        Queue a job, or return the existing one if it is already active in this process
+
+        Args:
+            job_id: Identifier for the job (the uploads row id)
+            run: Coroutine function receiving an emit callback and returning (body, status code)
+
+        Returns:
+            Job: The queued or already active job
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job and job.status in ('queued', 'running'):
+                return job
+            self._prune()
+            job = Job(job_id, self._publish)
+            self._jobs[job_id] = job
+            # A cancellation left over from an earlier run must not stop this one
+            if self.cancel_store:
+                self.cancel_store.delete(self._cancel_key(job_id))
+            # Nor may its events be replayed as this run's
+            if self.event_store:
+                self.event_store.clear_events(job_id)
+            try:
+                self._get_executor().submit(self._run, job, run)
+            except RuntimeError as e:
+                del self._jobs[job_id]
+                raise JobError(f"Failed to queue job {job_id}: {str(e)}")
+            self._start_heartbeat()
+            self._start_event_writer()
+        logger.info(f"Queued job {job_id}")
+        return job
+
+    def _prune(self) -> None:
+        """Forget finished jobs older than the retention period"""
+        cutoff = time.monotonic() - self.retention_seconds
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished_at and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Return the job if it was started by this process"""
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Request cancellation of a job, wherever it is running
+
+        Returns:
+            bool: True if the job was active in this process and has been cancelled here
+        """
+        if self.cancel_store:
+            key = self._cancel_key(job_id)
+            self.cancel_store.set(key, {'requested_at': time.time()})
+            self.cancel_store.finish(key)
+        job = self._jobs.get(job_id)
+        if job and job.status in ('queued', 'running'):
+            job.cancel_requested = True
+            if job.future:
+                job.future.cancel()
+            logger.info(f"Cancelled job {job_id}")
+            return True
+        return False
+
+    @staticmethod
+    def _cancel_key(job_id: str) -> str:
+        return f"cancel:{job_id}"
+
+    def _cancel_requested(self, job: Job) -> bool:
+        return job.cancel_requested or bool(self.cancel_store and self._cancel_key(job.job_id) in self.cancel_store)
+
+    def _run(self, job: Job, run: JobFunction) -> None:
+        if self._cancel_requested(job):
+            logger.info(f"Job {job.job_id} was cancelled before it started")
+            job.finish(*CANCELLED_RESULT)
+            return
+
+        job.status = 'running'
+        logger.info(f"Starting job {job.job_id}")
+        job.future = event_loop.submit(run(job.emit))
+        while True:
+            try:
+                result, status_code = job.future.result(timeout=self.cancel_poll_interval)
+                break
+            except FutureTimeoutError:
+                if self._cancel_requested(job):
+                    job.future.cancel()
+            except CancelledError:
+                logger.info(f"Job {job.job_id} was cancelled")
+                result, status_code = CANCELLED_RESULT
+                break
+            except Exception as e:
+                logger.error(f"Unexpected error in job {job.job_id}: {str(e)}", exc_info=True)
+                result, status_code = {'success': False, 'message': f'Unexpected error: {str(e)}'}, 500
+                break
+        job.finish(result, status_code)
+        logger.info(f"Finished job {job.job_id} with status {job.status}")
+
+# Create a singleton instance
+job_runner = JobRunner(
+    max_workers=int(os.getenv('JOB_WORKERS', '4')),
+    cancel_store=progress_store,
+    event_store=progress_store,
+    heartbeat_interval=float(os.getenv('JOB_HEARTBEAT_SECONDS', '30'))
+)
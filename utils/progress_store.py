@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import sqlite3
+import tempfile
+import threading
+import logging
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class ProgressStoreError(Exception):
+    """Base exception for progress store operations"""
+    pass
+
+class ProgressStore(ABC):
+    """Per-job generation progress, readable from any worker
+
+    Keys are job (upload) IDs. Supports the dict operations the generation
+    code already uses (``store[key] = {...}``, ``key in store``, ``store[key]``)
+    plus ``merge`` for atomic partial updates and ``finish`` to start the
+    expiry countdown once a run is over. Entries that are not updated for
+    ``active_ttl_seconds`` (e.g. the worker died mid-run) expire as well.
+
+    Each key also has an append-only event log (``append_events`` /
+    ``events_after``) so a job's events can be streamed from any worker,
+    not only the one running it. Event ids count up from 1 per key.
+    """
+
+    def __init__(self, active_ttl_seconds: int = 3600, finished_ttl_seconds: int = 300):
+        self.active_ttl_seconds = active_ttl_seconds
+        self.finished_ttl_seconds = finished_ttl_seconds
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the current progress for key, or None if there is none or it has expired"""
+
+    @abstractmethod
+    def set(self, key: str, progress: Dict[str, Any]) -> None:
+        """Replace the progress for key"""
+
+    @abstractmethod
+    def merge(self, key: str, fields: Dict[str, Any]) -> None:
+        """Atomically update some fields of the progress for key"""
+
+    @abstractmethod
+    def finish(self, key: str) -> None:
+        """Mark the run for key as over; its progress stays readable for finished_ttl_seconds"""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        """Remove the progress for key, if any"""
+
+    @abstractmethod
+    def append_events(self, key: str, events: List[Tuple[str, Dict[str, Any]]]) -> None:
+        """Append (event, data) items to the event log for key, in order"""
+
+    @abstractmethod
+    def events_after(self, key: str, after: int = 0) -> List[Tuple[int, str, Dict[str, Any]]]:
+        """(event id, event, data) items in the event log for key with an id greater than after"""
+
+    @abstractmethod
+    def clear_events(self, key: str) -> None:
+        """Remove the event log for key, if any"""
+
+    def __getitem__(self, key: str) -> Dict[str, Any]:
+        progress = self.get(key)
+        if progress is None:
+            raise KeyError(key)
+        return progress
+
+    def __setitem__(self, key: str, progress: Dict[str, Any]) -> None:
+        self.set(key, progress)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+class MemoryProgressStore(ProgressStore):
+    """Progress held in this process only; suitable for a single worker"""
+
+    def __init__(self, active_ttl_seconds: int = 3600, finished_ttl_seconds: int = 300):
+        super().__init__(active_ttl_seconds, finished_ttl_seconds)
+        self._entries: Dict[str, tuple] = {}
+        self._events: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def _purge(self, now: float) -> None:
+        for entries in (self._entries, self._events):
+            for key in [key for key, (_, expires_at) in entries.items() if expires_at <= now]:
+                del entries[key]
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                return None
+            return dict(entry[0])
+
+    def set(self, key: str, progress: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            self._entries[key] = (dict(progress), now + self.active_ttl_seconds)
+
+    def merge(self, key: str, fields: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            progress = dict(entry[0]) if entry and entry[1] > now else {}
+            progress.update(fields)
+            self._entries[key] = (progress, now + self.active_ttl_seconds)
+
+    def finish(self, key: str) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries[key] = (entry[0], time.time() + self.finished_ttl_seconds)
+            log = self._events.get(key)
+            if log:
+                self._events[key] = (log[0], min(log[1], time.time() + self.finished_ttl_seconds))
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def append_events(self, key: str, events: List[Tuple[str, Dict[str, Any]]]) -> None:
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            log = self._events.get(key)
+            items = log[0] if log else []
+            items.extend((event, dict(data)) for event, data in events)
+            self._events[key] = (items, now + self.active_ttl_seconds)
+
+    def events_after(self, key: str, after: int = 0) -> List[Tuple[int, str, Dict[str, Any]]]:
+        with self._lock:
+            log = self._events.get(key)
+            if log is None or log[1] <= time.time():
+                return []
+            return [(event_id, event, dict(data)) for event_id, (event, data) in enumerate(log[0][after:], start=after + 1)]
+
+    def clear_events(self, key: str) -> None:
+        with self._lock:
+            self._events.pop(key, None)
+
+class SQLiteProgressStore(ProgressStore):
+    """Progress in a SQLite file shared by every worker process on the host
+
+    Each write is a single statement, so concurrent updates from different
+    workers never interleave. Reads are a primary-key lookup on a connection
+    kept open per thread, which keeps frequent /progress polling cheap. Put
+    the file on a tmpfs such as /dev/shm to keep it in shared memory.
+
+    Event logs live in an ``events`` table keyed on (key, id); a batch of
+    events is appended in one transaction.
+    """
+
+    # Expired rows are deleted at most this often per process
+    PURGE_INTERVAL_SECONDS = 60
+
+    def __init__(self, path: str, active_ttl_seconds: int = 3600, finished_ttl_seconds: int = 300):
+        super().__init__(active_ttl_seconds, finished_ttl_seconds)
+        self.path = path
+        self._local = threading.local()
+        self._last_purge = 0.0
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            conn = self._connection()
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS progress ('
+                'key TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS progress_expires_at_idx ON progress(expires_at)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS events ('
+                'key TEXT NOT NULL, id INTEGER NOT NULL, event TEXT NOT NULL, data TEXT NOT NULL, '
+                'expires_at REAL NOT NULL, PRIMARY KEY (key, id))'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS events_expires_at_idx ON events(expires_at)')
+        except sqlite3.Error as e:
+            raise ProgressStoreError(f"Failed to initialise progress store at {path}: {str(e)}")
+
+    def _connection(self) -> sqlite3.Connection:
+        """Connection for the current thread, reopened after a fork"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _purge(self, conn: sqlite3.Connection, now: float) -> None:
+        if now - self._last_purge >= self.PURGE_INTERVAL_SECONDS:
+            self._last_purge = now
+            conn.execute('DELETE FROM progress WHERE expires_at <= ?', (now,))
+            conn.execute('DELETE FROM events WHERE expires_at <= ?', (now,))
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            row = self._connection().execute(
+                'SELECT data FROM progress WHERE key = ? AND expires_at > ?', (key, time.time())
+            ).fetchone()
+            return json.loads(row[0]) if row else None
+        except sqlite3.Error as e:
+            logger.warning(f"Progress lookup failed for {key}: {str(e)}")
+            return None
+
+    def set(self, key: str, progress: Dict[str, Any]) -> None:
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute(
+                'INSERT OR REPLACE INTO progress (key, data, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(progress), now + self.active_ttl_seconds)
+            )
+            self._purge(conn, now)
+        except sqlite3.Error as e:
+            logger.warning(f"Progress update failed for {key}: {str(e)}")
+
+    def merge(self, key: str, fields: Dict[str, Any]) -> None:
+        now = time.time()
+        try:
+            self._connection().execute(
+                'INSERT INTO progress (key, data, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET '
+                'data = CASE WHEN expires_at > ? THEN json_patch(data, excluded.data) ELSE excluded.data END, '
+                'expires_at = excluded.expires_at',
+                (key, json.dumps(fields), now + self.active_ttl_seconds, now)
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"Progress update failed for {key}: {str(e)}")
+
+    def finish(self, key: str) -> None:
+        expires_at = time.time() + self.finished_ttl_seconds
+        try:
+            conn = self._connection()
+            conn.execute('UPDATE progress SET expires_at = MIN(expires_at, ?) WHERE key = ?', (expires_at, key))
+            conn.execute('UPDATE events SET expires_at = MIN(expires_at, ?) WHERE key = ?', (expires_at, key))
+        except sqlite3.Error as e:
+            logger.warning(f"Progress update failed for {key}: {str(e)}")
+
+    def delete(self, key: str) -> None:
+        try:
+            self._connection().execute('DELETE FROM progress WHERE key = ?', (key,))
+        except sqlite3.Error as e:
+            logger.warning(f"Progress delete failed for {key}: {str(e)}")
+
+    def append_events(self, key: str, events: List[Tuple[str, Dict[str, Any]]]) -> None:
+        now = time.time()
+        try:
+            conn = self._connection()
+            # BEGIN IMMEDIATE takes the write lock before reading the last id,
+            # so concurrent appends for the same key can't pick the same ids
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM events WHERE key = ?', (key,)).fetchone()[0]
+                conn.executemany(
+                    'INSERT INTO events (key, id, event, data, expires_at) VALUES (?, ?, ?, ?, ?)',
+                    [(key, event_id, event, json.dumps(data), now + self.active_ttl_seconds)
+                     for event_id, (event, data) in enumerate(events, start=last_id + 1)]
+                )
+                conn.execute('COMMIT')
+            except sqlite3.Error:
+                conn.execute('ROLLBACK')
+                raise
+            self._purge(conn, now)
+        except sqlite3.Error as e:
+            logger.warning(f"Event log update failed for {key}: {str(e)}")
+
+    def events_after(self, key: str, after: int = 0) -> List[Tuple[int, str, Dict[str, Any]]]:
+        try:
+            rows = self._connection().execute(
+                'SELECT id, event, data FROM events WHERE key = ? AND id > ? AND expires_at > ? ORDER BY id',
+                (key, after, time.time())
+            ).fetchall()
+            return [(event_id, event, json.loads(data)) for event_id, event, data in rows]
+        except sqlite3.Error as e:
+            logger.warning(f"Event log lookup failed for {key}: {str(e)}")
+            return []
+
+    def clear_events(self, key: str) -> None:
+        try:
+            self._connection().execute('DELETE FROM events WHERE key = ?', (key,))
+        except sqlite3.Error as e:
+            logger.warning(f"Event log delete failed for {key}: {str(e)}")
+
+def _default_path() -> str:
+    # /dev/shm keeps the file in shared memory where available
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'batch_report_progress.sqlite3')
+
+def create_progress_store() -> ProgressStore:
+    """Build the progress store selected by PROGRESS_STORE_BACKEND ('sqlite' or 'memory')"""
+    backend = os.getenv('PROGRESS_STORE_BACKEND', 'sqlite').lower()
+    active_ttl = int(os.getenv('PROGRESS_ACTIVE_TTL_SECONDS', '3600'))
+    finished_ttl = int(os.getenv('PROGRESS_FINISHED_TTL_SECONDS', '300'))
+    if backend == 'sqlite':
+        try:
+            return SQLiteProgressStore(os.getenv('PROGRESS_STORE_PATH', _default_path()), active_ttl, finished_ttl)
+        except ProgressStoreError as e:
+            logger.error(f"Falling back to in-process progress tracking: {str(e)}")
+    elif backend != 'memory':
+        logger.error(f"Unknown PROGRESS_STORE_BACKEND '{backend}', using in-process progress tracking")
+    return MemoryProgressStore(active_ttl, finished_ttl)
+
+# Create a singleton instance
+progress_store = create_progress_store()
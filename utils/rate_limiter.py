@@ -0,0 +1,144 @@
+import os
+import time
+import asyncio
+import threading
+import logging
+from datetime import datetime, timezone
+from typing import Optional, Mapping
+
+logger = logging.getLogger(__name__)
+
+class AdaptiveRateLimiter:
+    """Process-wide token bucket for LLM calls with AIMD rate adjustment
+
+    Every call takes a token before it is sent, and its outcome is reported
+    back: successful calls raise the rate additively, 429/529 responses cut
+    it multiplicatively and pause all callers for ``retry-after``. The
+    ``anthropic-ratelimit-*`` headers on every response (see
+    ``observe_response``) cap the rate at the account's request limit and
+    pace the remaining quota evenly until the window resets. ``max_rate``
+    caps it before any headers have been seen.
+
+    State is guarded by a threading lock rather than an asyncio primitive so
+    the limiter can be shared by every event loop and thread in the process,
+    not just the shared loop in utils.event_loop.
+    """
+
+    def __init__(self, initial_rate: float = 2.0, min_rate: float = 0.1, max_rate: float = 50.0,
+                 increase_step: float = 0.2, decrease_factor: float = 0.5, burst: int = 5):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.burst = burst
+        self.rate = min(max(initial_rate, min_rate), max_rate)
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        # Requests per second allowed by the account, from anthropic-ratelimit-requests-limit
+        self._account_rate: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated_at
+        self._tokens = min(float(self.burst), self._tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    def _reserve(self) -> float:
+        """Take a token and return how long the caller must wait before using it"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+            return max(wait, self._blocked_until - now)
+
+    async def acquire(self) -> None:
+        """Wait until the next LLM call is allowed"""
+        wait = self._reserve()
+        if wait > 0:
+            logger.debug(f"Rate limiter delaying call by {wait:.2f}s (rate {self.rate:.2f}/s)")
+            await asyncio.sleep(wait)
+
+    def on_success(self) -> None:
+        """Additive increase after a successful call, up to max_rate and the account's request limit"""
+        with self._lock:
+            ceiling = self.max_rate if self._account_rate is None else min(self.max_rate, self._account_rate)
+            self.rate = max(self.min_rate, min(ceiling, self.rate + self.increase_step))
+
+    def on_rate_limited(self, retry_after: Optional[float] = None) -> None:
+        """Multiplicative decrease after a 429/529, pausing callers for retry_after seconds"""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self._tokens = min(self._tokens, 0.0)
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+        logger.warning(f"LLM rate limited, reducing rate to {self.rate:.2f}/s (retry after {retry_after}s)")
+
+    def observe_headers(self, headers: Mapping[str, str]) -> None:
+        """Pace the remaining request/token quota from anthropic-ratelimit-* headers"""
+        for kind in ('requests', 'tokens', 'input-tokens', 'output-tokens'):
+            remaining = _parse_float(headers.get(f'anthropic-ratelimit-{kind}-remaining'))
+            limit = _parse_float(headers.get(f'anthropic-ratelimit-{kind}-limit'))
+            reset_in = _seconds_until(headers.get(f'anthropic-ratelimit-{kind}-reset'))
+            if kind == 'requests' and limit:
+                # The request limit is per minute
+                with self._lock:
+                    self._account_rate = limit / 60.0
+            if remaining is None or not limit or reset_in is None:
+                continue
+
+            with self._lock:
+                if remaining <= 0:
+                    self._blocked_until = max(self._blocked_until, time.monotonic() + reset_in)
+                    logger.warning(f"Anthropic {kind} quota exhausted, pausing for {reset_in:.1f}s")
+                elif remaining / limit < 0.1:
+                    # Spread the last of the quota across the rest of the window;
+                    # token quotas can't be mapped to calls, so scale the rate down instead
+                    if kind == 'requests':
+                        paced_rate = remaining / max(reset_in, 1.0)
+                    else:
+                        paced_rate = self.rate * (remaining / limit) / 0.1
+                    self.rate = max(self.min_rate, min(self.rate, paced_rate))
+
+    async def observe_response(self, response) -> None:
+        """httpx response hook reading anthropic-ratelimit-* headers from successful responses
+
+        Error responses are handled by on_error_response once the SDK has raised.
+        """
+        if response.is_success:
+            try:
+                self.observe_headers(response.headers)
+            except Exception as e:
+                logger.warning(f"Failed to update rate limiter from response: {str(e)}")
+
+    def on_error_response(self, response) -> None:
+        """Slow down after an Anthropic API error response (the ``response`` of an APIStatusError)"""
+        try:
+            if response.status_code in (429, 529):
+                self.on_rate_limited(_parse_float(response.headers.get('retry-after')))
+            self.observe_headers(response.headers)
+        except Exception as e:
+            logger.warning(f"Failed to update rate limiter from response: {str(e)}")
+
+def _parse_float(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def _seconds_until(timestamp: Optional[str]) -> Optional[float]:
+    """Seconds until an RFC 3339 reset timestamp, as sent in anthropic-ratelimit-*-reset"""
+    if not timestamp:
+        return None
+    try:
+        reset_at = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return max(0.0, (reset_at - datetime.now(timezone.utc)).total_seconds())
+
+# Create a singleton instance shared by every ReportGenerationService in the process
+rate_limiter = AdaptiveRateLimiter(
+    initial_rate=float(os.getenv('LLM_INITIAL_RATE', '2.0')),
+    max_rate=float(os.getenv('LLM_MAX_RATE', '50.0'))
+)
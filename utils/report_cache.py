@@ -0,0 +1,177 @@
+import os
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import logging
+from contextlib import contextmanager
+from typing import Optional, Dict, Iterator, Tuple
+
+logger = logging.getLogger(__name__)
+
+class ReportCacheError(Exception):
+    """Base exception for report cache operations"""
+    pass
+
+class ReportCache:
+    """Persistent cache of generated reports keyed on the rendered prompt
+
+    Entries live in a SQLite file so they survive worker restarts and are
+    shared by every gunicorn worker on the instance. Entries older than
+    ``ttl_seconds`` are treated as misses, and the least recently used
+    entries are evicted once the cache holds more than ``max_entries``.
+
+    Lookups only read the file. Hit/miss counts and access times are kept
+    in memory and written in one transaction at most every
+    ``flush_interval_seconds`` (and with every ``set``), so concurrent
+    lookups don't queue on SQLite's write lock.
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000, ttl_seconds: int = 30 * 24 * 3600,
+                 flush_interval_seconds: float = 30):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.flush_interval_seconds = flush_interval_seconds
+        self._pending_counts = {'hits': 0, 'misses': 0}
+        self._pending_access: Dict[str, float] = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with self._connect() as conn:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS reports ('
+                    'key TEXT PRIMARY KEY, report TEXT NOT NULL, '
+                    'created_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+                )
+                conn.execute('CREATE INDEX IF NOT EXISTS reports_accessed_at_idx ON reports(accessed_at)')
+                conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+                conn.executemany('INSERT OR IGNORE INTO stats (name, value) VALUES (?, 0)', [('hits',), ('misses',)])
+        except sqlite3.Error as e:
+            raise ReportCacheError(f"Failed to initialise report cache at {path}: {str(e)}")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Open a connection that commits on success and is always closed"""
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_key(prompt: str, model: str, temperature: Optional[float]) -> str:
+        """Content address for a rendered prompt and the model settings that produced it"""
+        digest = hashlib.sha256()
+        for part in (model, repr(temperature), prompt):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached report for key, or None on a miss or expired entry"""
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute('SELECT report, created_at FROM reports WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Report cache lookup failed: {str(e)}")
+            return None
+        # Expired entries are removed by the next set
+        hit = row is not None and now - row[1] <= self.ttl_seconds
+        with self._lock:
+            self._pending_counts['hits' if hit else 'misses'] += 1
+            if hit:
+                self._pending_access[key] = now
+            due = time.monotonic() - self._last_flush >= self.flush_interval_seconds
+        if due:
+            self.flush()
+        return row[0] if hit else None
+
+    def _take_pending(self) -> Tuple[Dict[str, int], Dict[str, float]]:
+        with self._lock:
+            counts, accessed = self._pending_counts, self._pending_access
+            self._pending_counts = {'hits': 0, 'misses': 0}
+            self._pending_access = {}
+            self._last_flush = time.monotonic()
+        return counts, accessed
+
+    @staticmethod
+    def _write_pending(conn: sqlite3.Connection, counts: Dict[str, int], accessed: Dict[str, float]) -> None:
+        conn.executemany(
+            'UPDATE reports SET accessed_at = MAX(accessed_at, ?) WHERE key = ?',
+            [(accessed_at, key) for key, accessed_at in accessed.items()]
+        )
+        conn.executemany(
+            'UPDATE stats SET value = value + ? WHERE name = ?',
+            [(count, name) for name, count in counts.items() if count]
+        )
+
+    def flush(self) -> None:
+        """Write buffered hit/miss counts and access times to the cache file"""
+        counts, accessed = self._take_pending()
+        if not any(counts.values()) and not accessed:
+            return
+        try:
+            with self._connect() as conn:
+                self._write_pending(conn, counts, accessed)
+        except sqlite3.Error as e:
+            logger.warning(f"Report cache stats flush failed: {str(e)}")
+
+    def set(self, key: str, report: str) -> None:
+        """Store a report, flush buffered stats and evict expired and least recently used entries"""
+        now = time.time()
+        counts, accessed = self._take_pending()
+        try:
+            with self._connect() as conn:
+                self._write_pending(conn, counts, accessed)
+                conn.execute(
+                    'INSERT OR REPLACE INTO reports (key, report, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+                    (key, report, now, now)
+                )
+                conn.execute('DELETE FROM reports WHERE created_at < ?', (now - self.ttl_seconds,))
+                conn.execute(
+                    'DELETE FROM reports WHERE key IN ('
+                    'SELECT key FROM reports ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,)
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Report cache store failed: {str(e)}")
+
+    def stats(self) -> Dict[str, int]:
+        """Hit/miss counters and current size, shared across all processes using the cache
+
+        Counts not yet flushed by other processes are missing for up to flush_interval_seconds.
+        """
+        try:
+            with self._connect() as conn:
+                counters = dict(conn.execute('SELECT name, value FROM stats').fetchall())
+                entries = conn.execute('SELECT COUNT(*) FROM reports').fetchone()[0]
+        except sqlite3.Error as e:
+            raise ReportCacheError(f"Failed to read report cache stats: {str(e)}")
+        with self._lock:
+            pending = dict(self._pending_counts)
+        return {
+            'hits': counters.get('hits', 0) + pending['hits'],
+            'misses': counters.get('misses', 0) + pending['misses'],
+            'entries': entries,
+            'max_entries': self.max_entries,
+            'ttl_seconds': self.ttl_seconds
+        }
+
+# Create a singleton instance (set REPORT_CACHE_ENABLED=false to disable)
+report_cache = None
+if os.getenv('REPORT_CACHE_ENABLED', 'true').lower() == 'true':
+    try:
+        report_cache = ReportCache(
+            path=os.getenv('REPORT_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'batch_report_cache.sqlite3')),
+            max_entries=int(os.getenv('REPORT_CACHE_MAX_ENTRIES', '10000')),
+            ttl_seconds=int(os.getenv('REPORT_CACHE_TTL_SECONDS', str(30 * 24 * 3600))),
+            flush_interval_seconds=float(os.getenv('REPORT_CACHE_FLUSH_SECONDS', '30'))
+        )
+    except ReportCacheError as e:
+        logger.error(f"Report cache disabled: {str(e)}")
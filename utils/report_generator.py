@@ -1,14 +1,21 @@
 from langchain.prompts import PromptTemplate
 from langchain_anthropic import ChatAnthropic
-from langchain.schema import AIMessage
-from docx import Document
+from langchain.schema import AIMessage, BaseMessage, HumanMessage, SystemMessage
 import time
 import os
+import shutil
 import asyncio
-from typing import List, Dict, Any
-from datetime import datetime
+from typing import List, Dict, Any, Optional, Tuple, Callable, Awaitable
 from dotenv import load_dotenv
 import logging
+import anthropic
+from functools import cached_property
+from utils.rate_limiter import rate_limiter
+from utils.report_cache import report_cache, ReportCache
+from utils.batch_backend import MessageBatchBackend
+from utils.retry import is_retryable, retry_after_seconds, backoff_delay
+from utils.progress_store import ProgressStore
+from utils.docx_builder import IncrementalWordDoc, DocxBuilderError
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -16,58 +23,202 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+# Default number of LLM calls allowed in flight at once for a single class
+DEFAULT_MAX_CONCURRENCY = int(os.getenv('REPORT_MAX_CONCURRENCY', '5'))
+
+# Classes with at least this many students are generated through the Message Batches API (0 disables)
+DEFAULT_BATCH_THRESHOLD = int(os.getenv('REPORT_BATCH_THRESHOLD', '100'))
+
+# Attempts per student for transient LLM failures
+DEFAULT_MAX_ATTEMPTS = int(os.getenv('REPORT_MAX_ATTEMPTS', '4'))
+
+# Wall-clock budget for generating a whole class, kept under the gunicorn worker timeout (0 disables)
+DEFAULT_TIME_BUDGET_SECONDS = float(os.getenv('REPORT_TIME_BUDGET_SECONDS', '240'))
+
+# on_report(index, student_name, report, completed, total) and on_token(index, text) callbacks
+ReportCallback = Callable[[int, str, str, int, int], None]
+TokenCallback = Callable[[int, str], None]
+
+# on_checkpoint(index, student_name, report), awaited after each successful report
+CheckpointCallback = Callable[[int, str, str], Awaitable[None]]
+
 class ReportGenerationError(Exception):
     """Base exception for report generation errors"""
     pass
 
+class _ClassProgress:
+    """Progress target for one class that reports progress for the whole job"""
+
+    def __init__(self, progress_tracker: ProgressStore, class_name: str, done_before: int, job_total: int):
+        self.progress_tracker = progress_tracker
+        self.class_name = class_name
+        self.done_before = done_before
+        self.job_total = job_total
+
+    def __setitem__(self, key: str, progress: Dict[str, Any]) -> None:
+        current = self.done_before + progress.get('current', 0)
+        self.progress_tracker[key] = {
+            **progress,
+            'current': current,
+            'total': self.job_total,
+            'status': f"{self.class_name}: {progress.get('status', '')}",
+            'progress': int((current / self.job_total) * 90) if self.job_total else 0,
+            'class_name': self.class_name
+        }
+
+class _ProgressWriter:
+    """Writes progress for one key off the event loop, keeping only the latest update
+
+    Store writes are blocking (SQLite), so they run in a worker thread. Updates
+    made while a write is in flight replace one another, so there is at most
+    one write per key in flight and older progress never lands after newer.
+    """
+
+    def __init__(self, progress_tracker: ProgressStore, key: str):
+        self.progress_tracker = progress_tracker
+        self.key = key
+        self._pending: Optional[Dict[str, Any]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def update(self, progress: Dict[str, Any]) -> None:
+        """Queue progress to be written; must be called on the event loop"""
+        self._pending = progress
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._write())
+
+    async def _write(self) -> None:
+        while self._pending is not None:
+            progress, self._pending = self._pending, None
+            await asyncio.to_thread(self.progress_tracker.__setitem__, self.key, progress)
+
+    async def flush(self) -> None:
+        """Wait until the latest update has been written"""
+        if self._task:
+            await self._task
+
+class RateLimitedChatAnthropic(ChatAnthropic):
+    """ChatAnthropic whose async client passes every response to the shared rate limiter
+
+    langchain-anthropic doesn't expose response headers, so the limiter
+    reads anthropic-ratelimit-* from an httpx response hook instead.
+    """
+
+    @cached_property
+    def _async_client(self) -> anthropic.AsyncClient:
+        return anthropic.AsyncClient(
+            **self._client_params,
+            http_client=anthropic.DefaultAsyncHttpxClient(event_hooks={'response': [rate_limiter.observe_response]})
+        )
+
 class ReportGenerationService:
-    def __init__(self):
+    # (llm, batch_backend) per process, see with_shared_clients
+    _shared_clients: Dict[int, Tuple[ChatAnthropic, MessageBatchBackend]] = {}
+
+    def __init__(self, max_concurrency: Optional[int] = None, cache: Optional[ReportCache] = report_cache,
+                 batch_threshold: Optional[int] = None, max_attempts: Optional[int] = None,
+                 time_budget: Optional[float] = None, llm: Optional[ChatAnthropic] = None,
+                 batch_backend: Optional[MessageBatchBackend] = None):
         api_key = os.getenv('ANTHROPIC_API_KEY')
         if not api_key:
             raise ReportGenerationError("ANTHROPIC_API_KEY environment variable is not set")
             
         logger.debug("Initializing ReportGenerationService")
-        self.llm = ChatAnthropic(
+        # Retries are handled per student in generate_single_report, not inside the SDK
+        self.llm = llm or RateLimitedChatAnthropic(
             model="claude-3-opus-20240229",
             anthropic_api_key=api_key,
-            temperature=0.4
+            temperature=0.4,
+            max_retries=0
         )
-        self.prompt_template = PromptTemplate(
-            input_variables=["student_name", "year", "gender", "adjectives", "academic_performance", 
-                           "extracurricular_activities", "other", "sample_report"],
+        self.max_concurrency = max(1, max_concurrency or DEFAULT_MAX_CONCURRENCY)
+        self.cache = cache
+        self.batch_threshold = DEFAULT_BATCH_THRESHOLD if batch_threshold is None else batch_threshold
+        self.max_attempts = max(1, max_attempts or DEFAULT_MAX_ATTEMPTS)
+        self.time_budget = DEFAULT_TIME_BUDGET_SECONDS if time_budget is None else time_budget
+        self.batch_backend = batch_backend or MessageBatchBackend(
+            api_key=api_key,
+            model=self.llm.model,
+            temperature=self.llm.temperature,
+            max_tokens=self.llm.max_tokens,
+            base_url=os.getenv('ANTHROPIC_BATCH_BASE_URL'),
+            poll_interval=float(os.getenv('REPORT_BATCH_POLL_INTERVAL', '5.0'))
+        )
+        # Static instructions and the class sample report are identical for every
+        # student, so they form the cached system prefix; only prompt_template varies
+        self.system_template = PromptTemplate(
+            input_variables=["sample_report"],
             template="""You are an experienced and caring high school teacher, your job is to write a report for students in your Home Group that comments on their academic performance, their wellbeing and their involvement in extracurricular activities.
 
 Use this sample report below as a template.
 
 {sample_report}
 
-It is very important that you follow the template above, using the same structure, tone, language and length. You must use adjectives such as {adjectives} in the opening sentence. You can vary adjectives in the closing sentence. It must be written in Australian English.
+It is very important that you follow the template above, using the same structure, tone, language and length. You must use the adjectives given for the student in the opening sentence. You can vary adjectives in the closing sentence. It must be written in Australian English.
+
+Use the student's year and class in place of any other mentions of year and class in the template, such as 7A, 9B, 10D etc.
+
+Use the appropriate pro-nouns for the student's gender.
+
+For House Athletics and House swimming, do not list out all the events the student participate in, just provide an overview of their involvement with a general comment on the events they participated in.
+
+Include 1 sentence on the other important information given for the student."""
+        )
+        self.prompt_template = PromptTemplate(
+            input_variables=["student_name", "year", "gender", "adjectives", "academic_performance",
+                           "extracurricular_activities", "other"],
+            template="""Write a report for {student_name}.
 
-Write a report for {student_name}.
+You must use adjectives such as {adjectives} in the opening sentence.
 
-They are in year {year}, use this year and class in place of any other mentions of year and class, such as 7A, 9B, 10D etc.
+They are in year {year}.
 
-Their gender is {gender}, use the appropriate pro-nouns.
+Their gender is {gender}.
 
 Academic Performance:
 {academic_performance}
 
 Extracurricular Activities:
-For House Athletics and House swimming, do not list out all the events the student participate in, just provide an overview of their involvement with a general comment on the events they participated in.
 {extracurricular_activities}
 
 Other important information to include 1 sentence on:
 {other}"""
         )
+        self.token_usage = {
+            'input_tokens': 0,
+            'output_tokens': 0,
+            'cache_creation_input_tokens': 0,
+            'cache_read_input_tokens': 0
+        }
         logger.debug("ReportGenerationService initialized successfully")
 
-    def generate_prompt(self, student: Dict[str, Any]) -> str:
-        """Generate a prompt for a single student"""
+    @classmethod
+    def with_shared_clients(cls, **kwargs) -> 'ReportGenerationService':
+        """
+        Create a service reusing this process's LLM and batch API clients
+
+        The clients keep their HTTP connection pools open between jobs. Only use
+        this from coroutines on the shared event loop (utils.event_loop), since
+        async connection pools are bound to the loop that first used them.
+        """
+        pid = os.getpid()
+        clients = cls._shared_clients.get(pid)
+        if clients is None:
+            template = cls()
+            clients = (template.llm, template.batch_backend)
+            cls._shared_clients = {pid: clients}
+        llm, batch_backend = clients
+        return cls(llm=llm, batch_backend=batch_backend, **kwargs)
+
+    def generate_prompt_parts(self, student: Dict[str, Any]) -> Tuple[str, str]:
+        """Render the shared system prefix and the student-specific prompt for a student"""
         try:
             logger.debug(f"Generating prompt for student: {student.get('student_name', 'unknown')}")
-            prompt = self.prompt_template.format(**student)
-            logger.debug(f"Generated prompt: {prompt[:200]}...")  # Log first 200 chars of prompt
-            return prompt
+            system_prompt = self.system_template.format(sample_report=student['sample_report'])
+            student_prompt = self.prompt_template.format(
+                **{key: student[key] for key in self.prompt_template.input_variables}
+            )
+            logger.debug(f"Generated prompt: {student_prompt[:200]}...")  # Log first 200 chars of prompt
+            return system_prompt, student_prompt
         except KeyError as e:
             logger.error(f"Missing required student data: {str(e)}")
             raise ReportGenerationError(f"Missing required student data: {str(e)}")
@@ -75,127 +226,453 @@ Other important information to include 1 sentence on:
             logger.error(f"Error generating prompt: {str(e)}")
             raise ReportGenerationError(f"Error generating prompt: {str(e)}")
 
-    async def generate_single_report(self, student: Dict[str, Any]) -> str:
-        """Generate a report for a single student"""
+    def generate_prompt(self, student: Dict[str, Any]) -> str:
+        """Generate the full prompt text for a single student"""
+        system_prompt, student_prompt = self.generate_prompt_parts(student)
+        return f"{system_prompt}\n\n{student_prompt}"
+
+    @staticmethod
+    def build_messages(system_prompt: str, student_prompt: str) -> List[BaseMessage]:
+        """Chat messages with the system prefix marked for Anthropic prompt caching"""
+        return [
+            SystemMessage(content=[{
+                'type': 'text',
+                'text': system_prompt,
+                'cache_control': {'type': 'ephemeral'}
+            }]),
+            HumanMessage(content=student_prompt)
+        ]
+
+    def _record_usage(self, usage: Optional[Dict[str, Any]]) -> None:
+        """Accumulate Anthropic token usage, including prompt cache reads and writes"""
+        if not usage:
+            return
+        for key in self.token_usage:
+            self.token_usage[key] += usage.get(key) or 0
+
+    async def _lookup_cache(self, prompt: str) -> Tuple[Optional[str], Optional[str]]:
+        """Return (cache key, cached report) for a prompt; both None when caching is disabled
+
+        The SQLite read runs in a thread so it never blocks the shared event loop.
+        """
+        if not self.cache:
+            return None, None
+        cache_key = self.cache.make_key(prompt, self.llm.model, self.llm.temperature)
+        return cache_key, await asyncio.to_thread(self.cache.get, cache_key)
+
+    async def generate_single_report(self, student: Dict[str, Any], on_token: Optional[Callable[[str], None]] = None,
+                                     deadline: Optional[float] = None) -> str:
+        """
+        Generate a report for a single student, streaming text chunks to on_token if given
+
+        Transient failures (rate limits, overload, timeouts) are retried with
+        jittered exponential backoff, honouring retry-after, for up to
+        ``max_attempts`` tries. No attempt or backoff runs past ``deadline``
+        (a time.monotonic() value).
+        """
+        name = student.get('student_name', 'unknown')
         try:
             logger.debug(f"Starting report generation for student: {student.get('student_name', 'unknown')}")
-            prompt = self.generate_prompt(student)
-            
-            # Use the LLM to generate the report
-            response = await self.llm.ainvoke(prompt)
-            if isinstance(response, AIMessage):
-                report = response.content
-            else:
-                report = str(response)
-                
-            logger.debug(f"Generated report for {student.get('student_name', 'unknown')}")
+            system_prompt, student_prompt = self.generate_prompt_parts(student)
+
+            # Reuse the report for an unchanged student from a previous run
+            cache_key, cached_report = await self._lookup_cache(f"{system_prompt}\n\n{student_prompt}")
+            if cached_report is not None:
+                logger.debug(f"Using cached report for {student.get('student_name', 'unknown')}")
+                return cached_report
+
+            messages = self.build_messages(system_prompt, student_prompt)
+            attempt = 0
+            while True:
+                attempt += 1
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise ReportGenerationError("Time budget for this job was exhausted")
+                try:
+                    # Use the LLM to generate the report, paced by the shared rate limiter
+                    await rate_limiter.acquire()
+                    if on_token:
+                        call = self._stream_report(messages, on_token)
+                    else:
+                        call = self._invoke_report(messages)
+                    report = await asyncio.wait_for(self._report_outcome(call), remaining)
+                    break
+                except asyncio.TimeoutError as e:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise ReportGenerationError("Time budget for this job was exhausted") from e
+                    raise
+                except Exception as e:
+                    if attempt >= self.max_attempts or not is_retryable(e):
+                        raise
+                    delay = backoff_delay(attempt, retry_after=retry_after_seconds(e))
+                    if deadline is not None and time.monotonic() + delay >= deadline:
+                        raise
+                    logger.warning(f"Attempt {attempt} for {name} failed ({type(e).__name__}: {str(e)}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+
+            if cache_key:
+                await asyncio.to_thread(self.cache.set, cache_key, report)
+
+            logger.debug(f"Generated report for {name}")
             return report
         except Exception as e:
-            logger.error(f"Error generating report for {student.get('student_name', 'unknown')}: {str(e)}")
-            raise ReportGenerationError(f"Error generating report for {student.get('student_name', 'unknown')}: {str(e)}")
+            logger.error(f"Error generating report for {name}: {str(e)}")
+            raise ReportGenerationError(f"Error generating report for {name}: {str(e)}") from e
 
-    async def generate_reports(self, student_list: List[Dict[str, Any]]) -> List[str]:
-        """Generate reports for multiple students concurrently"""
+    @staticmethod
+    async def _report_outcome(call: Awaitable[str]) -> str:
+        """Await an LLM call and feed its outcome into the shared rate limiter
+
+        The model is built with max_retries=0, so each call is exactly one API
+        request. Headers of successful responses reach the limiter through
+        RateLimitedChatAnthropic's response hook; error responses (429, 529,
+        ...) carry retry-after and anthropic-ratelimit-* headers as well.
+        """
+        try:
+            report = await call
+        except anthropic.APIStatusError as e:
+            rate_limiter.on_error_response(e.response)
+            raise
+        rate_limiter.on_success()
+        return report
+
+    async def _invoke_report(self, messages: List[BaseMessage]) -> str:
+        """Generate a report from the LLM in a single call"""
+        response = await self.llm.ainvoke(messages)
+        if isinstance(response, AIMessage):
+            self._record_usage(response.response_metadata.get('usage'))
+            return response.content
+        return str(response)
+
+    async def _stream_report(self, messages: List[BaseMessage], on_token: Callable[[str], None]) -> str:
+        """Stream a report from the LLM, passing each text chunk to on_token"""
+        response = None
+        async for chunk in self.llm.astream(messages):
+            if isinstance(chunk.content, str) and chunk.content:
+                on_token(chunk.content)
+            response = chunk if response is None else response + chunk
+        if response is None:
+            return ''
+        if response.usage_metadata:
+            details = response.usage_metadata.get('input_token_details') or {}
+            cache_read = details.get('cache_read') or 0
+            cache_creation = details.get('cache_creation') or 0
+            self._record_usage({
+                'input_tokens': response.usage_metadata['input_tokens'] - cache_read - cache_creation,
+                'output_tokens': response.usage_metadata['output_tokens'],
+                'cache_read_input_tokens': cache_read,
+                'cache_creation_input_tokens': cache_creation
+            })
+        return response.content if isinstance(response.content, str) else str(response.content)
+
+    async def generate_reports(self, student_list: List[Dict[str, Any]], max_concurrency: Optional[int] = None) -> List[str]:
+        """Generate reports for multiple students concurrently, returned in input order"""
         try:
             logger.info(f"Starting batch report generation for {len(student_list)} students")
-            reports = []
-            for student in student_list:
-                report = await self.generate_single_report(student)
-                reports.append(report)
+            semaphore = asyncio.Semaphore(max_concurrency or self.max_concurrency)
+
+            async def _generate(student: Dict[str, Any]) -> str:
+                async with semaphore:
+                    return await self.generate_single_report(student)
+
+            reports = await asyncio.gather(*(_generate(student) for student in student_list))
             logger.info(f"Successfully generated {len(reports)} reports")
-            return reports
+            return list(reports)
         except Exception as e:
             logger.error(f"Error generating batch reports: {str(e)}")
             raise ReportGenerationError(f"Error generating batch reports: {str(e)}")
 
-    async def generate_reports_with_progress(self, student_list: List[Dict[str, Any]], user_id: str, progress_tracker: dict) -> List[str]:
-        """Generate reports for multiple students with progress tracking"""
+    async def generate_reports_with_progress(self, student_list: List[Dict[str, Any]], progress_key: str, progress_tracker: ProgressStore,
+                                             max_concurrency: Optional[int] = None, on_report: Optional[ReportCallback] = None,
+                                             on_token: Optional[TokenCallback] = None,
+                                             completed_reports: Optional[Dict[int, str]] = None,
+                                             on_checkpoint: Optional[CheckpointCallback] = None,
+                                             deadline: Optional[float] = None) -> List[str]:
+        """Generate reports for multiple students with progress tracking
+
+        Up to ``max_concurrency`` students are generated at once. Progress is
+        written under ``progress_key`` (the job's upload ID) from a worker
+        thread and ``on_report`` called as each student finishes, and reports are
+        returned in the same order as ``student_list``. ``on_token``
+        streams report text as it is generated. Classes of ``batch_threshold``
+        students or more are sent as a single Message Batch instead, which
+        cannot stream tokens.
+
+        The whole call is bounded by ``time_budget`` seconds, or by an explicit
+        ``deadline`` (a time.monotonic() value): students still unfinished
+        when it runs out get a failure placeholder.
+
+        ``completed_reports`` maps student index to a report saved by an
+        earlier, interrupted run; those students are not generated again.
+        ``on_checkpoint`` is awaited with each newly generated report so it
+        can be persisted.
+        """
+        total = len(student_list)
+        completed_reports = completed_reports or {}
+        if deadline is None and self.time_budget:
+            deadline = time.monotonic() + self.time_budget
+        progress = _ProgressWriter(progress_tracker, progress_key)
         try:
-            logger.info(f"Starting batch report generation for {len(student_list)} students")
-            reports = []
+            pending = [i for i in range(total) if i not in completed_reports]
+            if self.batch_threshold and len(pending) >= self.batch_threshold:
+                return await self._generate_reports_in_batch(student_list, progress_key, progress_tracker, on_report, deadline,
+                                                             completed_reports, on_checkpoint)
+
+            concurrency = max_concurrency or self.max_concurrency
+            logger.info(f"Starting batch report generation for {len(pending)}/{total} students (max {concurrency} in flight)")
+            semaphore = asyncio.Semaphore(concurrency)
+            reports: List[Optional[str]] = [completed_reports.get(i) for i in range(total)]
             failed_reports = []
-            
-            for i, student in enumerate(student_list, 1):
-                try:
-                    # Update progress before generating each report
-                    progress_tracker[user_id] = {
-                        'current': i - 1,  # Show previous completed count
-                        'total': len(student_list),
-                        'status': f'Generating report {i}/{len(student_list)}',
-                        'progress': int(((i - 1) / len(student_list)) * 90)  # Reserve 10% for final steps
-                    }
-                    
-                    report = await self.generate_single_report(student)
-                    reports.append(report)
-                    
-                    # Update progress after successful generation
-                    progress_tracker[user_id] = {
-                        'current': i,
-                        'total': len(student_list),
-                        'status': f'Generated report {i}/{len(student_list)}',
-                        'progress': int((i / len(student_list)) * 90)
-                    }
-                    
-                    logger.debug(f"Generated report {i}/{len(student_list)} for {student.get('student_name', 'unknown')}")
-                    
-                    # Add a small delay to avoid rate limiting
-                    await asyncio.sleep(0.5)
-                    
-                except Exception as e:
-                    logger.warning(f"Failed to generate report for student {student.get('student_name', 'unknown')}: {str(e)}")
-                    failed_reports.append(student.get('student_name', f'Student {i}'))
-                    # Add a placeholder report for failed generation
-                    reports.append(f"Report generation failed for {student.get('student_name', f'Student {i}')}. Error: {str(e)}")
-                    
-                    # Update progress to show we've processed this student (even if failed)
-                    progress_tracker[user_id] = {
-                        'current': i,
-                        'total': len(student_list),
-                        'status': f'Processed {i}/{len(student_list)} (some errors)',
-                        'progress': int((i / len(student_list)) * 90)
-                    }
-                    
-                    # Add a longer delay after an error to avoid further rate limiting
-                    await asyncio.sleep(2.0)
-                
+            completed = 0
+
+            progress.update({
+                'current': 0,
+                'total': total,
+                'status': f'Generating reports 0/{total}',
+                'progress': 0
+            })
+
+            def _record_completion(i: int, name: str) -> None:
+                nonlocal completed
+                completed += 1
+                if on_report:
+                    on_report(i, name, reports[i], completed, total)
+                status = f'Generated report {completed}/{total}'
+                if failed_reports:
+                    status = f'Processed {completed}/{total} (some errors)'
+                progress.update({
+                    'current': completed,
+                    'total': total,
+                    'status': status,
+                    'progress': int((completed / total) * 90)  # Reserve 10% for final steps
+                })
+
+            async def _generate(i: int, student: Dict[str, Any]) -> None:
+                name = student.get('student_name', f'Student {i + 1}')
+                async with semaphore:
+                    try:
+                        reports[i] = await self.generate_single_report(
+                            student,
+                            on_token=(lambda text: on_token(i, text)) if on_token else None,
+                            deadline=deadline
+                        )
+                        logger.debug(f"Generated report {i + 1}/{total} for {name}")
+                        await self._checkpoint(on_checkpoint, i, name, reports[i])
+                        _record_completion(i, name)
+
+                    except Exception as e:
+                        logger.warning(f"Failed to generate report for student {name}: {str(e)}")
+                        failed_reports.append(name)
+                        # Add a placeholder report for failed generation
+                        reports[i] = f"Report generation failed for {name}. Error: {str(e)}"
+                        _record_completion(i, name)
+
+            # Reports restored from checkpoints count as already finished
+            for i in sorted(completed_reports):
+                _record_completion(i, student_list[i].get('student_name', f'Student {i + 1}'))
+
+            await asyncio.gather(*(_generate(i, student_list[i]) for i in pending))
+            await progress.flush()
+
             if failed_reports:
                 logger.warning(f"Failed to generate reports for {len(failed_reports)} students: {failed_reports}")
-            
-            logger.info(f"Successfully generated {len(reports) - len(failed_reports)}/{len(reports)} reports")
+
+            logger.info(f"Successfully generated {total - len(failed_reports)}/{total} reports")
+            logger.info(f"Token usage: {self.token_usage}")
             return reports
-            
+
         except Exception as e:
             # Set error state in progress tracker
-            progress_tracker[user_id] = {
+            progress.update({
                 'current': 0,
-                'total': len(student_list),
+                'total': total,
                 'status': 'Error occurred during generation',
                 'progress': 0,
                 'error': str(e)
-            }
+            })
+            await progress.flush()
             logger.error(f"Error generating batch reports: {str(e)}")
             raise ReportGenerationError(f"Error generating batch reports: {str(e)}")
 
+    async def generate_class_reports(self, student_list: List[Dict[str, Any]], classes: Dict[str, List[int]], progress_key: str,
+                                     progress_tracker: ProgressStore, on_report: Optional[ReportCallback] = None,
+                                     on_token: Optional[TokenCallback] = None,
+                                     completed_reports: Optional[Dict[int, str]] = None,
+                                     on_checkpoint: Optional[CheckpointCallback] = None) -> List[str]:
+        """Generate reports for several classes within one job, one class at a time
+
+        ``classes`` maps each class name to the indexes of its students in
+        ``student_list``. Each class is generated as its own
+        generate_reports_with_progress run, so it keeps its own sample report
+        as the cached prompt prefix and a class of ``batch_threshold`` students
+        or more becomes its own Message Batch. Indexes given to the callbacks
+        and in ``completed_reports`` refer to ``student_list``, progress covers
+        the whole job, and ``time_budget`` applies to the job as a whole.
+        """
+        total = len(student_list)
+        completed_reports = completed_reports or {}
+        deadline = time.monotonic() + self.time_budget if self.time_budget else None
+        reports: List[Optional[str]] = [None] * total
+        done = 0
+
+        for class_name, indexes in classes.items():
+            logger.info(f"Generating reports for class {class_name} ({len(indexes)} students)")
+            class_on_report = None
+            if on_report:
+                def class_on_report(i: int, name: str, report: str, completed: int, class_total: int,
+                                    indexes=indexes, offset=done) -> None:
+                    on_report(indexes[i], name, report, offset + completed, total)
+
+            class_on_checkpoint = None
+            if on_checkpoint:
+                async def class_on_checkpoint(i: int, name: str, report: str, indexes=indexes) -> None:
+                    await on_checkpoint(indexes[i], name, report)
+
+            class_reports = await self.generate_reports_with_progress(
+                [student_list[i] for i in indexes],
+                progress_key,
+                _ClassProgress(progress_tracker, class_name, done, total),
+                on_report=class_on_report,
+                on_token=(lambda i, text, indexes=indexes: on_token(indexes[i], text)) if on_token else None,
+                completed_reports={
+                    local: completed_reports[i] for local, i in enumerate(indexes) if i in completed_reports
+                },
+                on_checkpoint=class_on_checkpoint,
+                deadline=deadline
+            )
+            for local, i in enumerate(indexes):
+                reports[i] = class_reports[local]
+            done += len(indexes)
+
+        return reports
+
+    @staticmethod
+    async def _checkpoint(on_checkpoint: Optional[CheckpointCallback], index: int, name: str, report: str) -> None:
+        """Persist a finished report; a failed checkpoint never fails the student"""
+        if not on_checkpoint:
+            return
+        try:
+            await on_checkpoint(index, name, report)
+        except Exception as e:
+            logger.warning(f"Failed to checkpoint report for {name}: {str(e)}")
+
+    async def _generate_reports_in_batch(self, student_list: List[Dict[str, Any]], progress_key: str, progress_tracker: ProgressStore,
+                                         on_report: Optional[ReportCallback] = None, deadline: Optional[float] = None,
+                                         completed_reports: Optional[Dict[int, str]] = None,
+                                         on_checkpoint: Optional[CheckpointCallback] = None) -> List[str]:
+        """Generate uncached reports through one Message Batch, mapped back by custom id"""
+        total = len(student_list)
+        completed_reports = completed_reports or {}
+        logger.info(f"Starting message batch generation for {total - len(completed_reports)}/{total} students")
+        reports: List[Optional[str]] = [completed_reports.get(i) for i in range(total)]
+        progress = _ProgressWriter(progress_tracker, progress_key)
+        prompts = {}
+        cache_keys = {}
+        failed_reports = []
+
+        for i, student in enumerate(student_list):
+            if reports[i] is not None:
+                continue
+            name = student.get('student_name', f'Student {i + 1}')
+            try:
+                system_prompt, student_prompt = self.generate_prompt_parts(student)
+            except ReportGenerationError as e:
+                failed_reports.append(name)
+                reports[i] = f"Report generation failed for {name}. Error: {str(e)}"
+                continue
+            cache_key, cached_report = await self._lookup_cache(f"{system_prompt}\n\n{student_prompt}")
+            if cached_report is not None:
+                reports[i] = cached_report
+                await self._checkpoint(on_checkpoint, i, name, cached_report)
+                continue
+            custom_id = f"student-{i}"
+            prompts[custom_id] = (system_prompt, student_prompt)
+            cache_keys[custom_id] = cache_key
+
+        ready = total - len(prompts)
+        completed = 0
+
+        def _report_ready(i: int) -> None:
+            nonlocal completed
+            completed += 1
+            if on_report:
+                on_report(i, student_list[i].get('student_name', f'Student {i + 1}'), reports[i], completed, total)
+
+        # Cached and unpromptable students are already done; the rest arrive when the batch ends
+        for i, report in enumerate(reports):
+            if report is not None:
+                _report_ready(i)
+
+        def _on_poll(request_counts) -> None:
+            finished = ready + request_counts.succeeded + request_counts.errored + request_counts.canceled + request_counts.expired
+            progress.update({
+                'current': finished,
+                'total': total,
+                'status': f'Waiting for batch results ({request_counts.processing} in progress)',
+                'progress': int((finished / total) * 90)
+            })
+
+        progress.update({
+            'current': ready,
+            'total': total,
+            'status': f'Submitted {len(prompts)} reports as a batch',
+            'progress': int((ready / total) * 90)
+        })
+
+        if prompts:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                results = await self.batch_backend.generate(prompts, on_poll=_on_poll, timeout=timeout)
+            finally:
+                # A failed batch must not leave a poll update to land after the caller's error progress
+                await progress.flush()
+            for custom_id in prompts:
+                i = int(custom_id.split('-')[1])
+                name = student_list[i].get('student_name', f'Student {i + 1}')
+                result = results.get(custom_id, {'error': 'No result returned for this student'})
+                if 'report' in result:
+                    reports[i] = result['report']
+                    self._record_usage(result.get('usage'))
+                    if cache_keys[custom_id]:
+                        await asyncio.to_thread(self.cache.set, cache_keys[custom_id], result['report'])
+                    await self._checkpoint(on_checkpoint, i, name, result['report'])
+                else:
+                    logger.warning(f"Failed to generate report for student {name}: {result['error']}")
+                    failed_reports.append(name)
+                    reports[i] = f"Report generation failed for {name}. Error: {result['error']}"
+                _report_ready(i)
+
+        status = f'Generated report {total}/{total}'
+        if failed_reports:
+            status = f'Processed {total}/{total} (some errors)'
+            logger.warning(f"Failed to generate reports for {len(failed_reports)} students: {failed_reports}")
+        progress.update({
+            'current': total,
+            'total': total,
+            'status': status,
+            'progress': 90
+        })
+        await progress.flush()
+        logger.info(f"Successfully generated {total - len(failed_reports)}/{total} reports")
+        logger.info(f"Token usage: {self.token_usage}")
+        return reports
+
     async def create_word_doc(self, reports: List[str], output_dir: str = "/tmp/reports") -> str:
-        """Create a Word document containing all reports"""
+        """Create a Word document containing all reports
+
+        For a generation run, prefer feeding an IncrementalWordDoc from
+        on_report so the document is built while reports are still arriving.
+        """
         try:
-            logger.debug(f"Creating Word document with {len(reports)} reports")
+            filename, buffer = await IncrementalWordDoc(len(reports)).save(reports)
+        except DocxBuilderError as e:
+            raise ReportGenerationError(str(e))
+
+        def _write() -> str:
             os.makedirs(output_dir, exist_ok=True)
-            doc = Document()
-            
-            for i, report in enumerate(reports, 1):
-                logger.debug(f"Adding report {i} to document")
-                doc.add_heading(f"Student Report {i}", level=1)
-                doc.add_paragraph(report)
-                if i < len(reports):
-                    doc.add_page_break()
-            
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            output_path = os.path.join(output_dir, f"student_reports_{timestamp}.docx")
-            logger.debug(f"Saving document to: {output_path}")
-            doc.save(output_path)
-            logger.info(f"Successfully created Word document at {output_path}")
+            output_path = os.path.join(output_dir, filename)
+            with buffer, open(output_path, 'wb') as f:
+                shutil.copyfileobj(buffer, f)
             return output_path
-        except Exception as e:
-            logger.error(f"Error creating Word document: {str(e)}")
-            raise ReportGenerationError(f"Error creating Word document: {str(e)}")
+
+        return await asyncio.to_thread(_write)
@@ -0,0 +1,138 @@
+import io
+import os
+import html
+import json
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+from utils.docx_builder import render_word_doc, write_report_bundle
+
+logger = logging.getLogger(__name__)
+
+# format -> (file extension, content type)
+RENDER_FORMATS = {
+    'docx': ('.docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+    'per_student': ('.zip', 'application/zip'),
+    'per_class': ('.zip', 'application/zip'),
+    'txt': ('.txt', 'text/plain; charset=utf-8'),
+    'html': ('.html', 'text/html; charset=utf-8')
+}
+
+class ReportRenderError(Exception):
+    """Base exception for on-demand report rendering errors"""
+    pass
+
+class ReportRenderer:
+    """Renders stored report text into downloadable documents on demand
+
+    Rendered documents are kept in an in-process LRU cache keyed on a hash
+    of the report set (every student's name, class and report) and the
+    format, so repeat downloads are served from memory and a regenerated
+    report set never hits a stale entry. The least recently used documents
+    are evicted once the cache holds more than ``max_entries`` documents or
+    ``max_bytes`` in total. Each gunicorn worker keeps its own cache.
+    """
+
+    def __init__(self, max_entries: int = 64, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._cache: 'OrderedDict[Tuple[str, str], bytes]' = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def report_set_key(reports: List[str], students: List[Dict[str, Any]]) -> str:
+        """Content address for a set of reports and the students they belong to"""
+        digest = hashlib.sha256()
+        for student, report in zip(students, reports):
+            digest.update(json.dumps([student.get('student_name'), student.get('class_name'), report]).encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def render(self, reports: List[str], students: List[Dict[str, Any]], fmt: str) -> bytes:
+        """
+        Render reports in the given format, from the cache when possible
+
+        Args:
+            reports: Reports in the same order as students
+            students: Student records (student_name, class_name)
+            fmt: One of RENDER_FORMATS
+
+        Returns:
+            bytes: The rendered document
+
+        Raises:
+            ReportRenderError: If the format is unknown or rendering fails
+        """
+        if fmt not in RENDER_FORMATS:
+            raise ReportRenderError(f"Unknown format '{fmt}'. Choose one of: {', '.join(RENDER_FORMATS)}")
+
+        key = (self.report_set_key(reports, students), fmt)
+        with self._lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+                self._hits += 1
+                return data
+            self._misses += 1
+
+        try:
+            data = self._render(reports, students, fmt)
+        except Exception as e:
+            logger.error(f"Error rendering {len(reports)} reports as {fmt}: {str(e)}")
+            raise ReportRenderError(f"Error rendering reports as {fmt}: {str(e)}")
+        logger.info(f"Rendered {len(reports)} reports as {fmt} ({len(data)} bytes)")
+
+        if len(data) <= self.max_bytes:
+            with self._lock:
+                if key not in self._cache:
+                    self._cache[key] = data
+                    self._size += len(data)
+                while len(self._cache) > self.max_entries or self._size > self.max_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._size -= len(evicted)
+        return data
+
+    @staticmethod
+    def _render(reports: List[str], students: List[Dict[str, Any]], fmt: str) -> bytes:
+        names = [student.get('student_name') or f"Student {i + 1}" for i, student in enumerate(students)]
+        if fmt == 'docx':
+            return render_word_doc(list(zip(names, reports)))
+        if fmt in ('per_student', 'per_class'):
+            buffer = io.BytesIO()
+            write_report_bundle(buffer, reports, students, fmt)
+            return buffer.getvalue()
+        if fmt == 'txt':
+            return '\n\n\n'.join(f"{name}\n\n{report}" for name, report in zip(names, reports)).encode('utf-8')
+        sections = ''.join(
+            f"<section><h2>{html.escape(name)}</h2>"
+            + ''.join(f"<p>{html.escape(paragraph)}</p>" for paragraph in report.split('\n\n') if paragraph.strip())
+            + "</section>\n"
+            for name, report in zip(names, reports)
+        )
+        return (
+            '<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Student Reports</title></head>\n'
+            f"<body>\n{sections}</body></html>\n"
+        ).encode('utf-8')
+
+    def stats(self) -> Dict[str, int]:
+        """Hit/miss counters and current size for this process's cache"""
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'entries': len(self._cache),
+                'bytes': self._size,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes
+            }
+
+# Create a singleton instance
+report_renderer = ReportRenderer(
+    max_entries=int(os.getenv('RENDER_CACHE_MAX_ENTRIES', '64')),
+    max_bytes=int(os.getenv('RENDER_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+)
@@ -0,0 +1,42 @@
+import random
+import asyncio
+from typing import Optional
+import anthropic
+
+# HTTP statuses worth retrying: request timeout, conflict, rate limited, server errors and 529 overloaded
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Classify an LLM call failure as transient (retry) or permanent (give up)
+
+    Rate limits, overload, server errors, timeouts and dropped connections are
+    transient. Bad requests, auth failures and invalid student data are not.
+    """
+    if isinstance(error, (anthropic.APITimeoutError, anthropic.APIConnectionError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Seconds requested by the server's retry-after header, if the error carries one"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        value = response.headers.get('retry-after')
+        return float(value) if value is not None else None
+    except (AttributeError, ValueError):
+        return None
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 30.0, retry_after: Optional[float] = None) -> float:
+    """
+    Full-jitter exponential backoff for the given 1-based attempt number
+
+    The delay is never shorter than the server's retry-after.
+    """
+    delay = random.uniform(0, min(cap, base * (2 ** (attempt - 1))))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
@@ -1,18 +1,211 @@
 import os
 import asyncio
-from typing import Optional
+import urllib.parse
+import httpx
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
 from supabase_config import supabase
+from utils.download_cache import download_cache, DownloadCache, DownloadCacheError
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Pooled async HTTP client for storage requests (one per process)
+STORAGE_CONNECT_TIMEOUT_SECONDS = float(os.getenv('STORAGE_CONNECT_TIMEOUT_SECONDS', '5'))
+STORAGE_TIMEOUT_SECONDS = float(os.getenv('STORAGE_TIMEOUT_SECONDS', '60'))
+STORAGE_MAX_CONNECTIONS = int(os.getenv('STORAGE_MAX_CONNECTIONS', '20'))
+STORAGE_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('STORAGE_MAX_KEEPALIVE_CONNECTIONS', '10'))
+STORAGE_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv('STORAGE_KEEPALIVE_EXPIRY_SECONDS', '30'))
+
+# Local files are uploaded in chunks of this size, each read off the event loop
+UPLOAD_CHUNK_BYTES = 256 * 1024
+
 class StorageError(Exception):
     """Base exception for storage operations"""
     pass
 
+# File types that may be downloaded from storage
+ALLOWED_DOWNLOAD_EXTENSIONS = {'.docx', '.zip', '.pdf', '.txt', '.xlsx'}
+
+# Content types for uploads, by file extension
+CONTENT_TYPES = {
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.zip': 'application/zip',
+    '.pdf': 'application/pdf'
+}
+
+def error_details(response: httpx.Response) -> Tuple[bool, str]:
+    """
+    Read an error response from the storage API (its body must already be read)
+
+    Returns:
+        Tuple[bool, str]: Whether the error means the object does not exist, and the error message
+    """
+    try:
+        error = response.json()
+    except ValueError:
+        error = None
+    if not isinstance(error, dict):
+        error = {}
+    # Supabase storage reports a missing object as a 404, or as a 400 carrying statusCode 404
+    missing = (response.status_code == 404 or str(error.get('statusCode')) == '404'
+               or error.get('error') in ('not_found', 'NoSuchKey'))
+    return missing, error.get('message') or response.text or str(response.status_code)
+
+def validate_download_type(filename: str) -> None:
+    """Raise StorageError unless filename has a downloadable extension"""
+    file_ext = os.path.splitext(filename)[1].lower()
+    if file_ext not in ALLOWED_DOWNLOAD_EXTENSIONS:
+        raise StorageError(f"Invalid file type. Allowed types: {', '.join(sorted(ALLOWED_DOWNLOAD_EXTENSIONS))}")
+
+def _write_file(path: str, content: bytes) -> None:
+    with open(path, "wb") as f:
+        f.write(content)
+
+async def _read_file_chunks(path: str) -> AsyncIterator[bytes]:
+    """Yield a local file's contents in chunks, reading each in a worker thread"""
+    f = await asyncio.to_thread(open, path, "rb")
+    try:
+        while True:
+            chunk = await asyncio.to_thread(f.read, UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
 class StorageService:
-    def __init__(self, supabase_client):
+    """Uploads, downloads and deletes files in Supabase storage
+
+    Requests are sent on one connection-pooled httpx.AsyncClient per process
+    (see ``http_client``) instead of through the synchronous storage3 client,
+    so transfers overlap with LLM calls and other work on the event loop and
+    connections are kept alive between requests. The storage3 client still
+    supplies the storage URL and the current auth headers.
+    """
+
+    # Pooled async HTTP client per process, see http_client
+    _http_clients: Dict[int, httpx.AsyncClient] = {}
+
+    def __init__(self, supabase_client, cache: Optional[DownloadCache] = download_cache):
         self.supabase = supabase_client
+        self.cache = cache
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        """
+        This process's pooled client for storage requests
+
+        Only use it from coroutines on the shared event loop (utils.event_loop),
+        since async connection pools are bound to the loop that first used them.
+        """
+        pid = os.getpid()
+        client = StorageService._http_clients.get(pid)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=httpx.Timeout(STORAGE_TIMEOUT_SECONDS, connect=STORAGE_CONNECT_TIMEOUT_SECONDS),
+                limits=httpx.Limits(
+                    max_connections=STORAGE_MAX_CONNECTIONS,
+                    max_keepalive_connections=STORAGE_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=STORAGE_KEEPALIVE_EXPIRY_SECONDS
+                )
+            )
+            StorageService._http_clients = {pid: client}
+        return client
+
+    async def _request(self, method: str, path: str, headers: Optional[Dict[str, str]] = None,
+                       **kwargs: Any) -> httpx.Response:
+        """
+        Send a request to the storage API on the pooled client
+
+        Args:
+            method: HTTP method
+            path: Path relative to the storage API, e.g. object/<bucket>/<path>
+            headers: Headers to send in addition to the storage client's auth headers
+            **kwargs: Passed on to httpx (json, data, files, ...)
+
+        Returns:
+            httpx.Response: The response, whatever its status
+
+        Raises:
+            StorageError: If the request could not be sent or timed out
+        """
+        # Read on every request: supabase rebuilds the storage client when the auth session changes
+        session = self.supabase.storage.session
+        try:
+            return await self.http_client.request(
+                method, session.base_url.join(path), headers={**session.headers, **(headers or {})}, **kwargs
+            )
+        except httpx.HTTPError as e:
+            raise StorageError(f"Storage request failed: {type(e).__name__}: {str(e)}")
+
+    async def upload_object(self, storage_path: str, content: Union[bytes, str], bucket: str = "uploads",
+                            content_type: Optional[str] = None) -> str:
+        """
+        Upload bytes or a local file to storage
+
+        Args:
+            storage_path: Destination path within the bucket
+            content: The file contents, or the path of a local file (as from SpooledBuffer.payload())
+            bucket: Storage bucket name
+            content_type: Content type to store, chosen from the file extension by default
+
+        Returns:
+            str: The object's path within the bucket (storage_path)
+
+        Raises:
+            StorageError: If the upload fails
+        """
+        filename = os.path.basename(storage_path)
+        content_type = content_type or CONTENT_TYPES.get(os.path.splitext(filename)[1].lower(), 'application/octet-stream')
+        headers = {'cache-control': 'max-age=3600', 'content-type': content_type, 'x-upsert': 'false'}
+        path = f"object/{bucket}/{storage_path}"
+
+        # Sent as a raw body rather than multipart: httpx only takes sync file objects in
+        # files=, and a file read on the event loop would block it for the whole upload
+        if isinstance(content, str):
+            headers['content-length'] = str(await asyncio.to_thread(os.path.getsize, content))
+            response = await self._request('POST', path, headers=headers, content=_read_file_chunks(content))
+        else:
+            response = await self._request('POST', path, headers=headers, content=content)
+        if response.is_error:
+            _, message = error_details(response)
+            raise StorageError(f"Storage returned {response.status_code}: {message}")
+
+        logger.debug(f"Successfully uploaded {storage_path}")
+        return storage_path
+
+    def public_url(self, storage_path: str, bucket: str = "uploads") -> str:
+        """Public URL of an object, as from get_public_url but without its empty trailing query string"""
+        base_url = str(self.supabase.storage.session.base_url)
+        return f"{base_url}object/public/{bucket}/{storage_path}"
+
+    async def download_object(self, storage_path: str, bucket: str = "uploads") -> bytes:
+        """
+        Download an object's contents
+
+        Raises:
+            StorageError: If the object doesn't exist or the download fails
+        """
+        response = await self._request('GET', f"object/{bucket}/{storage_path}")
+        if response.is_error:
+            missing, message = error_details(response)
+            if missing:
+                raise StorageError(f"File {os.path.basename(storage_path)} not found in storage")
+            raise StorageError(f"Storage returned {response.status_code}: {message}")
+        return response.content
+
+    async def remove_objects(self, storage_paths: List[str], bucket: str = "documents") -> None:
+        """
+        Delete objects from a bucket; paths that don't exist are ignored
+
+        Raises:
+            StorageError: If storage rejects the request
+        """
+        response = await self._request('DELETE', f"object/{bucket}", json={'prefixes': storage_paths})
+        if response.is_error:
+            _, message = error_details(response)
+            raise StorageError(f"Storage returned {response.status_code}: {message}")
 
     async def upload_template(self, local_path: str, bucket: str = "documents") -> str:
         """Upload a template file to Supabase storage asynchronously"""
@@ -24,42 +217,21 @@ class StorageService:
             # Create a templates path
             storage_path = f"templates/{filename}"
             logger.debug(f"Uploading template file {filename} to bucket {bucket} with path {storage_path}")
-            
-            # Determine content type based on file extension
-            file_ext = os.path.splitext(filename)[1].lower()
-            content_types = {
-                '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                '.pdf': 'application/pdf'
-            }
-            content_type = content_types.get(file_ext, 'application/octet-stream')
-            
-            with open(local_path, "rb") as f:
-                # Upload file
-                try:
-                    self.supabase.storage.from_(bucket).upload(
-                        file=f,
-                        path=storage_path,
-                        file_options={"content-type": content_type}
-                    )
-                    logger.debug(f"Successfully uploaded template {storage_path}")
-                except Exception as upload_error:
-                    logger.error(f"Error during template upload: {str(upload_error)}")
-                    # Try to delete the file if it exists
-                    try:
-                        self.supabase.storage.from_(bucket).remove([storage_path])
-                        logger.debug(f"Cleaned up existing template {storage_path}")
-                    except Exception as delete_error:
-                        logger.warning(f"Failed to clean up existing template: {str(delete_error)}")
-                    raise StorageError(f"Failed to upload template: {str(upload_error)}")
-
-            # Get public URL
+
+            # Upload file; the content type is chosen from the file extension
             try:
-                public_url = self.supabase.storage.from_(bucket).get_public_url(storage_path)
-                logger.debug(f"Generated public URL for template {storage_path}")
-                return public_url
-            except Exception as url_error:
-                raise StorageError(f"Failed to get public URL for template: {str(url_error)}")
+                await self.upload_object(storage_path, local_path, bucket=bucket)
+                logger.debug(f"Successfully uploaded template {storage_path}")
+                return self.public_url(storage_path, bucket)
+            except StorageError as upload_error:
+                logger.error(f"Error during template upload: {str(upload_error)}")
+                # Try to delete the file if it exists
+                try:
+                    await self.remove_objects([storage_path], bucket=bucket)
+                    logger.debug(f"Cleaned up existing template {storage_path}")
+                except StorageError as delete_error:
+                    logger.warning(f"Failed to clean up existing template: {str(delete_error)}")
+                raise StorageError(f"Failed to upload template: {str(upload_error)}")
 
         except Exception as e:
             logger.error(f"Error in upload_template: {str(e)}")
@@ -78,35 +250,24 @@ class StorageService:
             # Create a user-specific path
             storage_path = f"{user_id}/{filename}"
             logger.debug(f"Uploading file {filename} to bucket {bucket} with path {storage_path}")
-            
-            # Read file in chunks to handle large files
-            chunk_size = 1024 * 1024  # 1MB chunks
-            with open(local_path, "rb") as f:
-                # Upload file
-                try:
-                    self.supabase.storage.from_(bucket).upload(
-                        file=f,
-                        path=storage_path,
-                        file_options={"content-type": "application/vnd.openxmlformats-officedocument.wordprocessingml.document"}
-                    )
-                    logger.debug(f"Successfully uploaded {storage_path}")
-                except Exception as upload_error:
-                    logger.error(f"Error during file upload: {str(upload_error)}")
-                    # Try to delete the file if it exists
-                    try:
-                        self.supabase.storage.from_(bucket).remove([storage_path])
-                        logger.debug(f"Cleaned up existing file {storage_path}")
-                    except Exception as delete_error:
-                        logger.warning(f"Failed to clean up existing file: {str(delete_error)}")
-                    raise StorageError(f"Failed to upload file: {str(upload_error)}")
-
-            # Get public URL
+
+            # Upload file, streamed from disk
             try:
-                public_url = self.supabase.storage.from_(bucket).get_public_url(storage_path)
-                logger.debug(f"Generated public URL for {storage_path}")
-                return public_url
-            except Exception as url_error:
-                raise StorageError(f"Failed to get public URL: {str(url_error)}")
+                await self.upload_object(
+                    storage_path, local_path, bucket=bucket,
+                    content_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+                )
+                logger.debug(f"Successfully uploaded {storage_path}")
+                return self.public_url(storage_path, bucket)
+            except StorageError as upload_error:
+                logger.error(f"Error during file upload: {str(upload_error)}")
+                # Try to delete the file if it exists
+                try:
+                    await self.remove_objects([storage_path], bucket=bucket)
+                    logger.debug(f"Cleaned up existing file {storage_path}")
+                except StorageError as delete_error:
+                    logger.warning(f"Failed to clean up existing file: {str(delete_error)}")
+                raise StorageError(f"Failed to upload file: {str(upload_error)}")
 
         except Exception as e:
             logger.error(f"Error in upload_file: {str(e)}")
@@ -114,17 +275,18 @@ class StorageService:
 
     async def download_file(self, filename: str, bucket: str = "documents", user_id: str = None, download_path: str = None, is_template: bool = False) -> str:
         """Download a file from Supabase storage asynchronously
-        
+
         Args:
             filename: Name of the file to download
             bucket: Storage bucket name
             user_id: User ID for the file path (not required for templates)
-            download_path: Optional path to save the file. If not provided, saves to /tmp/reports
+            download_path: Optional path to save the file. If not provided, the file is served
+                from the download cache (or saved to /tmp/reports when the cache is disabled)
             is_template: If True, downloads from templates folder instead of user folder
-            
+
         Returns:
             str: Path to the downloaded file
-            
+
         Raises:
             StorageError: If file doesn't exist, invalid file type, or other errors
         """
@@ -133,35 +295,18 @@ class StorageService:
             if not is_template and not user_id:
                 raise StorageError("User ID is required for file download")
 
-            # Validate file type
-            allowed_extensions = {'.docx', '.pdf', '.txt', '.xlsx'}
-            file_ext = os.path.splitext(filename)[1].lower()
-            if file_ext not in allowed_extensions:
-                raise StorageError(f"Invalid file type. Allowed types: {', '.join(allowed_extensions)}")
-
             # Set storage path based on whether it's a template or user file
             if is_template:
+                validate_download_type(filename)
                 storage_path = f"templates/{filename}"
-                list_path = "templates"
             else:
                 # For student reports, use the uploads bucket and reports subdirectory
                 bucket = "uploads"
-                storage_path = f"{user_id}/reports/{filename}"
-                list_path = f"{user_id}/reports"
-            
-            logger.debug(f"Checking if file exists: {storage_path} in bucket {bucket}")
+                storage_path = self.report_path(filename, user_id)
 
-            # Check if file exists in storage
-            try:
-                file_list = self.supabase.storage.from_(bucket).list(path=list_path)
-                
-                if not any(f['name'] == filename for f in file_list):
-                    raise StorageError(f"File {filename} not found in storage")
-                
-                logger.debug(f"File {filename} exists in storage at {storage_path}")
-            except Exception as list_error:
-                logger.error(f"Error checking file existence: {str(list_error)}")
-                raise StorageError(f"Error checking file existence: {str(list_error)}")
+            # Without an explicit destination, serve from (and fill) the shared download cache
+            if not download_path and self.cache:
+                return await self._download_cached(bucket, storage_path, filename)
 
             # Set default download path if not provided
             if not download_path:
@@ -171,39 +316,196 @@ class StorageService:
                 # Ensure the custom download path directory exists
                 os.makedirs(os.path.dirname(download_path), exist_ok=True)
 
-            # Download the file
+            # Download the file; a missing object comes back as a not-found error,
+            # so no separate existence check (or folder listing) is needed
             try:
-                response = self.supabase.storage.from_(bucket).download(storage_path)
-                
+                content = await self.download_object(storage_path, bucket=bucket)
+
                 # Write the file
-                with open(download_path, "wb") as f:
-                    f.write(response)
-                
+                await asyncio.to_thread(_write_file, download_path, content)
+
                 logger.debug(f"Successfully downloaded file to {download_path}")
                 return download_path
-                
+
+            except StorageError:
+                raise
             except Exception as download_error:
                 logger.error(f"Error during file download: {str(download_error)}")
                 raise StorageError(f"Failed to download file: {str(download_error)}")
 
+        except StorageError as e:
+            logger.error(f"Error in download_file: {str(e)}")
+            raise
         except Exception as e:
             logger.error(f"Error in download_file: {str(e)}")
             raise StorageError(f"Error downloading file from storage: {str(e)}")
 
+    async def _download_cached(self, bucket: str, storage_path: str, filename: str) -> str:
+        """Return a cached copy of an object, revalidating or downloading it as needed
+
+        Every cache call touches its SQLite index, which can wait on another
+        worker's lock, so each one runs in a thread off the shared event loop.
+        """
+        key = f"{bucket}/{storage_path}"
+        entry = await asyncio.to_thread(self.cache.lookup, key)
+        if entry and entry['fresh']:
+            await asyncio.to_thread(self.cache.record, 'hits', entry['size'])
+            logger.debug(f"Serving {storage_path} from the download cache")
+            return entry['path']
+
+        try:
+            status, content, headers = await self._fetch_object(bucket, storage_path, entry)
+        except StorageError as download_error:
+            logger.error(f"Error during file download: {str(download_error)}")
+            raise StorageError(f"Failed to download file: {str(download_error)}")
+
+        if status == 304:
+            await asyncio.to_thread(self.cache.mark_validated, key)
+            await asyncio.to_thread(self.cache.record, 'revalidated', entry['size'])
+            logger.debug(f"Revalidated cached copy of {storage_path}")
+            return entry['path']
+        if status == 404:
+            await asyncio.to_thread(self.cache.invalidate, key)
+            raise StorageError(f"File {filename} not found in storage")
+
+        await asyncio.to_thread(self.cache.record, 'misses')
+        try:
+            return await asyncio.to_thread(
+                self.cache.store, key, content, headers.get('etag'), headers.get('last-modified'),
+                os.path.splitext(filename)[1]
+            )
+        except DownloadCacheError as e:
+            raise StorageError(f"Failed to cache downloaded file: {str(e)}")
+
+    async def _fetch_object(self, bucket: str, storage_path: str, entry: Optional[Dict[str, Any]] = None) -> Tuple[int, bytes, Dict[str, str]]:
+        """
+        GET an object, conditionally on the cached entry's ETag / Last-Modified
+
+        Returns:
+            Tuple[int, bytes, Dict[str, str]]: 200 with the content and response headers,
+            304 if the cached entry is current, or 404 if there is no such object
+
+        Raises:
+            StorageError: For any other error response
+        """
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        response = await self._request('GET', f"object/{bucket}/{storage_path}", headers=headers)
+        if response.status_code in (200, 304):
+            return response.status_code, response.content, dict(response.headers)
+
+        missing, message = error_details(response)
+        if missing:
+            return 404, b'', dict(response.headers)
+        raise StorageError(f"Storage returned {response.status_code}: {message}")
+
+    @staticmethod
+    def report_path(filename: str, user_id: str) -> str:
+        """Storage path of a user's generated report in the uploads bucket
+
+        Raises:
+            StorageError: If the file type can't be downloaded
+        """
+        validate_download_type(filename)
+        return f"{user_id}/reports/{filename}"
+
+    async def create_signed_url(self, filename: str, user_id: str, expires_in: int = 60) -> str:
+        """
+        Short-lived URL from which the client can download a user's report directly
+
+        Args:
+            filename: Name of the report file
+            user_id: Owner of the report
+            expires_in: Seconds until the URL stops working
+
+        Returns:
+            str: The signed URL, which makes storage send the file as an attachment
+
+        Raises:
+            StorageError: If the file doesn't exist or the URL can't be created
+        """
+        storage_path = self.report_path(filename, user_id)
+        response = await self._request(
+            'POST', f"object/sign/uploads/{storage_path}", json={'expiresIn': str(expires_in), 'download': filename}
+        )
+        if response.is_error:
+            missing, message = error_details(response)
+            if missing:
+                raise StorageError(f"File {filename} not found in storage")
+            logger.error(f"Error creating signed URL for {storage_path}: {message}")
+            raise StorageError(f"Failed to create download URL: {message}")
+
+        # signedURL is relative to the storage API: /object/sign/<bucket>/<path>?token=...
+        signed = urllib.parse.urlparse(response.json()['signedURL'])
+        base_url = str(self.supabase.storage.session.base_url)
+        return (f"{base_url}{urllib.parse.quote(signed.path).lstrip('/')}?{signed.query}"
+                f"&download={urllib.parse.quote(filename)}")
+
+    def open_stream(self, filename: str, user_id: str, range_header: Optional[str] = None) -> httpx.Response:
+        """
+        Start streaming a user's report from storage
+
+        Blocking, on the storage client's own synchronous session: the WSGI
+        server iterates the response from a request thread, not the event
+        loop. A Range header is passed through, so the response may be a 206
+        partial response or a 416 for an unsatisfiable range.
+
+        Args:
+            filename: Name of the report file
+            user_id: Owner of the report
+            range_header: The client's Range header, if any
+
+        Returns:
+            httpx.Response: The unread response (200, 206 or 416); the caller must close it
+
+        Raises:
+            StorageError: If the file doesn't exist or storage returns an error
+        """
+        storage_path = self.report_path(filename, user_id)
+        # Identity encoding keeps Content-Length and Content-Range valid for the bytes passed on
+        headers = {'Accept-Encoding': 'identity'}
+        if range_header:
+            headers['Range'] = range_header
+
+        session = self.supabase.storage.session
+        try:
+            response = session.send(session.build_request('GET', f"object/uploads/{storage_path}", headers=headers), stream=True)
+        except httpx.HTTPError as e:
+            raise StorageError(f"Failed to download file: {str(e)}")
+        if response.status_code in (200, 206, 416):
+            return response
+
+        try:
+            response.read()
+        finally:
+            response.close()
+        missing, message = error_details(response)
+        if missing:
+            raise StorageError(f"File {filename} not found in storage")
+        raise StorageError(f"Storage returned {response.status_code}: {message}")
+
+    def forget_cached_report(self, filename: str, user_id: str) -> None:
+        """Drop a user's report from the download cache, e.g. once it has been deleted"""
+        if self.cache:
+            self.cache.invalidate(f"uploads/{user_id}/reports/{filename}")
+
     async def delete_file(self, filename: str, bucket: str = "documents", user_id: str = None) -> None:
         """Delete a file from Supabase storage asynchronously"""
+        storage_path = f"{user_id}/{filename}"
         try:
             if not user_id:
                 raise StorageError("User ID is required for file deletion")
-            
-            # Create the full storage path
-            storage_path = f"{user_id}/{filename}"
+
             logger.debug(f"Attempting to delete file: {storage_path}")
-            
+
             # Delete the file from storage
-            self.supabase.storage.from_(bucket).remove([storage_path])
+            await self.remove_objects([storage_path], bucket=bucket)
             logger.debug(f"Successfully deleted file: {storage_path}")
-            
+
         except Exception as e:
             logger.error(f"Error deleting file {storage_path}: {str(e)}")
             raise StorageError(f"Error deleting file from storage: {str(e)}")